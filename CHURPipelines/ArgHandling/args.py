@@ -7,6 +7,9 @@ import argparse
 import CHURPipelines
 from CHURPipelines.ArgHandling import group_template_args
 from CHURPipelines.ArgHandling import bulk_rnaseq_args
+from CHURPipelines.ArgHandling import profile_args
+from CHURPipelines.ArgHandling import status_args
+from CHURPipelines.ArgHandling import resubmit_args
 from CHURPipelines import DieGracefully
 
 
@@ -21,6 +24,12 @@ BRNASEQ_HELP = ('Bulk RNAseq analysis, including QC, mapping, and expression. '
                 'Alignment is performed with HISAT2. Read counts are '
                 'generated with featureCounts from the Subread package. '
                 'Expression anaylsis is done with edgeR in R.')
+PROFILE_HELP = ('Summarize the run time, CPU, memory, and I/O of each section '
+                'of the pipeline across all samples of a run.')
+STATUS_HELP = ('Show the progress of a run: the state and current section of '
+               'each sample, and an estimate of the time to finish.')
+RESUBMIT_HELP = ('Resubmit only the failed and unfinished samples of a run, '
+                 'optionally with more memory and time.')
 
 
 def usage():
@@ -37,6 +46,9 @@ online help is maintained at the GitHub repository.
 Currently, the following subcommands are supported:
     - group_template
     - bulk_rnaseq
+    - profile
+    - status
+    - resubmit
 
 For issues, contact help@msi.umn.edu.
 Version: {version}
@@ -94,9 +106,27 @@ def pipeline_args():
         'bulk_rnaseq',
         help=BRNASEQ_HELP,
         add_help=False)
+    # Resource profile parser
+    profile_parser = pipe_parser.add_parser(
+        'profile',
+        help=PROFILE_HELP,
+        add_help=False)
+    # Run status parser
+    status_parser = pipe_parser.add_parser(
+        'status',
+        help=STATUS_HELP,
+        add_help=False)
+    # Resubmission parser
+    resubmit_parser = pipe_parser.add_parser(
+        'resubmit',
+        help=RESUBMIT_HELP,
+        add_help=False)
 
     group_template_args.add_args(group_parser)
     bulk_rnaseq_args.add_args(bulk_rnaseq_parser)
+    profile_args.add_args(profile_parser)
+    status_args.add_args(status_parser)
+    resubmit_args.add_args(resubmit_parser)
     pargs = parser.parse_args()
     check_for_bad(pargs)
     return vars(pargs)
@@ -120,6 +120,55 @@ def add_args(ap):
               'Default: 10'),
         type=float,
         default=10)
+    ap_opt.add_argument(
+        '--de-engine',
+        metavar='<DE engine>',
+        dest='de_engine',
+        help=('How to test for differential expression. "qlf" is edgeR '
+              'quasi-likelihood F-tests. "qlf-trended" gives the same tests '
+              'without estimating the per-gene dispersions, which are not '
+              'used by the tests and are slow to estimate for large runs. '
+              '"voom" is limma-voom, which fits one linear model for all '
+              'comparisons and is the fastest for runs with hundreds of '
+              'samples. Default: qlf'),
+        choices=['qlf', 'qlf-trended', 'voom'],
+        default='qlf')
+    ap_opt.add_argument(
+        '--norm-engine',
+        metavar='<normalization engine>',
+        dest='norm_engine',
+        help=('How to write cpm_list.txt, filter the genes by expression, '
+              'and compute the TMM normalization factors. "r" is edgeR, in '
+              'the R summary script. "numpy" does the same in Python before '
+              'the R script runs, which is faster for large runs, and also '
+              'writes the factors to Counts/norm_factors.txt and the '
+              'normalized expression of the filtered genes to '
+              'Counts/filtered_cpm_list.txt. The R summary script still '
+              'runs for the plots and the DE tests, unless --counts-only is '
+              'given. Default: r'),
+        choices=['r', 'numpy'],
+        default='r')
+    ap_opt.add_argument(
+        '--counts-only',
+        help=('Write the count tables and the normalized expression, and do '
+              'not run the R summary script. The HTML report and the DE '
+              'tables are not updated. Use this with --summary-only to '
+              'refilter a finished run with new --min-counts or '
+              '--min-gene-length values. Requires --norm-engine numpy.'),
+        dest='counts_only',
+        action='store_true',
+        default=False)
+    ap_opt.add_argument(
+        '--report-detail-limit',
+        metavar='<num samples>',
+        dest='detail_limit',
+        help=('Maximum number of samples for which per-sample quality plots '
+              'are drawn in the HTML report. Above this, the report shows '
+              'the spread of quality across samples, and the per-sample '
+              'plots are written to separate pages that are linked from the '
+              'report. Default: 96'),
+        type=int,
+        default=96)
     ap_opt.add_argument(
         '--strand',
         metavar='<library strandedness>',
@@ -151,6 +200,33 @@ def add_args(ap):
               'any subsampling. Default: 0 (no subsampling).'),
         type=int,
         default=0)
+    ap_opt.add_argument(
+        '--shard-size',
+        metavar='<GB>',
+        dest='shard_size',
+        help=('Align samples whose R1 FASTQ file is larger than this many GB '
+              'in shards of about this size, each in its own array task, '
+              'and merge the alignments before marking duplicates. This '
+              'keeps very deep samples from setting the walltime of the '
+              'whole run. Not used with --subsample. If 0, then do not split '
+              'any samples. Default: 0 (no sharding).'),
+        type=float,
+        default=0)
+    ap_opt.add_argument(
+        '--bam-metrics',
+        metavar='<BAM metrics engine>',
+        dest='bam_metrics',
+        help=('How to collect the alignment metrics of each sample. "tools" '
+              'runs samtools stats, RNASeQC (unstranded and stranded), and '
+              'Picard CollectInsertSizeMetrics, which each read the BAM file. '
+              '"pysam" collects all of them in one pass over the BAM file, '
+              'with a gene index that is built from the GTF once per run. '
+              'Its RNASeQC metrics are close to, but not the same as, those '
+              'of RNASeQC. "pysam-rnaseqc" runs samtools stats and Picard, '
+              'and replaces only the two RNASeQC runs with one pysam pass. '
+              'Default: tools'),
+        choices=['tools', 'pysam', 'pysam-rnaseqc'],
+        default='tools')
     ap_opt.add_argument(
         '--headcrop',
         metavar='<num bp to crop>',
@@ -224,10 +300,52 @@ def add_args(ap):
         dest='no_auto_submit',
         action='store_true',
         default=False)
+    ap_opt.add_argument(
+        '--prescan',
+        help=('Read every FASTQ file when setting up the run, to count its '
+              'reads and check that it is not truncated or corrupt. The '
+              'counts are saved in fastq_prescan.tsv in the output directory '
+              'and are re-used for files that have not changed.'),
+        dest='prescan',
+        action='store_true',
+        default=False)
+    ap_opt.add_argument(
+        '--cache-dir',
+        metavar='<result cache directory>',
+        dest='cache_dir',
+        help=('Shared directory for caching per-sample results (trimming, '
+              'alignment, and QC outputs). Samples whose FASTQ files, '
+              'trimming/alignment options, HISAT2 index, and GTF match a '
+              'previous run are restored from the cache instead of being '
+              're-analyzed. Useful when re-running the same data with new '
+              'groups or filtering options. CHURP does not remove old '
+              'entries; the group that shares the directory is responsible '
+              'for pruning it. Default: no caching.'),
+        default=None)
 
     # Make an argument for scheduler options
     ap_sched = ap.add_argument_group(
         'Scheduler Options')
+    ap_sched.add_argument(
+        '--scheduler',
+        metavar='<scheduler>',
+        dest='scheduler',
+        help=('How to run the jobs. "slurm" submits them to the cluster with '
+              'sbatch. "local" runs them on this machine, with --ppn cores '
+              'for each sample and at most --max-cores in total; the pipeline '
+              'script then waits for all jobs to finish. The "local" '
+              'scheduler uses the programs in your PATH instead of loading '
+              'the MSI modules. Default: slurm'),
+        choices=['slurm', 'local'],
+        default='slurm')
+    ap_sched.add_argument(
+        '--max-cores',
+        metavar='<total cores>',
+        dest='max_cores',
+        help=('Total cores to use with "--scheduler local". Default: all '
+              'cores of this machine'),
+        type=int,
+        default=None)
     ap_sched.add_argument(
         '--queue',
         '-q',
@@ -273,6 +391,17 @@ def add_args(ap):
               'website for partition-specific limits.'),
         type=int,
         default=12000)
+    ap_sched.add_argument(
+        '--stage-local',
+        dest='stage_local',
+        help=('If supplied, run the steps of each single sample job in the '
+              'node-local temporary space of the job ($TMPDIR, up to the '
+              'size given with --tmp), and copy only the final BAMs, indices, '
+              'and metrics back to the working directory. Samples that need '
+              'more space than this run in the working directory. Default: '
+              'run in the working directory.'),
+        action='store_true',
+        default=False)
     ap_sched.add_argument(
         '--walltime',
         '-w',
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Add arguments for the run profile subcommand."""
+
+import argparse
+
+
+def add_args(ap):
+    """Takes an ArgumentParser object, and adds arguments to it. These args
+    will be for the run profile subcommand. The function returns NoneType; we
+    only call it for the side-effect of adding arguments to the parser
+    object."""
+    ap_req = ap.add_argument_group(
+        title='Required Arguments')
+    ap_req.add_argument(
+        'outdir',
+        metavar='<output directory>',
+        help='Output directory of a CHURP run.')
+    ap_opt = ap.add_argument_group(
+        'Optional Arguments')
+    ap_opt.add_argument(
+        '--help',
+        '-h',
+        help='Show this help message and exit.',
+        action='help')
+    ap_opt.add_argument(
+        '--output',
+        '-o',
+        metavar='<output file>',
+        dest='output',
+        help=('Also write the profile table to this file, tab-delimited. '
+              'Default: only print to the terminal.'),
+        default=None)
+    ap_opt.add_argument(
+        '--verbosity',
+        '-v',
+        metavar='<loglevel>',
+        dest='verbosity',
+        help=('How much logging output to show. '
+              'Choose one of "debug," "info," or "warn." Default: warn'),
+        choices=['debug', 'info', 'warn'],
+        default='warn')
+    return
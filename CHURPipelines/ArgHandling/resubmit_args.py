@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Add arguments for the resubmission subcommand."""
+
+import argparse
+
+
+def add_args(ap):
+    """Takes an ArgumentParser object, and adds arguments to it. These args
+    will be for the resubmission subcommand. The function returns NoneType; we
+    only call it for the side-effect of adding arguments to the parser
+    object."""
+    ap_req = ap.add_argument_group(
+        title='Required Arguments')
+    ap_req.add_argument(
+        'outdir',
+        metavar='<output directory>',
+        help='Output directory of a CHURP run.')
+    ap_opt = ap.add_argument_group(
+        'Optional Arguments')
+    ap_opt.add_argument(
+        '--help',
+        '-h',
+        help='Show this help message and exit.',
+        action='help')
+    ap_opt.add_argument(
+        '--mem-factor',
+        metavar='<factor>',
+        dest='mem_factor',
+        help=('Multiply the memory request of the resubmitted samples by this '
+              'factor, up to 512000 MB. Default: 1 (no change)'),
+        type=float,
+        default=1.0)
+    ap_opt.add_argument(
+        '--time-factor',
+        metavar='<factor>',
+        dest='time_factor',
+        help=('Multiply the walltime request of the resubmitted samples by '
+              'this factor, up to 96 hours. Default: 1 (no change)'),
+        type=float,
+        default=1.0)
+    ap_opt.add_argument(
+        '--purge',
+        dest='purge',
+        help=('Keep the purge setting of the original run. By default, '
+              'resubmitted samples continue from their last finished step.'),
+        action='store_true',
+        default=False)
+    ap_opt.add_argument(
+        '--no-submit',
+        help=('Write the resubmission script, but do not submit it.'),
+        dest='no_auto_submit',
+        action='store_true',
+        default=False)
+    ap_opt.add_argument(
+        '--verbosity',
+        '-v',
+        metavar='<loglevel>',
+        dest='verbosity',
+        help=('How much logging output to show. '
+              'Choose one of "debug," "info," or "warn." Default: warn'),
+        choices=['debug', 'info', 'warn'],
+        default='warn')
+    return
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Add arguments for the run status subcommand."""
+
+import argparse
+
+
+def add_args(ap):
+    """Takes an ArgumentParser object, and adds arguments to it. These args
+    will be for the run status subcommand. The function returns NoneType; we
+    only call it for the side-effect of adding arguments to the parser
+    object."""
+    ap_req = ap.add_argument_group(
+        title='Required Arguments')
+    ap_req.add_argument(
+        'outdir',
+        metavar='<output directory>',
+        help='Output directory of a CHURP run.')
+    ap_opt = ap.add_argument_group(
+        'Optional Arguments')
+    ap_opt.add_argument(
+        '--help',
+        '-h',
+        help='Show this help message and exit.',
+        action='help')
+    ap_opt.add_argument(
+        '--watch',
+        '-w',
+        metavar='<seconds>',
+        dest='watch',
+        help=('Refresh the status every <seconds> seconds (default 60 if no '
+              'value is given) until the run finishes. Only logs that have '
+              'changed are re-read. Press Ctrl-C to stop.'),
+        nargs='?',
+        type=int,
+        const=60,
+        default=None)
+    ap_opt.add_argument(
+        '--brief',
+        dest='brief',
+        help='Only print the counts, not the per-sample table.',
+        action='store_true',
+        default=False)
+    ap_opt.add_argument(
+        '--verbosity',
+        '-v',
+        metavar='<loglevel>',
+        dest='verbosity',
+        help=('How much logging output to show. '
+              'Choose one of "debug," "info," or "warn." Default: warn'),
+        choices=['debug', 'info', 'warn'],
+        default='warn')
+    return
@@ -16,6 +16,7 @@ BAD_FASTQ = 13
 EMPTY_FASTQ = 14
 BAD_NUMBER = 15
 BAD_QUEUE = 16
+BAD_CACHEDIR = 17
 BRNASEQ_INC_ARGS = 20
 BRNASEQ_CONFLICT = 21
 BAD_HISAT = 22
@@ -31,6 +32,11 @@ GROUP_NO_PIPE = 50
 GROUP_BAD_COL = 51
 BRNASEQ_GROUP_SUCCESS = 52
 BAD_ORG = 31
+BAD_RUNDIR = 32
+BAD_INPUTS = 33
+RESUB_NO_QUEUE = 34
+RESUB_SUMMARY_RUNNING = 35
+BRNASEQ_COUNTS_ONLY = 36
 NEFARIOUS_CHAR = 99
 
 # We will prepend a little message to the end that says the pipelines were
@@ -101,6 +107,20 @@ with this error and the debugging output.\n"""
     return
 
 
+def bad_cachedir():
+    """Call this function when the user supplies a bad result cache
+    directory."""
+    msg = CREDITS + """----------
+ERROR
+
+The result cache directory you have supplied is not suitable. Either it could
+not be created, or you do not have permissions to write into it. The cache
+directory must be writeable by everyone who shares it. Please choose another
+location, or leave out the --cache-dir option to run without a cache.\n"""
+    sys.stderr.write(msg)
+    return
+
+
 def bad_resources():
     """Call this function when the user supplies illegal PBS resources."""
     msg = CREDITS + """----------
@@ -154,6 +174,20 @@ directory. Please fix your command line and re-run.\n"""
     return
 
 
+def brnaseq_counts_only():
+    """Call this function when --counts-only is passed to the bulk_rnaseq
+    pipeline without --norm-engine numpy."""
+    msg = CREDITS + """----------
+ERROR
+
+
+The --counts-only option skips the R summary script, so the counts have to be
+normalized in Python. Please add --norm-engine numpy to your command line and
+re-run.\n"""
+    sys.stderr.write(msg)
+    return
+
+
 def brnaseq_conflict():
     """Call this function when there are conflicting arguments passed to the
     bulk_rnaseq pipeline."""
@@ -445,12 +479,85 @@ subcommand of CHURP. The names are *case sensitive.*\n"""
     return
 
 
+def bad_rundir(d, missing):
+    """Call this function if the user supplies a directory to one of the run
+    inspection subcommands that does not look like a CHURP output
+    directory."""
+    msg = CREDITS + """----------
+ERROR
+
+The directory you supplied does not look like the output directory of a CHURP
+run. We could not find {what} in
+
+{rundir}
+
+Please check the path. The output directory is the one given to the -o option
+when the pipeline was set up.\n"""
+    sys.stderr.write(msg.format(what=missing, rundir=d))
+    return
+
+
+def bad_inputs(problems):
+    """Call this function with the list of problems that were found when
+    checking the input files of a pipeline."""
+    msg = CREDITS + """----------
+ERROR
+
+We found the following problems with the input files for this run:
+
+{problems}
+
+Please fix or replace these files and try again. Files that are being copied
+or downloaded may show up as truncated until they are complete.\n"""
+    sys.stderr.write(msg.format(
+        problems='\n'.join('    - ' + p for p in problems)))
+    return
+
+
+def resub_no_queue(d, err):
+    """Call this function if the resubmit subcommand cannot read the Slurm
+    queue to find the tasks of a run that are still queued."""
+    msg = CREDITS + """----------
+ERROR
+
+We could not read the Slurm queue to check which tasks of the run in
+
+{rundir}
+
+are still queued or running. Resubmitting without this check could start a
+second copy of those tasks. The error was:
+
+{err}
+
+Please run the resubmit subcommand on a machine that can run squeue.\n"""
+    sys.stderr.write(msg.format(rundir=d, err=err))
+    return
+
+
+def resub_summary_running(d, jobs):
+    """Call this function if the summary job of a run is running when the
+    resubmit subcommand is called."""
+    msg = CREDITS + """----------
+ERROR
+
+The summary job of the run in
+
+{rundir}
+
+is still running (job {jobs}). Resubmitting samples now would change them while
+the summary job reads them. Please wait for it to finish, or cancel it with
+scancel, and then try again.\n"""
+    sys.stderr.write(msg.format(rundir=d, jobs=', '.join(jobs)))
+    return
+
+
 def die_gracefully(e, *args):
     """Print user-friendly error messages and exit."""
     err_dict = {
         BAD_LOGDIR: bad_logdir,
         BAD_OUTDIR: bad_outdir,
         BAD_WORKDIR: bad_workdir,
+        BAD_CACHEDIR: bad_cachedir,
         BAD_RESOURCES: bad_resources,
         BAD_FASTQ: bad_fastq,
         EMPTY_FASTQ: empty_fastq,
@@ -459,6 +566,7 @@ def die_gracefully(e, *args):
         BAD_QUEUE: bad_queue,
         BRNASEQ_INC_ARGS: brnaseq_inc,
         BRNASEQ_CONFLICT: brnaseq_conflict,
+        BRNASEQ_COUNTS_ONLY: brnaseq_counts_only,
         BAD_GTF: bad_gtf,
         BAD_ADAPT: bad_adapter,
         BRNASEQ_BAD_GPS: brnaseq_bad_groups,
@@ -471,7 +579,11 @@ def die_gracefully(e, *args):
         BRNASEQ_SUBMIT_FAIL: brnaseq_auto_submit_fail,
         NEFARIOUS_CHAR: nefarious_cmd,
         PE_SE_MIX: pe_se_mix,
-        BAD_ORG: bad_organism
+        BAD_ORG: bad_organism,
+        BAD_RUNDIR: bad_rundir,
+        BAD_INPUTS: bad_inputs,
+        RESUB_NO_QUEUE: resub_no_queue,
+        RESUB_SUMMARY_RUNNING: resub_summary_running
         }
     try:
         err_dict[e](*args)
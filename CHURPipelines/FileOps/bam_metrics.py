@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+"""Collect the alignment metrics of one sample in a single pass over its
+coordinate-sorted BAM file. This is run by the single sample job when
+bulk_rnaseq is given --bam-metrics pysam, as
+
+    python3 -m CHURPipelines.FileOps.bam_metrics --bam <Raw_CoordSort.bam> \\
+        --gtf <annotation GTF> --sample <sample name> --paired <true|false> \\
+        --stranded <FR|RF|none> --index-dir <directory> --threads <n> \\
+        --is-metrics <insert size metrics file>
+
+and replaces samtools stats, the two RNASeQC runs, and Picard
+CollectInsertSizeMetrics, which read the BAM four times between them. It
+writes the files that the summary job collates, in the formats of the tools:
+
+    <sample>_bamstats.txt                   The SN lines of samtools stats
+                                            that go into the report
+    RNASeQC_Out/<sample>.metrics.tsv        RNASeQC metrics, strand-aware
+    RNASeQC_Out/<sample>_Unstranded.metrics.tsv
+                                            RNASeQC metrics, unstranded
+    IS_Stats.txt                            The median, mean, standard
+                                            deviation, and the widths of the
+                                            10, 30, 70, and 90% bins of the
+                                            insert sizes (paired-end only)
+
+The insert size metrics and their histogram also go into the file given by
+--is-metrics. With --metrics rnaseqc, only the two RNASeQC files are written,
+for runs that keep samtools stats and Picard but not the two RNASeQC runs.
+The reads are classified against an index of the merged exons of each gene,
+which is built from the GTF on the first run and kept in --index-dir for the
+other samples of the run. The contigs are split among --threads worker
+processes.
+
+The definitions follow the tools, with some simplifications:
+
+  - samtools stats: the counts are of the primary alignments, and the
+    average length and quality are over the bases of those reads.
+  - RNASeQC: only the reads with the unique HISAT2 mapping quality (60) are
+    classified. A read is exonic if its aligned blocks overlap the exons of
+    one gene, intronic if it overlaps a gene but no exons, intergenic if it
+    overlaps no gene, and ambiguous if it overlaps the exons of more than one
+    gene. In the strand-aware metrics, only the genes on the strand of the
+    transcript count. The library complexity is the Picard estimate from the
+    duplicate flags, of read pairs for paired-end data.
+  - Picard: the insert sizes are of the reads that pass the MAPQ filter of
+    the counts, with the read and pair filters of CollectInsertSizeMetrics.
+
+This module needs pysam."""
+
+import argparse
+import collections
+import gzip
+import hashlib
+import math
+import multiprocessing
+import os
+import pickle
+import re
+import sys
+
+import pysam
+
+from CHURPipelines.FileOps import output_writer
+
+# Version of the gene index format. Bump this if build_index() changes, so
+# that old indices are rebuilt.
+INDEX_VERSION = 1
+# The gene and exon intervals are kept in bins of 2^BIN_SHIFT bp
+BIN_SHIFT = 14
+# The MAPQ of a unique HISAT2 alignment. This is also the filter for the BAM
+# that is counted.
+UNIQUE_MAPQ = 60
+# Gene types that count towards the rRNA rate
+RRNA_TYPES = {'rRNA', 'Mt_rRNA', 'rRNA_pseudogene'}
+# Insert size metrics: the orientations in the order Picard reports them,
+# the smallest fraction of the pairs for an orientation to be reported, the
+# number of median absolute deviations that the histogram is trimmed to for
+# the mean and standard deviation, and the bin widths that are reported.
+ORIENTATIONS = ['FR', 'RF', 'TANDEM']
+IS_MIN_PCT = 0.05
+IS_DEVIATIONS = 10
+IS_WIDTHS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.99]
+# The widths that go into IS_Stats.txt, after the median, mean, and SD
+IS_STATS_WIDTHS = [0.1, 0.3, 0.7, 0.9]
+# The read classes of the RNASeQC metrics
+READ_CLASSES = ['exonic', 'intronic', 'intergenic', 'ambiguous', 'rrna']
+
+# The gene index of the worker processes. It is loaded before the pool is
+# started, so that the workers share it instead of each receiving a copy.
+_INDEX = None
+GENE_ID = re.compile(r'gene_id "([^"]*)"')
+GENE_TYPE = re.compile(r'gene_(?:bio)?type "([^"]*)"')
+
+
+def open_text(path):
+    """Open a plain or gzipped text file for reading."""
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rt')
+    return open(path, 'rt')
+
+
+def merge_intervals(intervals):
+    """Merge overlapping or adjacent (start, end) intervals. Returns a sorted
+    list."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [tuple(i) for i in merged]
+
+
+def add_to_bins(bins, start, end, value):
+    """Add an interval to every bin that it overlaps."""
+    for b in range(start >> BIN_SHIFT, ((end - 1) >> BIN_SHIFT) + 1):
+        bins.setdefault(b, []).append((start, end, value))
+    return
+
+
+def build_index(gtf):
+    """Build the gene index from the exons in a GTF. Returns a dictionary
+    with the gene strands, whether each gene is an rRNA gene, and, for each
+    contig, the binned gene spans and merged exons. Genes are numbered in
+    the order of their IDs; a gene ID on more than one contig is a separate
+    gene on each."""
+    genes = collections.OrderedDict()
+    with open_text(gtf) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9 or fields[2] != 'exon':
+                continue
+            gid = GENE_ID.search(fields[8])
+            if not gid:
+                continue
+            gtype = GENE_TYPE.search(fields[8])
+            key = (fields[0], gid.group(1))
+            if key not in genes:
+                genes[key] = {
+                    'strand': fields[6],
+                    'rrna': bool(gtype) and gtype.group(1) in RRNA_TYPES,
+                    'exons': []}
+            # GTF coordinates are 1-based and closed; ours are 0-based and
+            # half-open, like pysam's
+            genes[key]['exons'].append((int(fields[3]) - 1, int(fields[4])))
+    index = {'strands': [], 'rrna': [], 'contigs': {}}
+    for g, key in enumerate(sorted(genes)):
+        contig = key[0]
+        gene = genes[key]
+        exons = merge_intervals(gene['exons'])
+        index['strands'].append(gene['strand'])
+        index['rrna'].append(gene['rrna'])
+        bins = index['contigs'].setdefault(contig, ({}, {}))
+        add_to_bins(bins[0], exons[0][0], exons[-1][1], g)
+        for start, end in exons:
+            add_to_bins(bins[1], start, end, g)
+    return index
+
+
+def load_index(gtf, index_dir):
+    """Return the gene index of a GTF. The index is stored in index_dir,
+    named by the path, size, and modification time of the GTF, and is built
+    if it is not there. It is written to a temporary file and renamed, so
+    that the other samples of the run only ever read a complete index."""
+    st = os.stat(gtf)
+    key = hashlib.sha1('\t'.join([
+        os.path.realpath(gtf), str(st.st_size), str(st.st_mtime),
+        str(INDEX_VERSION)]).encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(index_dir, 'gene_index.' + key + '.pkl')
+    if os.path.isfile(path):
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+    index = build_index(gtf)
+    os.makedirs(index_dir, exist_ok=True)
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return index
+
+
+def overlaps(bins, blocks):
+    """Return the set of values of the intervals in bins that overlap any of
+    the (start, end) blocks."""
+    found = set()
+    for start, end in blocks:
+        for b in range(start >> BIN_SHIFT, ((end - 1) >> BIN_SHIFT) + 1):
+            for i_start, i_end, value in bins.get(b, ()):
+                if i_start < end and start < i_end:
+                    found.add(value)
+    return found
+
+
+def classify(gene_hits, exon_hits, strands, rrna, strand=None):
+    """Classify a read from the genes whose spans (gene_hits) and exons
+    (exon_hits) it overlaps. If strand is given, only the genes on that
+    strand count. Returns 'exonic', 'intronic', 'intergenic', or
+    'ambiguous', and whether the read is in an rRNA gene."""
+    if strand is not None:
+        gene_hits = [g for g in gene_hits if strands[g] == strand]
+        exon_hits = [g for g in exon_hits if strands[g] == strand]
+    if len(exon_hits) == 1:
+        g = next(iter(exon_hits))
+        return ('exonic', rrna[g])
+    if len(exon_hits) > 1:
+        return ('ambiguous', any(rrna[g] for g in exon_hits))
+    if gene_hits:
+        return ('intronic', False)
+    return ('intergenic', False)
+
+
+def transcript_strand(read, stranded):
+    """Return the strand of the transcript that a read came from, for a
+    library with the given RNASeQC strandedness (FR: the first read is on
+    the transcript strand; RF: the second read is)."""
+    sense = read.is_reverse == read.is_read2
+    if stranded == 'RF':
+        sense = not sense
+    return '+' if sense else '-'
+
+
+def pair_orientation(read):
+    """Return the orientation of a pair, as Picard SamPairUtil does."""
+    if read.is_reverse == read.mate_is_reverse:
+        return 'TANDEM'
+    if read.is_reverse:
+        pos_five = read.next_reference_start + 1
+        neg_five = read.reference_end
+    else:
+        pos_five = read.reference_start + 1
+        neg_five = read.reference_start + 1 + read.template_length
+    return 'FR' if neg_five > pos_five else 'RF'
+
+
+def new_counts():
+    """Return empty counts for collect()."""
+    counts = {
+        'total': 0, 'mapped': 0, 'duplicated': 0, 'mapped_dup': 0,
+        'mq0': 0, 'bases': 0, 'qual_sum': 0, 'max_len': 0,
+        'unique': 0, 'lc_total': 0, 'lc_dup': 0,
+        'stranded': dict((c, 0) for c in READ_CLASSES),
+        'unstranded': dict((c, 0) for c in READ_CLASSES),
+        'insert_sizes': dict((o, collections.Counter()) for o in ORIENTATIONS)}
+    return counts
+
+
+def collect(task):
+    """Count the reads of one contig of a BAM file, or of the unplaced
+    reads if the contig is None. task is (bam path, contig, stranded).
+    Returns the counts of new_counts()."""
+    bam_path, contig, stranded = task
+    counts = new_counts()
+    strands = _INDEX['strands']
+    rrna = _INDEX['rrna']
+    bins = _INDEX['contigs'].get(contig, ({}, {}))
+    insert_sizes = counts['insert_sizes']
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        reads = bam.fetch(contig) if contig is not None else bam.fetch('*')
+        for read in reads:
+            if read.is_secondary or read.is_supplementary:
+                continue
+            counts['total'] += 1
+            length = read.query_length
+            counts['bases'] += length
+            if length > counts['max_len']:
+                counts['max_len'] = length
+            quals = read.query_qualities
+            if quals is not None:
+                counts['qual_sum'] += sum(quals)
+            if read.is_duplicate:
+                counts['duplicated'] += 1
+            if read.is_unmapped:
+                continue
+            # Reads whose pairs count towards the library complexity: the
+            # first read of a pair, or single reads
+            if not read.is_read2:
+                counts['lc_total'] += 1
+                if read.is_duplicate:
+                    counts['lc_dup'] += 1
+            counts['mapped'] += 1
+            if read.is_duplicate:
+                counts['mapped_dup'] += 1
+            if read.mapping_quality == 0:
+                counts['mq0'] += 1
+            if read.mapping_quality < UNIQUE_MAPQ or read.is_qcfail:
+                continue
+            counts['unique'] += 1
+            blocks = read.get_blocks()
+            gene_hits = overlaps(bins[0], blocks)
+            exon_hits = overlaps(bins[1], blocks) if gene_hits else set()
+            cls, is_rrna = classify(gene_hits, exon_hits, strands, rrna)
+            counts['unstranded'][cls] += 1
+            counts['unstranded']['rrna'] += is_rrna
+            if stranded:
+                cls, is_rrna = classify(
+                    gene_hits, exon_hits, strands, rrna,
+                    transcript_strand(read, stranded))
+            counts['stranded'][cls] += 1
+            counts['stranded']['rrna'] += is_rrna
+            # The reads that CollectInsertSizeMetrics uses
+            if (read.is_paired and not read.mate_is_unmapped
+                    and not read.is_read1 and not read.is_duplicate
+                    and read.template_length != 0):
+                insert_sizes[pair_orientation(read)][
+                    abs(read.template_length)] += 1
+    return counts
+
+
+def merge_counts(a, b):
+    """Add the counts b into a. Returns a."""
+    for k, v in b.items():
+        if k == 'max_len':
+            a[k] = max(a[k], v)
+        elif k == 'insert_sizes':
+            for o in ORIENTATIONS:
+                a[k][o].update(v[o])
+        elif isinstance(v, dict):
+            for c in v:
+                a[k][c] += v[c]
+        else:
+            a[k] += v
+    return a
+
+
+def count_bam(bam_path, stranded, threads):
+    """Count the reads of a coordinate-sorted, indexed BAM file, with one
+    task per contig with reads, and one for the unplaced reads."""
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        tasks = [
+            (bam_path, s.contig, stranded)
+            for s in bam.get_index_statistics()
+            if s.total > 0]
+        if bam.nocoordinate > 0:
+            tasks.append((bam_path, None, stranded))
+    counts = new_counts()
+    if threads > 1 and len(tasks) > 1:
+        # Fork, so that the workers share the gene index
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(min(threads, len(tasks))) as pool:
+            for c in pool.imap_unordered(collect, tasks):
+                merge_counts(counts, c)
+    else:
+        for task in tasks:
+            merge_counts(counts, collect(task))
+    return counts
+
+
+def estimate_library_size(pairs, unique):
+    """Estimate the number of distinct molecules in a library from the
+    number of read pairs and of unique (non-duplicate) read pairs, as Picard
+    DuplicationMetrics.estimateLibrarySize() does. Returns None if there are
+    no duplicates, or no reads."""
+    if unique >= pairs or pairs == 0 or unique == 0:
+        return None
+
+    def f(x):
+        return unique / x - 1 + math.exp(-pairs / x)
+
+    low = 1.0
+    high = 100.0
+    if f(low * unique) < 0:
+        return None
+    while f(high * unique) > 0:
+        high *= 10
+    for _ in range(40):
+        r = (low + high) / 2
+        u = f(r * unique)
+        if u == 0:
+            break
+        elif u > 0:
+            low = r
+        else:
+            high = r
+    return int(unique * (low + high) / 2)
+
+
+def histogram_median(hist):
+    """Return the median of a histogram, a Counter of value to count, as
+    Picard Histogram.getMedian() does: the mean of the two middle values if
+    the count is even."""
+    total = sum(hist.values())
+    if total % 2 == 0:
+        mid_low = total // 2
+        mid_high = mid_low + 1
+    else:
+        mid_low = mid_high = total // 2 + 1
+    seen = 0
+    low = high = None
+    for value in sorted(hist):
+        seen += hist[value]
+        if low is None and seen >= mid_low:
+            low = value
+        if seen >= mid_high:
+            high = value
+            break
+    return (low + high) / 2
+
+
+def insert_size_metrics(hist):
+    """Compute the Picard insert size metrics of one pair orientation.
+    Returns an ordered dictionary of the metrics."""
+    total = sum(hist.values())
+    median = histogram_median(hist)
+    deviations = collections.Counter()
+    for value, n in hist.items():
+        deviations[abs(value - median)] += n
+    mad = histogram_median(deviations)
+    # The widths of the bins, centered on the median, that hold each
+    # fraction of the reads
+    widths = {}
+    covered = 0
+    low = high = int(median)
+    lowest = min(hist)
+    highest = max(hist)
+    pending = list(IS_WIDTHS)
+    while pending and (low >= lowest or high <= highest):
+        covered += hist.get(low, 0)
+        if high != low:
+            covered += hist.get(high, 0)
+        while pending and covered / total >= pending[0]:
+            widths[pending.pop(0)] = 1 + high - low
+        low -= 1
+        high += 1
+    for pct in pending:
+        widths[pct] = 1 + high - low
+    # The mean and standard deviation are of the histogram trimmed to
+    # remove the outliers
+    limit = median + IS_DEVIATIONS * mad
+    kept = [(v, n) for v, n in sorted(hist.items()) if v <= limit]
+    n_kept = sum(n for _, n in kept)
+    mean = sum(v * n for v, n in kept) / n_kept
+    if n_kept > 1:
+        sd = math.sqrt(
+            sum(n * (v - mean) ** 2 for v, n in kept) / (n_kept - 1))
+    else:
+        sd = 0.0
+    metrics = collections.OrderedDict([
+        ('MEDIAN_INSERT_SIZE', median),
+        ('MEDIAN_ABSOLUTE_DEVIATION', mad),
+        ('MIN_INSERT_SIZE', lowest),
+        ('MAX_INSERT_SIZE', highest),
+        ('MEAN_INSERT_SIZE', mean),
+        ('STANDARD_DEVIATION', sd),
+        ('READ_PAIRS', total)])
+    for pct in IS_WIDTHS:
+        name = 'WIDTH_OF_' + str(int(round(pct * 100))) + '_PERCENT'
+        metrics[name] = widths[pct]
+    return metrics
+
+
+def fmt(x):
+    """Format a number the way the tools do: integers without a decimal
+    point, and NA for None."""
+    if x is None:
+        return 'NA'
+    if isinstance(x, float) and x.is_integer():
+        return str(int(x))
+    return str(x)
+
+
+def write_bamstats(path, counts):
+    """Write the SN lines of samtools stats that the summary job reads."""
+    total = counts['total']
+    with output_writer.OutputWriter(path) as handle:
+        handle.writelines([
+            '# Summary numbers of the primary alignments, written by '
+            'CHURPipelines.FileOps.bam_metrics in the format of samtools '
+            'stats',
+            'SN\traw total sequences:\t' + str(total),
+            'SN\treads mapped:\t' + str(counts['mapped']),
+            'SN\treads duplicated:\t' + str(counts['duplicated']) +
+            '\t# PCR or optical duplicate bit set',
+            'SN\treads MQ0:\t' + str(counts['mq0']) + '\t# mapped and MQ=0',
+            'SN\taverage length:\t' +
+            str(counts['bases'] // total if total else 0),
+            'SN\tmaximum length:\t' + str(counts['max_len']),
+            'SN\taverage quality:\t' + '%.1f' % (
+                counts['qual_sum'] / counts['bases'] if counts['bases']
+                else 0)])
+    return
+
+
+def write_rnaseqc(path, sample, counts, classes):
+    """Write RNASeQC-style metrics, with the read classes of one strand
+    setting."""
+    unique = counts['unique']
+    total = counts['total']
+    mapped = counts['mapped']
+
+    def rate(n, d):
+        return n / d if d else None
+
+    complexity = estimate_library_size(
+        counts['lc_total'], counts['lc_total'] - counts['lc_dup'])
+    stats = [
+        ('Mapped Reads', mapped),
+        ('Mapped Unique Reads', unique),
+        ('Total Reads', total),
+        ('Exonic Rate', rate(classes['exonic'], unique)),
+        ('Intronic Rate', rate(classes['intronic'], unique)),
+        ('Intergenic Rate', rate(classes['intergenic'], unique)),
+        ('Ambiguous Alignment Rate', rate(classes['ambiguous'], unique)),
+        ('rRNA Rate', rate(classes['rrna'], unique)),
+        ('Expression Profiling Efficiency', rate(classes['exonic'], total)),
+        ('Duplicate Rate of Mapped', rate(counts['mapped_dup'], mapped)),
+        ('Estimated Library Complexity', complexity)]
+    with output_writer.OutputWriter(path) as handle:
+        handle.writelines(
+            ['Sample\t' + sample] + [s + '\t' + fmt(v) for s, v in stats])
+    return
+
+
+def write_insert_sizes(is_stats, metrics_path, counts):
+    """Write IS_Stats.txt and the insert size metrics file. The metrics are
+    given for each orientation with at least IS_MIN_PCT of the pairs, and
+    IS_Stats.txt has those of the first of them, as the summary job takes
+    them from the Picard output. If there are none, IS_Stats.txt has seven
+    NA."""
+    hists = counts['insert_sizes']
+    total = sum(sum(h.values()) for h in hists.values())
+    rows = []
+    for o in ORIENTATIONS:
+        n = sum(hists[o].values())
+        if total and n / total >= IS_MIN_PCT:
+            rows.append((o, insert_size_metrics(hists[o])))
+    if not rows:
+        output_writer.write_text(is_stats, '\t'.join(['NA'] * 7) + '\n')
+        return
+    first = rows[0][1]
+    output_writer.write_text(is_stats, '\t'.join(fmt(first[k]) for k in (
+        ['MEDIAN_INSERT_SIZE', 'MEAN_INSERT_SIZE', 'STANDARD_DEVIATION'] +
+        ['WIDTH_OF_' + str(int(round(p * 100))) + '_PERCENT'
+         for p in IS_STATS_WIDTHS])) + '\n')
+    header = list(first.keys()) + ['PAIR_ORIENTATION']
+    lines = [
+        '## Insert size metrics, written by '
+        'CHURPipelines.FileOps.bam_metrics in the format of Picard '
+        'CollectInsertSizeMetrics',
+        '',
+        '## METRICS CLASS\tpicard.analysis.InsertSizeMetrics',
+        '\t'.join(header)]
+    for o, m in rows:
+        lines.append('\t'.join([fmt(v) for v in m.values()] + [o]))
+    lines.extend(['', '## HISTOGRAM\tjava.lang.Integer'])
+    lines.append('\t'.join(
+        ['insert_size'] +
+        ['All_Reads.' + o.lower() + '_count' for o, _ in rows]))
+    for size in sorted(set().union(*(hists[o] for o, _ in rows))):
+        lines.append('\t'.join(
+            [str(size)] + [str(hists[o].get(size, 0)) for o, _ in rows]))
+    with output_writer.OutputWriter(metrics_path) as handle:
+        handle.writelines(lines)
+    return
+
+
+def main():
+    """Parse the arguments, count the BAM, and write the metrics."""
+    global _INDEX
+    parser = argparse.ArgumentParser(
+        description=(
+            'Collect samtools stats, RNASeQC, and insert size metrics in one '
+            'pass over a coordinate-sorted BAM file.'))
+    parser.add_argument('--bam', required=True)
+    parser.add_argument('--gtf', required=True)
+    parser.add_argument('--sample', required=True)
+    parser.add_argument(
+        '--paired', choices=['true', 'false'], required=True)
+    parser.add_argument(
+        '--stranded', choices=['FR', 'RF', 'none'], default='none')
+    parser.add_argument('--index-dir', required=True)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--outdir', default='.')
+    parser.add_argument('--is-metrics')
+    parser.add_argument(
+        '--metrics', choices=['all', 'rnaseqc'], default='all')
+    args = parser.parse_args()
+    _INDEX = load_index(args.gtf, args.index_dir)
+    stranded = args.stranded if args.stranded != 'none' else None
+    counts = count_bam(args.bam, stranded, args.threads)
+    rnaseqc_dir = os.path.join(args.outdir, 'RNASeQC_Out')
+    os.makedirs(rnaseqc_dir, exist_ok=True)
+    write_rnaseqc(
+        os.path.join(rnaseqc_dir, args.sample + '.metrics.tsv'),
+        args.sample, counts, counts['stranded'])
+    write_rnaseqc(
+        os.path.join(rnaseqc_dir, args.sample + '_Unstranded.metrics.tsv'),
+        args.sample + '_Unstranded', counts, counts['unstranded'])
+    if args.metrics == 'rnaseqc':
+        return 0
+    write_bamstats(
+        os.path.join(args.outdir, args.sample + '_bamstats.txt'), counts)
+    if args.paired == 'true':
+        is_metrics = args.is_metrics or os.path.join(
+            args.outdir, args.sample + '_is_metrics.txt')
+        write_insert_sizes(
+            os.path.join(args.outdir, 'IS_Stats.txt'), is_metrics, counts)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
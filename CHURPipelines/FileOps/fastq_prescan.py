@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""Count the records of FASTQ files and check that they decompress cleanly,
+using a pool of processes. BGZF files are split into ranges of blocks that are
+decompressed in parallel. Other gzip files, including those with several
+members, are decompressed from start to end in one process each, so they are
+only parallel across files. The results are cached in a table that is keyed on
+the path, size, and modification time of each file, so that running CHURP
+again on the same FASTQ files does not read them again."""
+
+import concurrent.futures
+import os
+import struct
+import zlib
+
+from CHURPipelines.FileOps import input_checks
+
+# How much of a BGZF file to give to each process, in bytes
+BGZF_RANGE = 67108864
+# The largest possible BGZF block
+BGZF_MAX_BLOCK = 65536
+# How much to read at a time for other files
+READ_SIZE = 4194304
+# The header of the prescan cache table
+CACHE_COLUMNS = ['Path', 'Size', 'MTime', 'Records', 'Problem']
+
+
+def _bgzf_block_size(buf, p):
+    """Return the total size of the BGZF block that starts at offset p of a
+    buffer, or 0 if there is not a BGZF block header there."""
+    if buf[p:p+4] != b'\x1f\x8b\x08\x04':
+        return 0
+    if buf[p+10:p+14] != b'\x06\x00BC' or len(buf) < p + 18:
+        return 0
+    return struct.unpack('<H', buf[p+16:p+18])[0] + 1
+
+
+def is_bgzf(f):
+    """Return True if a file starts with a BGZF block."""
+    with open(f, 'rb') as handle:
+        return _bgzf_block_size(handle.read(18), 0) > 0
+
+
+def has_bgzf_eof(f, size):
+    """Return True if a file ends with the BGZF end-of-file block."""
+    with open(f, 'rb') as handle:
+        handle.seek(max(0, size - len(input_checks.BGZF_EOF)))
+        return handle.read() == input_checks.BGZF_EOF
+
+
+def count_bgzf_range(f, start, end, size):
+    """Decompress the BGZF blocks of a file that start in the byte range
+    [start, end), and count their newlines. The first block in the range is
+    found by searching for a block header that is followed by another block
+    header or the end of the file. Returns a tuple of (newlines, last byte,
+    problem)."""
+    with open(f, 'rb') as handle:
+        handle.seek(start)
+        buf = handle.read(end - start + 2 * BGZF_MAX_BLOCK)
+    span = end - start
+    p = 0
+    if start > 0:
+        while True:
+            p = buf.find(b'\x1f\x8b\x08\x04', p)
+            if p < 0 or p >= span:
+                return (0, b'', None)
+            n = _bgzf_block_size(buf, p)
+            if n and (start + p + n == size or _bgzf_block_size(buf, p + n)):
+                break
+            p += 1
+    lines = 0
+    last = b''
+    while p < span:
+        n = _bgzf_block_size(buf, p)
+        if not n:
+            return (0, b'', 'has a bad BGZF block at byte ' + str(start + p))
+        block = buf[p:p+n]
+        if len(block) < n:
+            return (0, b'', 'is truncated')
+        try:
+            data = zlib.decompress(block[18:-8], -15)
+        except zlib.error:
+            return (0, b'', 'has a corrupt block at byte ' + str(start + p))
+        crc, isize = struct.unpack('<II', block[-8:])
+        if zlib.crc32(data) != crc or len(data) != isize:
+            return (0, b'', 'fails the CRC check at byte ' + str(start + p))
+        lines += data.count(b'\n')
+        if data:
+            last = data[-1:]
+        p += n
+    return (lines, last, None)
+
+
+def count_stream(f):
+    """Count the newlines of a plain or gzipped file, reading it from start
+    to end. gzip files with more than one member are read to the end of the
+    last member. Returns a tuple of (newlines, last byte, problem)."""
+    lines = 0
+    last = b''
+    with open(f, 'rb') as handle:
+        if not f.endswith('.gz'):
+            for chunk in iter(lambda: handle.read(READ_SIZE), b''):
+                lines += chunk.count(b'\n')
+                last = chunk[-1:]
+            return (lines, last, None)
+        d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        fed = False
+        try:
+            for chunk in iter(lambda: handle.read(READ_SIZE), b''):
+                while chunk:
+                    fed = True
+                    data = d.decompress(chunk)
+                    lines += data.count(b'\n')
+                    if data:
+                        last = data[-1:]
+                    if d.eof:
+                        chunk = d.unused_data
+                        d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                        fed = False
+                    else:
+                        chunk = b''
+        except zlib.error:
+            return (0, b'', 'is not a valid gzip file')
+        if fed:
+            return (0, b'', 'is truncated')
+    return (lines, last, None)
+
+
+def read_cache(path):
+    """Read the prescan cache table into a dictionary keyed on path."""
+    cache = {}
+    if not os.path.isfile(path):
+        return cache
+    with open(path, 'rt') as handle:
+        for line in handle:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == CACHE_COLUMNS[0] or len(fields) != 5:
+                continue
+            cache[fields[0]] = fields
+    return cache
+
+
+def write_cache(path, results, stats):
+    """Write the prescan results into the cache table."""
+    with open(path, 'wt') as handle:
+        handle.write('\t'.join(CACHE_COLUMNS) + '\n')
+        for f in sorted(results):
+            handle.write('\t'.join([
+                f,
+                str(stats[f].st_size),
+                str(stats[f].st_mtime_ns),
+                str(results[f][0]),
+                results[f][1] or '']) + '\n')
+    return
+
+
+def available_cpus():
+    """Return the number of cores that this process may run on. This is the
+    affinity mask where there is one, e.g., in a Slurm job, rather than every
+    core of the node."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def prescan(fastqs, cache_path, l, procs=None):
+    """Count the records of a list of FASTQ files and check them, with one
+    process for each core that is available if procs is not given. Returns a
+    dictionary keyed on path of (records, problem), where problem is None for
+    files that are intact."""
+    if procs is None:
+        procs = available_cpus()
+    cache = read_cache(cache_path)
+    stats = {}
+    results = {}
+    tasks = {}
+    eof_problems = {}
+    for f in fastqs:
+        stats[f] = os.stat(f)
+        row = cache.get(f)
+        if row and row[1:3] == [
+                str(stats[f].st_size), str(stats[f].st_mtime_ns)]:
+            l.debug('Using cached prescan of %s', f)
+            results[f] = (int(row[3]), row[4] or None)
+            continue
+        if f.endswith('.gz') and is_bgzf(f):
+            size = stats[f].st_size
+            if not has_bgzf_eof(f, size):
+                eof_problems[f] = 'is missing the BGZF end-of-file block'
+            tasks[f] = [
+                (count_bgzf_range, (f, s, min(s + BGZF_RANGE, size), size))
+                for s in range(0, size, BGZF_RANGE)]
+        else:
+            tasks[f] = [(count_stream, (f,))]
+    l.info(
+        'Prescanning %i FASTQ files (%i cached).',
+        len(tasks), len(results))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=procs) as pool:
+        futures = {
+            f: [pool.submit(func, *fargs) for func, fargs in tasks[f]]
+            for f in tasks}
+        for f in futures:
+            lines = 0
+            last = b''
+            problem = eof_problems.get(f)
+            for fut in futures[f]:
+                n, tail, err = fut.result()
+                lines += n
+                last = tail or last
+                problem = problem or err
+            # A last line without a newline still counts
+            if last and last != b'\n':
+                lines += 1
+            if not problem and lines % 4 != 0:
+                problem = 'has ' + str(lines) + ' lines, not a multiple of 4'
+            results[f] = (lines // 4, problem)
+            l.debug('%s: %i records, problem: %s', f, lines // 4, problem)
+    write_cache(cache_path, results, stats)
+    return results
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""Checks on the input files of a pipeline that are run when it is set up.
+Most of the time in these checks is spent waiting on network storage, so they
+are run in a pool of threads and all of the problems are reported at once,
+instead of stopping at the first one. Each check returns a list of problems,
+which is empty if the check passed."""
+
+import glob
+import os
+import queue
+import threading
+import time
+import zlib
+
+# The number of checks to run at once
+CHECK_THREADS = 16
+# How long to wait for all of the checks, in seconds. Checks that have not
+# finished by then are reported as not checked, rather than holding up the
+# submission.
+CHECK_BUDGET = 120
+# The magic number at the start of every gzip member
+GZIP_MAGIC = b'\x1f\x8b'
+# The empty block that ends every complete BGZF file
+BGZF_EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+# How much of the start of a gzipped FASTQ to decompress as a check
+HEAD_BYTES = 65536
+
+
+def file_readable(f, what):
+    """Check that a file exists and can be opened for reading."""
+    try:
+        handle = open(f, 'rb')
+        handle.close()
+    except OSError:
+        return ['The ' + what + ' ' + f + ' does not exist or cannot be read.']
+    return []
+
+
+def hisat_idx_complete(i):
+    """Check that all of the [1-8].ht2 or [1-8].ht2l files of a HISAT2 index
+    are present."""
+    for suffix in ['.[1-8].ht2', '.[1-8].ht2l']:
+        if len(glob.glob(i + suffix)) == 8:
+            return []
+    return [
+        'The HISAT2 index ' + i + ' is not complete. All of the .1.ht2 to '
+        '.8.ht2 (or .ht2l) files must be present.']
+
+
+def _is_bgzf(head):
+    """Return True if the header of a gzip member has the BGZF extra
+    subfield."""
+    return len(head) >= 14 and head[3] & 4 and head[12:14] == b'BC'
+
+
+def fastq_intact(f):
+    """Check that a FASTQ file can be read and does not look truncated. Empty
+    files are reported. For gzipped files, the start of the file must
+    decompress to a FASTQ record, and BGZF files must end with the BGZF EOF
+    block. Plain gzip has no end marker, so truncation at the end of a plain
+    gzip file is only found by reading the whole file."""
+    try:
+        size = os.stat(f).st_size
+    except OSError:
+        return ['The FASTQ file ' + f + ' does not exist or cannot be read.']
+    if size == 0:
+        return ['The FASTQ file ' + f + ' is empty.']
+    try:
+        with open(f, 'rb') as handle:
+            head = handle.read(HEAD_BYTES)
+            handle.seek(max(0, size - len(BGZF_EOF)))
+            tail = handle.read()
+    except OSError:
+        return ['The FASTQ file ' + f + ' cannot be read.']
+    if not f.endswith('.gz'):
+        if not head.startswith(b'@'):
+            return ['The FASTQ file ' + f + ' does not start with a record.']
+        return []
+    if not head.startswith(GZIP_MAGIC):
+        return ['The FASTQ file ' + f + ' is named .gz but is not gzipped.']
+    try:
+        text = zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(head)
+    except zlib.error:
+        return ['The FASTQ file ' + f + ' is not a valid gzip file.']
+    if text and not text.startswith(b'@'):
+        return ['The FASTQ file ' + f + ' does not start with a record.']
+    if _is_bgzf(head) and tail != BGZF_EOF:
+        return [
+            'The FASTQ file ' + f + ' is truncated. It is missing the BGZF '
+            'end-of-file block.']
+    return []
+
+
+def run_checks(checks, l, threads=CHECK_THREADS, budget=CHECK_BUDGET):
+    """Run a list of checks in a pool of threads. Each check is a tuple of
+    (description, function, arguments), and the function returns a list of
+    problems. Returns a tuple of the problems found and the descriptions of
+    the checks that did not finish within the budget, in seconds. The threads
+    are daemon threads, so a check that hangs on the file system does not
+    keep CHURP from exiting."""
+    todo = queue.Queue()
+    for n, c in enumerate(checks):
+        todo.put((n, c))
+    results = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                n, (desc, func, fargs) = todo.get_nowait()
+            except queue.Empty:
+                return
+            l.debug('Checking %s', desc)
+            try:
+                res = func(*fargs)
+            except Exception as e:
+                res = ['Could not check ' + desc + ': ' + str(e)]
+            with lock:
+                results[n] = res
+    workers = [
+        threading.Thread(target=worker, daemon=True)
+        for i in range(max(1, min(threads, len(checks))))]
+    for w in workers:
+        w.start()
+    deadline = time.monotonic() + budget
+    for w in workers:
+        w.join(max(0, deadline - time.monotonic()))
+    with lock:
+        problems = []
+        unfinished = []
+        for n, c in enumerate(checks):
+            if n in results:
+                problems.extend(results[n])
+            else:
+                unfinished.append(c[0])
+    return (problems, unfinished)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Write the files that CHURP generates (the samplesheet and its index, the
+array key, and the pipeline script) in one piece. The contents are kept in
+memory until they are committed, and are then written to a temporary file in
+the same directory and renamed over the target. The rename is atomic, so the
+array jobs, or a second CHURP run into the same output directory, only ever
+see the old file or the new file, and never a partly written one."""
+
+import os
+
+
+class OutputWriter(object):
+    """Buffer the contents of an output file and write them atomically."""
+
+    def __init__(self, path):
+        """Start an empty file at the given path. Nothing is written until
+        commit() is called."""
+        self.path = path
+        self.chunks = []
+        self.size = 0
+
+    def write(self, s):
+        """Add a string to the file."""
+        self.chunks.append(s)
+        self.size += len(s)
+        return
+
+    def writelines(self, lines):
+        """Add a list of lines to the file, with a newline after each."""
+        for line in lines:
+            self.write(line + '\n')
+        return
+
+    def commit(self):
+        """Write the contents into a temporary file next to the target and
+        move it into place. The temporary file is removed if the write
+        fails."""
+        tmp = os.path.join(
+            os.path.dirname(self.path),
+            '.' + os.path.basename(self.path) + '.' + str(os.getpid()) +
+            '.tmp')
+        try:
+            with open(tmp, 'wt', encoding='utf-8', newline='') as f:
+                f.write(''.join(self.chunks))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Commit the file if the block finished without an error."""
+        if exc_type is None:
+            self.commit()
+        return False
+
+
+def write_text(path, text):
+    """Atomically write a string into a file."""
+    w = OutputWriter(path)
+    w.write(text)
+    return w.commit()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Functions for building the keys of the shared per-sample result cache. A
+cache key is a digest of everything that determines the per-sample outputs of
+the bulk RNAseq single sample script: the FASTQ files, the trimming and
+alignment options, the identity of the HISAT2 index and GTF, and the CHURP
+version. The summary stage is not covered by the key, so changing the groups
+sheet or the gene filtering options will still re-use cached alignments."""
+
+import glob
+import hashlib
+import os
+import re
+
+import CHURPipelines
+
+# How much of the start and end of each FASTQ to read for the fingerprint, in
+# bytes. Hashing whole FASTQ files would take longer than the alignment in some
+# cases, so we hash the head and the tail along with the size of the file. The
+# path and modification time are left out, so that a copy of a FASTQ file in
+# another directory, or one whose time stamp was changed, still finds its
+# cached results. The cost is that a file that was edited in the middle,
+# without changing its size, its first FINGERPRINT_CHUNK bytes, or its last
+# FINGERPRINT_CHUNK bytes, would also match.
+FINGERPRINT_CHUNK = 1048576
+
+
+def fastq_fingerprint(fq, l):
+    """Return a hex digest that identifies a FASTQ file. This is a SHA256
+    of the size of the file and its first and last FINGERPRINT_CHUNK bytes,
+    so it does not depend on where the file is. Returns an empty string for an
+    empty path, which is how a missing R2 file is represented in the
+    samplesheet."""
+    if not fq:
+        return ''
+    l.debug('Fingerprinting %s', fq)
+    st = os.stat(fq)
+    size = st.st_size
+    h = hashlib.sha256()
+    h.update('{s}:'.format(s=size).encode('utf-8'))
+    with open(fq, 'rb') as f:
+        h.update(f.read(FINGERPRINT_CHUNK))
+        if size > FINGERPRINT_CHUNK:
+            f.seek(max(FINGERPRINT_CHUNK, size - FINGERPRINT_CHUNK))
+            h.update(f.read(FINGERPRINT_CHUNK))
+    return h.hexdigest()
+
+
+def reference_identity(paths, l):
+    """Return a string that identifies a set of reference files (the HISAT2
+    index files or the GTF). We use the path, size, and modification time of
+    each file rather than a checksum because the references are large and are
+    only replaced, never edited in place, on the bioref storage."""
+    ident = []
+    for p in sorted(paths):
+        st = os.stat(p)
+        l.debug('Reference file %s: %i bytes, mtime %i', p, st.st_size,
+                int(st.st_mtime))
+        ident.append(
+            '{p}:{s}:{m}'.format(p=p, s=st.st_size, m=int(st.st_mtime)))
+    return ';'.join(ident)
+
+
+def hisat_index_files(idx):
+    """Return the list of files that make up a HISAT2 index basename. The
+    escaping added by sanitize_path() has to be undone for glob() to match."""
+    raw_idx = idx.replace('\\', '')
+    idx_files = glob.glob(raw_idx + '.[1-8].ht2')
+    if len(idx_files) != 8:
+        idx_files = glob.glob(raw_idx + '.[1-8].ht2l')
+    return idx_files
+
+
+def sample_key(row, extra, l):
+    """Return the cache key for one row of the samplesheet. 'row' is the
+    final_sheet dictionary for the sample and 'extra' is a dictionary of any
+    options that affect the per-sample outputs but are not in the sheet, such
+    as the subsampling levels."""
+    # The OutputDir and WorkingDir columns are deliberately left out. The
+    # whole point of the cache is to re-use results across different output
+    # and working directories. The single sample script gives HISAT2 its
+    # thread count, which does not change the alignments, so a -p in the
+    # user's HISAT2 options or in the sheets of earlier runs is dropped.
+    hisat_opts = re.sub(r'-p [0-9]+ ?', '', row['Hisat2Options']).strip()
+    key_fields = [
+        'CHURP=' + CHURPipelines.__version__,
+        'R1=' + fastq_fingerprint(row['FastqR1files'], l),
+        'R2=' + fastq_fingerprint(row['FastqR2file'], l),
+        'TRIM=' + row['TRIM'],
+        'RMDUP=' + row['RMDUP'],
+        'trimmomaticOpts=' + row['trimmomaticOpts'],
+        'Hisat2Options=' + hisat_opts,
+        'Strand=' + row['Strand'],
+        'Hisat2index=' + reference_identity(
+            hisat_index_files(row['Hisat2index']), l),
+        'AnnotationGTF=' + reference_identity([row['AnnotationGTF']], l)
+        ]
+    for opt in sorted(extra):
+        key_fields.append(opt + '=' + str(extra[opt]))
+    l.debug('Cache key fields:\n%s', '\n'.join(key_fields))
+    return hashlib.sha256('\n'.join(key_fields).encode('utf-8')).hexdigest()
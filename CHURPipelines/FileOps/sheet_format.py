@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""Write and read the structured samplesheet. The sheet is tab-delimited and
+starts with a line that gives its schema version:
+
+    #CHURP_SAMPLESHEET<TAB>2
+
+Comment lines start with '#'. The fields that have the same value for every
+sample are written once, as '@Column<TAB>Value' lines, and are followed by a
+header of the remaining columns and one row per sample. The first column of
+each row is the array index of its job, which is also its line in the array
+key. The byte offset and length of every row are written into a fixed-width
+index next to the sheet (<sheet>.idx), so that a job can read its own row
+with one seek instead of parsing the whole sheet. Version 1 sheets, which have
+one '|'-delimited row per sample and the major CHURP version on the last line,
+can still be read for the 'status' and 'resubmit' subcommands.
+
+Run as
+
+    python3 -m CHURPipelines.FileOps.sheet_format --benchmark <samples>
+
+to time writing and reading a sheet of simulated samples, and looking up rows
+from bash the way the array jobs do."""
+
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from CHURPipelines.FileOps import output_writer
+
+# The version of the sheet layout. The PBS scripts check this against the
+# version that they understand.
+SCHEMA_VERSION = '2'
+SCHEMA_TAG = '#CHURP_SAMPLESHEET'
+# Each record of the index is a zero-padded offset and length, and a newline,
+# so record n starts at byte (n - 1) * INDEX_WIDTH
+INDEX_FORMAT = '{:012d} {:08d}\n'
+INDEX_WIDTH = 22
+# The columns of a version 1 sheet, in order
+V1_COLUMNS = [
+    'SampleName',
+    'Group',
+    'FastqR1files',
+    'FastqR2file',
+    'OutputDir',
+    'WorkingDir',
+    'TRIM',
+    'RMDUP',
+    'trimmomaticOpts',
+    'Hisat2index',
+    'Hisat2Options',
+    'Strand',
+    'AnnotationGTF',
+    'CacheKey']
+
+
+def clean(v):
+    """Replace the characters that would break the layout of the sheet."""
+    return str(v).replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+
+
+def index_path(path):
+    """Return the path of the row index of a sheet."""
+    return path + '.idx'
+
+
+def write_sheet(path, columns, rows, run_columns, comments):
+    """Write a structured samplesheet and its row index. columns is the list
+    of column names, rows is a list of dictionaries keyed on column name in
+    array index order, and run_columns are the columns that may be written
+    once for the whole run if all of the rows share a value. comments are
+    written after the schema line. Returns the list of per-sample columns."""
+    shared = [
+        c for c in columns
+        if c in run_columns and rows and len(set(r[c] for r in rows)) == 1]
+    per_sample = ['Index'] + [c for c in columns if c not in shared]
+    lines = [SCHEMA_TAG + '\t' + SCHEMA_VERSION]
+    lines.extend('# ' + clean(c) for c in comments)
+    lines.extend('@' + c + '\t' + clean(rows[0][c]) for c in shared)
+    lines.append('\t'.join(per_sample))
+    sheet = output_writer.OutputWriter(path)
+    idx = output_writer.OutputWriter(index_path(path))
+    sheet.writelines(lines)
+    # The offsets are in bytes, and the values may not be ASCII
+    offset = len(''.join(sheet.chunks).encode('utf-8'))
+    for n, r in enumerate(rows):
+        row = '\t'.join([str(n + 1)] + [clean(r[c]) for c in per_sample[1:]])
+        sheet.write(row + '\n')
+        nbytes = len(row.encode('utf-8'))
+        idx.write(INDEX_FORMAT.format(offset, nbytes))
+        offset += nbytes + 1
+    # Write the index first, so that a sheet is never newer than its index.
+    # The jobs check the row that the index points to, and scan the sheet if
+    # it is the wrong one.
+    idx.commit()
+    sheet.commit()
+    return per_sample
+
+
+def read_sheet(path):
+    """Read a samplesheet of either version. Returns a list of dictionaries
+    keyed on column name, one per sample, in array index order. The shared
+    fields of a version 2 sheet are filled in for every sample."""
+    with open(path, 'rt') as f:
+        lines = f.read().split('\n')
+    if not lines[0].startswith(SCHEMA_TAG + '\t'):
+        rows = []
+        for line in lines:
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split('|')
+            fields += [''] * (len(V1_COLUMNS) - len(fields))
+            rows.append(dict(zip(V1_COLUMNS, fields)))
+        return sorted(rows, key=lambda r: r['SampleName'])
+    shared = {}
+    header = None
+    rows = []
+    for line in lines[1:]:
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('@') and header is None:
+            key, _, val = line[1:].partition('\t')
+            shared[key] = val
+        elif header is None:
+            header = line.split('\t')
+        else:
+            row = dict(shared)
+            row.update(zip(header, line.split('\t')))
+            rows.append(row)
+    return rows
+
+
+def benchmark(n_samples, workdir):
+    """Write and read a sheet of n_samples simulated samples in workdir, and
+    look up the last rows from bash with PBS/samplesheet_functions.sh.
+    Returns a list of (step, value) tuples, where the value is in seconds or
+    bytes."""
+    shared = {
+        'Group': 'NULL',
+        'OutputDir': '/scratch.global/churp/project/Output',
+        'WorkingDir': '/scratch.global/churp/project/Work',
+        'TRIM': 'yes',
+        'RMDUP': 'no',
+        'trimmomaticOpts': (
+            'ILLUMINACLIP:/home/msistaff/public/CHURP_Deps/v1/db/'
+            'all_illumina_adapters.fa:4:15:7:2:true LEADING:3 TRAILING:3 '
+            'SLIDINGWINDOW:4:15 MINLEN:18'),
+        'Hisat2index': (
+            '/home/msistaff/public/CHURP_Deps/v1/Genomes/Homo_sapiens/'
+            'HISAT2/genome'),
+        'Hisat2Options': '--no-mixed --new-summary --no-discordant',
+        'Strand': '2',
+        'AnnotationGTF': (
+            '/home/msistaff/public/CHURP_Deps/v1/Genomes/Homo_sapiens/'
+            'Homo_sapiens.GRCh38.110.gtf'),
+        'Shards': '1'}
+    fq_dir = '/scratch.global/churp/project/fastq/'
+    rows = []
+    for i in range(n_samples):
+        name = 'Sample{:06d}'.format(i + 1)
+        row = dict(shared)
+        row.update({
+            'SampleName': name,
+            'FastqR1files': fq_dir + name + '_S' + str(i + 1) +
+            '_R1_001.fastq.gz',
+            'FastqR2file': fq_dir + name + '_S' + str(i + 1) +
+            '_R2_001.fastq.gz',
+            'CacheKey': '{:064x}'.format(i * 2654435761 % 2 ** 256)})
+        rows.append(row)
+    columns = V1_COLUMNS + ['Shards']
+    run_columns = [c for c in shared if c not in ('Group', 'Shards')]
+    path = os.path.join(workdir, 'benchmark.samplesheet.txt')
+    times = []
+    t = time.time()
+    write_sheet(path, columns, rows, run_columns, ['Benchmark'])
+    times.append(('Write sheet and index (s)', time.time() - t))
+    times.append(('Sheet size (bytes)', os.path.getsize(path)))
+    # The version 1 layout, with every field on every row
+    v1_path = os.path.join(workdir, 'benchmark.v1.samplesheet.txt')
+    output_writer.write_text(v1_path, ''.join(
+        '|'.join(clean(r[c]) for c in V1_COLUMNS) + '\n' for r in rows))
+    times.append(('Version 1 sheet size (bytes)', os.path.getsize(v1_path)))
+    t = time.time()
+    read_sheet(path)
+    times.append(('Read sheet (s)', time.time() - t))
+    funcs = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+        'PBS', 'samplesheet_functions.sh')
+    last = list(range(max(1, n_samples - 10), n_samples + 1))
+    t = time.time()
+    subprocess.run(
+        ['bash', '-c',
+         'source "${1}"; shift; sheet="${1}"; shift; '
+         'for i in "${@}"; do read_samplesheet "${sheet}" "${i}" || exit 1; '
+         'done',
+         'benchmark', funcs, path] + [str(i) for i in last],
+        check=True)
+    times.append((
+        'Look up the last ' + str(len(last)) + ' rows from bash (s)',
+        time.time() - t))
+    return times
+
+
+def main():
+    """Main function."""
+    ap = argparse.ArgumentParser(
+        description='Time writing and reading a structured samplesheet.')
+    ap.add_argument(
+        '--benchmark',
+        metavar='<samples>',
+        help='Number of simulated samples in the sheet.',
+        type=int,
+        required=True)
+    ap.add_argument(
+        '--dir',
+        help=('Directory to write the sheets into. Default: a temporary '
+              'directory, which is removed afterwards.'),
+        default=None)
+    args = ap.parse_args()
+    if args.dir:
+        results = benchmark(args.benchmark, args.dir)
+    else:
+        with tempfile.TemporaryDirectory() as d:
+            results = benchmark(args.benchmark, d)
+    for step, value in results:
+        if isinstance(value, float):
+            value = '{:.3f}'.format(value)
+        print(step + '\t' + str(value))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,6 @@
 
 import pprint
 import os
-import glob
 import subprocess
 import re
 import pandas as pd
@@ -16,6 +15,51 @@ from CHURPipelines.SampleSheet import BulkRNASeqSampleSheet
 from CHURPipelines.ArgHandling import set_verbosity
 from CHURPipelines.FileOps import default_files
 from CHURPipelines.FileOps import dir_funcs
+from CHURPipelines.FileOps import input_checks
+from CHURPipelines.FileOps import fastq_prescan
+from CHURPipelines.FileOps import output_writer
+from CHURPipelines.RunTools import run_dir
+from CHURPipelines.Schedulers import Local
+from CHURPipelines.Schedulers import Slurm
+from CHURPipelines.Schedulers import pipeline_script
+from CHURPipelines.Schedulers import resource_budget
+
+# The template of the pipeline script. See Schedulers/pipeline_script.py for
+# the placeholders.
+PIPELINE_TEMPLATE = """#!/bin/bash
+# Generated by CHURP version @version
+# Generated at @now
+set -e
+set -u
+set -o pipefail
+@preamble
+@variables
+@checks
+if [ -f "${OUTDIR}/.in_progress" ]
+then
+    echo "ERROR: ${OUTDIR}/.in_progress" exists. > /dev/stderr
+    echo "Job already submitted; aborting." > /dev/stderr
+    echo "Remove this file to allow job resbumission." > /dev/stderr
+    exit 1
+fi
+touch "${OUTDIR}/.in_progress"
+@jobs
+echo "You are running CHURP version ${CHURP_VERSION}"
+echo "Output and logs will be written to ${OUTDIR}"
+echo "Sbatch array to samplename key: ${KEYFILE}"
+if [ "${SUMMARY_ONLY}" = "true" ]
+    then echo "--summary-only" specified. No single samples job array ID
+    else echo "Single samples job array ID: ${single_id:-none}"
+fi
+if [ -n "${shard_id:-}" ]
+then
+    echo "Shard job array ID: ${shard_id}"
+    echo "Gather job array ID: ${gather_id}"
+fi
+echo "Summary job ID: ${summary_id}"
+echo -e "${single_id:-}\\t${shard_id:-}\\t${gather_id:-}\\t${summary_id}" >> "${OUTDIR}/bulk_rnaseq_job_ids.txt"
+@epilogue
+"""
 
 
 class BulkRNAseqPipeline(Pipeline.Pipeline):
@@ -51,11 +95,43 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
         self.min_gene_len = str(valid_args['mingene'])
         # And the minimum depth
         self.min_cts = str(valid_args['mincts'])
+        # And the number of samples above which the report is summarized
+        self.detail_limit = str(valid_args['detail_limit'])
+        # And how to test for differential expression
+        self.de_engine = valid_args['de_engine']
+        # And how to normalize the counts
+        self.norm_engine = valid_args['norm_engine']
+        # And whether the summary job stops after the count tables
+        if valid_args['counts_only']:
+            self.counts_only = 'true'
+        else:
+            self.counts_only = 'false'
         # Set the subsampling level
         self.rrna_screen = str(valid_args['rrna_screen'])
         self.subsample = str(valid_args['subsample'])
+        # And how to collect the alignment metrics
+        self.bam_metrics = valid_args['bam_metrics']
+        # And how much node-local space the single sample jobs may stage
+        # their files in. 0 runs them in the working directory.
+        if valid_args['stage_local']:
+            self.stage_local_mb = str(valid_args['tmp_space'])
+        else:
+            self.stage_local_mb = '0'
+        # Set whether to prescan the FASTQ files
+        self.prescan = valid_args['prescan']
         # Set the destination queue
         self.msi_queue = str(valid_args['msi_queue'])
+        # Set the scheduler that runs the jobs
+        if valid_args['scheduler'] == 'local':
+            self.scheduler = Local.LocalScheduler(valid_args)
+        else:
+            self.scheduler = Slurm.SlurmScheduler(valid_args)
+        # Set the result cache directory. An empty string disables the cache
+        # in the single sample script.
+        if valid_args['cache_dir']:
+            self.cache_dir = valid_args['cache_dir']
+        else:
+            self.cache_dir = ''
 
         # And make a sample sheet from the args
         self.sheet = BulkRNASeqSampleSheet.BulkRNASeqSampleSheet(valid_args)
@@ -83,6 +159,9 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
             os.path.realpath(__file__).rsplit(os.path.sep, 3)[0],
             'R_Scripts',
             'bulk_rnaseq_report.Rmd')
+        # The summary job runs the Python summary modules from this copy of
+        # CHURP
+        self.churp_dir = os.path.realpath(__file__).rsplit(os.path.sep, 3)[0]
         return
 
     def _validate_args(self, a):
@@ -92,7 +171,9 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
         RNAseq analysis pipeline:
             - FASTQ dir and UMGC sheet are mutually exclusive
             - Organism and HISAT2 index + GTF are mutually exclusive
-            - Check that the HISAT2 index is complete
+            - Counts only requires the numpy normalization engine
+            - Check that the HISAT2 index is complete, and that the GTF,
+              adapters, groups sheet, and FASTQ files can be read
         Further, sanitize the paths of the output dir, working dir, and hisat2
         index.
         """
@@ -105,6 +186,10 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
             DieGracefully.die_gracefully(DieGracefully.BRNASEQ_INC_ARGS)
         elif (a['hisat2_idx'] or a['gtf']) and a['organism']:
             DieGracefully.die_gracefully(DieGracefully.BRNASEQ_CONFLICT)
+        # --counts-only skips R, so the counts have to be normalized in
+        # Python
+        if a['counts_only'] and a['norm_engine'] != 'numpy':
+            DieGracefully.die_gracefully(DieGracefully.BRNASEQ_COUNTS_ONLY)
         # Set the hisat index and gtf if the 'organism' option was supplied
         if a['organism']:
             try:
@@ -127,6 +212,9 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
         if a['expr_groups']:
             a['expr_groups'] = os.path.realpath(os.path.expanduser(str(
                 a['expr_groups'])))
+        if a['cache_dir']:
+            a['cache_dir'] = os.path.realpath(os.path.expanduser(str(
+                a['cache_dir'])))
         try:
             assert a['headcrop'] >= 0
             assert isinstance(a['headcrop'], int)
@@ -138,6 +226,11 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
         except AssertionError:
             DieGracefully.die_gracefully(
                 DieGracefully.BAD_NUMBER, '--min-cts')
+        try:
+            assert a['detail_limit'] >= 1
+        except AssertionError:
+            DieGracefully.die_gracefully(
+                DieGracefully.BAD_NUMBER, '--report-detail-limit')
         try:
             assert a['rrna_screen'] >= 0
             assert isinstance(a['rrna_screen'], int)
@@ -152,7 +245,12 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
             DieGracefully.die_gracefully(
                 DieGracefully.BAD_NUMBER, '--subsample')
         try:
-            assert a['mem'] >= 24000
+            assert a['shard_size'] >= 0
+        except AssertionError:
+            DieGracefully.die_gracefully(
+                DieGracefully.BAD_NUMBER, '--shard-size')
+        try:
+            assert a['mem'] >= resource_budget.MIN_MEM_MB
             assert isinstance(a['mem'], int)
         except AssertionError:
             DieGracefully.die_gracefully(
@@ -177,28 +275,22 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
         self.pipe_logger.debug('HISAT2 Idx: %s', a['hisat2_idx'])
         self.pipe_logger.debug('Expr Groups: %s', a['expr_groups'])
         self.pipe_logger.debug('Strandness: %s', a['strand'])
-        # Check that the adapters and GTF file exist
-        try:
-            handle = open(a['gtf'], 'rt')
-            handle.close()
-        except OSError:
-            DieGracefully.die_gracefully(DieGracefully.BAD_GTF)
+        self.pipe_logger.debug('Cache Dir: %s', a['cache_dir'])
         if not a['adapters']:
             a['adapters'] = '/home/msistaff/public/CHURP_Deps/v1/db/all_illumina_adapters.fa'
         else:
-            try:
-                a['adapters'] = os.path.realpath(
-                    os.path.expanduser(str(a['adapters'])))
-                handle = open(a['adapters'], 'rt')
-                handle.close()
-            except OSError:
-                DieGracefully.die_gracefully(DieGracefully.BAD_ADAPT)
-        # Validate the FASTQ folder
-        self._validate_fastq_folder(a['fq_folder'])
-        # Validate the hisat2 index
-        self._validate_hisat_idx(a['hisat2_idx'])
-        # Validate the experimental groups xlsx 
+            a['adapters'] = os.path.realpath(
+                os.path.expanduser(str(a['adapters'])))
+        # Validate the FASTQ folder. The other checks need the list of FASTQ
+        # files, so this one runs first.
+        fastqs = self._validate_fastq_folder(a['fq_folder'])
+        # Validate the result cache directory
+        if a['cache_dir']:
+            self._validate_cache_dir(a['cache_dir'])
+        # Make the experimental groups xlsx if one was not given
         a = self._validate_groupsheet(a)
+        # Then check the input files all at once
+        self._check_inputs(a, fastqs)
         # Sanitize the hisat2 index path
         a['hisat2_idx'] = dir_funcs.sanitize_path(
             a['hisat2_idx'], self.pipe_logger)
@@ -206,48 +298,61 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
 
     def _validate_fastq_folder(self, d):
         """Raise an error if the FASTQ directory does not exist or does not
-        have any FASTQ files."""
+        have any FASTQ files. Returns the paths to the FASTQ files."""
         try:
             contents = os.listdir(d)
         except OSError:
             DieGracefully.die_gracefully(DieGracefully.BAD_FASTQ)
         # Check if there is at least one file ending in a standard fastq suffix
         fq_pat = re.compile(r'^.+((.fq(.gz)?$)|(.fastq(.gz)?$))')
-        has_fastq = False
-        for f in contents:
-            if re.match(fq_pat, f):
-                has_fastq = True
-                break
-        if has_fastq:
-            return
-        else:
+        fastqs = [
+            os.path.join(d, f)
+            for f in sorted(contents)
+            if re.match(fq_pat, f)]
+        if not fastqs:
             DieGracefully.die_gracefully(DieGracefully.EMPTY_FASTQ)
+        return fastqs
+
+    def _check_inputs(self, a, fastqs):
+        """Check the GTF, adapters, HISAT2 index, experimental groups sheet,
+        and every FASTQ file in a pool of threads. If any of them have
+        problems, exit with a list of all of the problems."""
+        checks = [
+            ('GTF', input_checks.file_readable, (a['gtf'], 'GTF')),
+            ('adapters', input_checks.file_readable,
+             (a['adapters'], 'adapters file')),
+            ('HISAT2 index', input_checks.hisat_idx_complete,
+             (a['hisat2_idx'],)),
+            ('experimental groups', self._groupsheet_problems,
+             (a['expr_groups'],))]
+        for fq in fastqs:
+            checks.append((fq, input_checks.fastq_intact, (fq,)))
+        self.pipe_logger.info('Checking %i inputs.', len(checks))
+        problems, unfinished = input_checks.run_checks(
+            checks, self.pipe_logger)
+        for desc in unfinished:
+            self.pipe_logger.warning(
+                'Check of %s did not finish in %i seconds. Skipping it.',
+                desc, input_checks.CHECK_BUDGET)
+        if problems:
+            for p in problems:
+                self.pipe_logger.error(p)
+            DieGracefully.die_gracefully(DieGracefully.BAD_INPUTS, problems)
         return
 
-    def _validate_hisat_idx(self, i):
-        """Raise an error if the provided HISAT2 index is not complete -
-        all of the [1-8].ht2l? files should be present."""
-        # Build glob patterns for the normal and long indices
-        norm_idx = i + '.[1-8].ht2'
-        long_idx = i + '.[1-8].ht2l'
-        # Do the search
-        self.pipe_logger.debug('Searching for %s', norm_idx)
-        norm_idx_files = glob.glob(norm_idx)
-        self.pipe_logger.debug('Found %i idx files', len(norm_idx_files))
-        # There should be 8 total
-        if len(norm_idx_files) == 8:
-            return
-        else:
-            self.pipe_logger.debug(
-                'Normal idx not found. Searching for long idx.')
-            long_idx_files = glob.glob(long_idx)
-            self.pipe_logger.debug(
-                'Found %i long idx files', len(long_idx_files))
-            if len(long_idx_files) == 8:
-                return
-            else:
-                self.pipe_logger.error('Cound not find HISAT2 idx files!')
-                DieGracefully.die_gracefully(DieGracefully.BAD_HISAT)
+    def _validate_cache_dir(self, d):
+        """Raise an error if the result cache directory cannot be made or
+        written into. Unlike the output and working directories, we expect the
+        cache directory to have contents from previous runs."""
+        self.pipe_logger.debug('Checking result cache directory %s', d)
+        if not dir_funcs.dir_exists(d, self.pipe_logger):
+            self.pipe_logger.warning(
+                'Cache dir %s does not exist, making it', d)
+            if not dir_funcs.make_dir(d, self.pipe_logger):
+                DieGracefully.die_gracefully(DieGracefully.BAD_CACHEDIR)
+        if not dir_funcs.dir_writeable(d, self.pipe_logger):
+            self.pipe_logger.error('Cache dir %s cannot be written to!', d)
+            DieGracefully.die_gracefully(DieGracefully.BAD_CACHEDIR)
         return
 
     def _prepare_samplesheet(self):
@@ -255,6 +360,8 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
         dictionary that will hold all samplesheet data, and then write it into
         the output directory."""
         self._run_checks()
+        if self.prescan:
+            self._prescan_fastqs()
         is_pe = self.sheet.compile(self.real_out, self.real_work)
         # We want to throw an error if there is a mix of PE and SE samples.
         if len(set(is_pe)) > 1:
@@ -273,42 +380,98 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
                 elif r1 and r2:
                     pe.append(sname)
             DieGracefully.die_gracefully(DieGracefully.PE_SE_MIX, pe, se)
-        ss_path = self.sheet.write_sheet(self.real_out, self.pipe_name, '|')
+        ss_path = self.sheet.write_sheet(self.real_out, self.pipe_name)
         return ss_path
         
+    def _prescan_fastqs(self):
+        """Count the reads in every FASTQ file of the samples and check that
+        they decompress cleanly. Exit with a list of the problems if any are
+        not intact, or if the R1 and R2 files of a sample have different
+        numbers of reads. Returns a dictionary of read counts keyed on sample
+        name."""
+        samples = self.sheet.samples
+        fastqs = [
+            samples[s][r]
+            for s in sorted(samples)
+            for r in ['R1', 'R2']
+            if samples[s][r]]
+        res = fastq_prescan.prescan(
+            fastqs,
+            os.path.join(self.real_out, 'fastq_prescan.tsv'),
+            self.pipe_logger)
+        problems = [
+            'The FASTQ file ' + f + ' ' + res[f][1] + '.'
+            for f in fastqs
+            if res[f][1]]
+        counts = {}
+        for s in sorted(samples):
+            r1 = samples[s]['R1']
+            r2 = samples[s]['R2']
+            counts[s] = res[r1][0]
+            if not r2 or res[r1][1] or res[r2][1]:
+                continue
+            if res[r1][0] != res[r2][0]:
+                problems.append(
+                    'Sample ' + s + ' has ' + str(res[r1][0]) + ' R1 reads '
+                    'and ' + str(res[r2][0]) + ' R2 reads.')
+        if problems:
+            for p in problems:
+                self.pipe_logger.error(p)
+            DieGracefully.die_gracefully(DieGracefully.BAD_INPUTS, problems)
+        # Subsampling more reads than a sample has just uses all of them. A
+        # sample can have fewer reads than both --subsample and
+        # --rrna-screen, so both are checked.
+        for s in sorted(counts):
+            if int(self.subsample) > counts[s]:
+                self.pipe_logger.warning(
+                    'Sample %s has %i reads, fewer than --subsample %s. All '
+                    'of its reads will be used.',
+                    s, counts[s], self.subsample)
+            if int(self.rrna_screen) > counts[s]:
+                self.pipe_logger.warning(
+                    'Sample %s has %i reads, fewer than --rrna-screen %s.',
+                    s, counts[s], self.rrna_screen)
+        # The counts are only reported, not used to plan the jobs. The jobs
+        # request the same --walltime and --mem, and the shards are cut by
+        # file size, which is known without a prescan. There is no model of
+        # run time from read counts to set them from.
+        largest = max(counts, key=counts.get)
+        self.pipe_logger.info(
+            '%i samples with %i reads in total. The largest is %s with %i '
+            'reads.',
+            len(counts), sum(counts.values()), largest, counts[largest])
+        return counts
+
     def _validate_groupsheet(self, args):
         # make a stub if one was not created.
         # @return the args with accurate args['expr_groups'] 
         if args['expr_groups'] is None:
             args['expr_groups'] = self._create_stub_groupsheet(args)
-        # Now do basic validation
-        groups = args['expr_groups']
-        # throw an error if the expr_groups file is not an excel file 
+        return(args)
+
+    def _groupsheet_problems(self, groups):
+        """Return a list of the problems with the experimental groups xlsx.
+        This runs with the other input checks."""
+        # the expr_groups file must be an excel file
         if not groups[-4:] == "xlsx" and not groups[-3:] == "xls":
-            self.sheet_logger.error(
+            return [
                 'A filetype different than an excel spreadsheet was '
                 'supplied for --expr_groups. You supplied a filetype '
                 f'end in {groups[-4:]}. Please replace this with an excel '
                 'spreadsheet in which the first sheet has two columns '
-                'titled "SampleName" and "Group"')
-            DieGracefully.die_gracefully(DieGracefully.BRNASEQ_NO_SAMP_GPS)                 
+                'titled "SampleName" and "Group"']
         # load the group sheet (the first sheet) from the xlsx
         groups_sheet = pd.read_excel(groups, 
                                      sheet_name = 0, 
                                      keep_default_na = False)
-        # throw an error if SampleName is not a header in the group sheet
-        if not 'SampleName' in groups_sheet:
-            self.sheet_logger.error(
-                'The xlsx experimental groups first sheet must have a '
-                'column named "SampleName"')
-            DieGracefully.die_gracefully(DieGracefully.BRNASEQ_NO_SAMP_GPS)   
-        # throw an error if Group is not a header in the group sheet
-        if not 'Group' in groups_sheet:
-            self.sheet_logger.error(
-                'The xlsx experimental groups first sheet must have a '
-                'column named "Group"')
-            DieGracefully.die_gracefully(DieGracefully.BRNASEQ_NO_SAMP_GPS)
-        return(args)
+        # SampleName and Group must be headers in the group sheet
+        problems = []
+        for col in ['SampleName', 'Group']:
+            if not col in groups_sheet:
+                problems.append(
+                    'The xlsx experimental groups first sheet must have a '
+                    f'column named "{col}"')
+        return problems
 
     def _create_stub_groupsheet(self, args):
         ## This produces an experimental groups xlsx with SampleNames
@@ -379,200 +542,183 @@ class BulkRNAseqPipeline(Pipeline.Pipeline):
         if os.path.isfile(keyname):
             self.pipe_logger.warning(
                 'Sbatch key file %s exists. Overwriting!', keyname)
-        try:
-            handle = open(keyname, 'wt')
-        except OSError:
-            DieGracefully.die_gracefully(DieGracefully.BAD_OUTDIR)
         # The sheet is sorted in this way before it is written to disk, so it
         # should be safe to sort it this way
+        handle = output_writer.OutputWriter(keyname)
         handle.write('Sbatch.Index\tSampleName\n')
-        for index, samplename in enumerate(sorted(self.sheet.final_sheet)):
-            handle.write(str(index+1) + '\t' + samplename + '\n')
-        handle.flush()
-        handle.close()
+        handle.writelines(
+            str(index+1) + '\t' + samplename
+            for index, samplename
+            in enumerate(sorted(self.sheet.final_sheet)))
+        # Samples that are aligned in shards get a second table, with the
+        # array index of each shard. It has three columns, so it is not read
+        # as part of the sample table.
+        shards = self.sheet.shards()
+        if shards:
+            handle.write('Shard.Index\tSampleName\tShard\n')
+            handle.writelines(
+                str(index+1) + '\t' + samplename + '\t' + str(shard)
+                for index, (samplename, shard)
+                in enumerate(shards))
+        try:
+            handle.commit()
+        except OSError:
+            DieGracefully.die_gracefully(DieGracefully.BAD_OUTDIR)
         # Make the script filename
         pname = default_files.default_pipeline(self.pipe_name)
         pname = os.path.join(self.real_out, pname)
         if os.path.isfile(pname):
             self.pipe_logger.warning(
                 'Submission script %s already exists. Overwriting!', pname)
-        try:
-            handle = open(pname, 'wt')
-        except OSError:
-            DieGracefully.die_gracefully(DieGracefully.BAD_OUTDIR)
-        # Write the header of the script
-        handle.write('#!/bin/bash\n')
-        # Write some meta-data lines
-        handle.write('# Generated by CHURP version ' +
-                     CHURPipelines.__version__ + '\n')
-        handle.write('# Generated at ' + CHURPipelines.NOW + '\n')
-        handle.write('set -e\n')
-        handle.write('set -u\n')
-        handle.write('set -o pipefail\n')
         self.pipe_logger.debug(
             'Number of samples: %i', len(self.sheet.final_sheet))
         self.pipe_logger.debug('Samplesheet: %s', ss)
-        # Write command to figure out email address of submitting user
-        handle.write('user_name="$(id -u -n)"\n')
-        handle.write('user_email="${user_name}@umn.edu"\n')
-        # Set the group string here
-        if self.group:
-            qsub_group = '-A ' + self.group
-        else:
-            qsub_group = ''
         qsub_array = '1'
         if len(self.sheet.final_sheet) > 1:
             qsub_array += '-' + str(len(self.sheet.final_sheet))
+        # Sharded samples are not in the single sample array. Their shards
+        # are aligned in their own array, and then the rest of the single
+        # sample script is run for them in a "gather" array.
+        sharded = [
+            index + 1
+            for index, samplename
+            in enumerate(sorted(self.sheet.final_sheet))
+            if int(self.sheet.final_sheet[samplename]['Shards']) > 1]
+        if sharded:
+            qsub_array = run_dir.compact_ranges([
+                index + 1
+                for index in range(len(self.sheet.final_sheet))
+                if index + 1 not in sharded])
         # Write a few variables into the header of the script so they are
         # easy to find
-        handle.write('CHURP_VERSION=' + '"' + CHURPipelines.__version__ + '"\n')
-        handle.write('SUMMARY_ONLY=' + '"' + self.summary_only + '"\n')
-        handle.write('KEYFILE=' + '"' + keyname + '"\n')
-        handle.write('QSUB_ARRAY=' + '"' + qsub_array + '"\n')
-        handle.write('OUTDIR=' + '"' + str(self.real_out) + '"\n')
-        handle.write('WORKDIR=' + '"' + str(self.real_work) + '"\n')
-        handle.write('DE_SCRIPT=' + '"' + self.de_script + '"\n')
-        handle.write('REPORT_SCRIPT=' + '"' + self.report_script + '"\n')
-        handle.write('GROUPSHEET=' + '"' + gs + '"\n')
-        handle.write('SAMPLESHEET=' + '"' + ss + '"\n')
-        handle.write('PURGE=' + '"' + self.purge + '"\n')
-        handle.write('RRNA_SCREEN=' + '"' + self.rrna_screen + '"\n')
-        handle.write('SUBSAMPLE=' + '"' + self.subsample + '"\n')
-        handle.write('PIPE_SCRIPT="$(cd "$( dirname "${BASH_SOURCE[0]}" )" '
-                     '>/dev/null && pwd )/$(basename $0)"\n')
-        # These are the variables we want to export into the single sample job
-        # script.
-        single_cmd_vars = ','.join([
+        header_vars = [
+            ('CHURP_VERSION', CHURPipelines.__version__),
+            ('SUMMARY_ONLY', self.summary_only),
+            ('KEYFILE', keyname),
+            ('QSUB_ARRAY', qsub_array),
+            ('OUTDIR', str(self.real_out)),
+            ('WORKDIR', str(self.real_work)),
+            ('DE_SCRIPT', self.de_script),
+            ('REPORT_SCRIPT', self.report_script),
+            ('CHURP_DIR', self.churp_dir),
+            ('GROUPSHEET', gs),
+            ('SAMPLESHEET', ss),
+            ('PURGE', self.purge),
+            ('RRNA_SCREEN', self.rrna_screen),
+            ('SUBSAMPLE', self.subsample),
+            ('CACHE_DIR', self.cache_dir)]
+        if sharded:
+            header_vars.extend([
+                ('SHARD_ARRAY', '1-' + str(len(shards))),
+                ('GATHER_ARRAY', run_dir.compact_ranges(sharded))])
+        header_vars.extend([
+            ('PIPE_SCRIPT',
+             '$(cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null && pwd )'
+             '/$(basename $0)')])
+        # The single sample job array. It is skipped if the user has
+        # specified the "--summary-only" option.
+        single_exports = [
             'SampleSheet="${SAMPLESHEET}"',
             'PURGE="${PURGE}"',
             'RRNA_SCREEN="${RRNA_SCREEN}"',
-            'SUBSAMPLE="${SUBSAMPLE}"'
-            ])
-        # And the command for the single-sample job array
-        aln_cmd = [
-            'sbatch',
-            '--parsable',
-            '--ignore-pbs',
-            '-p', self.msi_queue,
-            '--mail-type=BEGIN,END,FAIL',
-            '--mail-user="${user_email}"',
-            qsub_group,
-            '-o', '"${OUTDIR}/bulk_rnaseq_single_sample-%A.%a.out"',
-            '-e', '"${OUTDIR}/bulk_rnaseq_single_sample-%A.%a.err"',
-            '-N', '1',
-            '--mem=' + str(self.mem) + 'mb',
-            '--tmp=' + str(self.tmp_space) + 'mb',
-            '-n', '1',
-            '-c', str(self.ppn),
-            '--time=' + str(self.walltime * 60),
-            '--array="${QSUB_ARRAY}"',
-            '--export=' + single_cmd_vars,
+            'SUBSAMPLE="${SUBSAMPLE}"',
+            'CACHE_DIR="${CACHE_DIR}"',
+            'CHURP_DIR="${CHURP_DIR}"',
+            'BAM_METRICS="' + self.bam_metrics + '"',
+            'STAGE_LOCAL_MB="' + self.stage_local_mb + '"']
+        single_job = pipeline_script.JobSpec(
+            'single',
             self.single_sample_script,
-            '||',
-            'exit',
-            '1']
-        # The variables to export for the summary job
-        summary_vars = ','.join([
-            'SampleSheet="${SAMPLESHEET}"',
-            'GroupSheet="${GROUPSHEET}"',
-            'CHURP_VERSION="${CHURP_VERSION}"',
-            'MINLEN="' + self.min_gene_len + '"',
-            'MINCPM="' + self.min_cts + '"',
-            'RSUMMARY="${DE_SCRIPT}"',
-            'PIPE_SCRIPT="${PIPE_SCRIPT}"',
-            'BULK_RNASEQ_REPORT="${REPORT_SCRIPT}"'])
-        # Write some logic to detect if we are running in a job allocation.
-        # Quit the bash script if it is.
-        handle.write('if [ ! -z "${SLURM_JOB_ID+NULL}" ]\n')
-        handle.write('    then echo "You should run this script with \'bash\' from outside of a job allocation." > /dev/stderr\n')
-        handle.write('    exit 99\n')
-        handle.write('fi\n')
-        # Make two versions of the summary command: one with the single sample
-        # array dependency and one without
-        summary_cmd_dep = [
-            'sbatch',
-            '--parsable',
-            '--ignore-pbs',
-            '-p', self.msi_queue,
-            '--mail-type=BEGIN,END,FAIL',
-            '--mail-user="${user_email}"',
-            qsub_group,
-            '-o', '"${OUTDIR}/run_summary_stats-%j.out"',
-            '-e', '"${OUTDIR}/run_summary_stats-%j.err"',
-            '-N', '1',
-            '--mem=' + str(self.mem) + 'mb',
-            '--tmp=' + str(self.tmp_space) + 'mb',
-            '-n', '1',
-            '-c', str(self.ppn),
-            '--time=' + str(self.walltime * 60),
-            '--depend=afterok:${single_id}',
-            '--export=' + summary_vars,
+            single_exports,
+            '"${OUTDIR}/bulk_rnaseq_single_sample-%A.%a.out"',
+            '"${OUTDIR}/bulk_rnaseq_single_sample-%A.%a.err"',
+            array=True,
+            skip_if='[ "${SUMMARY_ONLY}" = "true" ]')
+        jobs = [single_job]
+        summary_depend = ['single']
+        if sharded:
+            # The shard and gather arrays run the same script. The gather
+            # tasks write the same logs as the single sample tasks, so that
+            # the status and resubmit subcommands see one log per sample.
+            single_job.skip_if = (
+                '[ "${SUMMARY_ONLY}" = "true" -o -z "${QSUB_ARRAY}" ]')
+            shard_skip = '[ "${SUMMARY_ONLY}" = "true" -o -z "${GATHER_ARRAY}" ]'
+            shard_job = pipeline_script.JobSpec(
+                'shard',
+                self.single_sample_script,
+                single_exports + ['SHARD_TASK="true"'],
+                '"${OUTDIR}/bulk_rnaseq_shard-%A.%a.out"',
+                '"${OUTDIR}/bulk_rnaseq_shard-%A.%a.err"',
+                array='SHARD_ARRAY',
+                skip_if=shard_skip)
+            gather_job = pipeline_script.JobSpec(
+                'gather',
+                self.single_sample_script,
+                single_exports,
+                '"${OUTDIR}/bulk_rnaseq_single_sample-%A.%a.out"',
+                '"${OUTDIR}/bulk_rnaseq_single_sample-%A.%a.err"',
+                array='GATHER_ARRAY',
+                depend=['shard'],
+                skip_if=shard_skip)
+            jobs = [shard_job, single_job, gather_job]
+            summary_depend = ['single', 'gather']
+        # The summary job, which waits for the single sample jobs
+        summary_job = pipeline_script.JobSpec(
+            'summary',
             self.summary_script,
-            '||',
-            'exit',
-            '1']
-        summary_cmd = [
-            'sbatch',
-            '--parsable',
-            '--ignore-pbs',
-            '-p', self.msi_queue,
-            '--mail-type=BEGIN,END,FAIL',
-            '--mail-user="${user_email}"',
-            qsub_group,
-            '-o', '"${OUTDIR}/run_summary_stats-%j.out"',
-            '-e', '"${OUTDIR}/run_summary_stats-%j.err"',
-            '-N', '1',
-            '--mem=' + str(self.mem) + 'mb',
-            '--tmp=' + str(self.tmp_space) + 'mb',
-            '-n', '1',
-            '-c', str(self.ppn),
-            '--time=' + str(self.walltime * 60),
-            '--export=' + summary_vars,
-            self.summary_script,
-            '||',
-            'exit',
-            '1']
-        # Write the logic for if the user has specified the "--summary-only"
-        # option.
-        handle.write('if [ -f "${OUTDIR}/.in_progress" ]\n')
-        handle.write('then\n')
-        handle.write('    echo "ERROR: ${OUTDIR}/.in_progress" exists. > /dev/stderr\n')
-        handle.write('    echo "Job already submitted; aborting." > /dev/stderr\n')
-        handle.write('    echo "Remove this file to allow job resbumission." > /dev/stderr\n')
-        handle.write('    exit 1\n')
-        handle.write('fi\n')
-        handle.write('touch "${OUTDIR}/.in_progress"\n')
-        handle.write('if [ "${SUMMARY_ONLY}" = "true" ]\n')
-        handle.write('then\n')
-        handle.write('    summary_id=$(' + ' '.join(summary_cmd) + ')\n')
-        handle.write('else\n')
-        handle.write('    single_id=$(' + ' '.join(aln_cmd) + ')\n')
-        handle.write('    summary_id=$(' + ' '.join(summary_cmd_dep) + ')\n')
-        handle.write('fi\n')
-        # Write some echo statements for users' information
-        handle.write('echo "You are running CHURP version ${CHURP_VERSION}"\n')
-        handle.write('echo "Output and logs will be written to ${OUTDIR}"\n')
-        handle.write('echo "Emails will be sent to ${user_email}"\n')
-        handle.write('echo "Sbatch array to samplename key: ${KEYFILE}"\n')
-        handle.write('if [ "${SUMMARY_ONLY}" = "true" ]\n')
-        handle.write('    then echo "--summary-only" specified. No single samples job array ID\n')
-        handle.write('    else echo "Single samples job array ID: ${single_id}"\n')
-        handle.write('fi\n')
-        handle.write('echo "Summary job ID: ${summary_id}"\n')
-        self.pipe_logger.debug('sbatch:\n%s', ' '.join(aln_cmd))
-        self.pipe_logger.debug('sbatch:\n%s', ' '.join(summary_cmd))
-        handle.flush()
-        handle.close()
+            ['SampleSheet="${SAMPLESHEET}"',
+             'GroupSheet="${GROUPSHEET}"',
+             'CHURP_VERSION="${CHURP_VERSION}"',
+             'CHURP_DIR="${CHURP_DIR}"',
+             'MINLEN="' + self.min_gene_len + '"',
+             'MINCPM="' + self.min_cts + '"',
+             'DETAIL_LIMIT="' + self.detail_limit + '"',
+             'DE_ENGINE="' + self.de_engine + '"',
+             'NORM_ENGINE="' + self.norm_engine + '"',
+             'COUNTS_ONLY="' + self.counts_only + '"',
+             'RSUMMARY="${DE_SCRIPT}"',
+             'PIPE_SCRIPT="${PIPE_SCRIPT}"',
+             'BULK_RNASEQ_REPORT="${REPORT_SCRIPT}"'],
+            '"${OUTDIR}/run_summary_stats-%j.out"',
+            '"${OUTDIR}/run_summary_stats-%j.err"',
+            depend=summary_depend)
+        jobs.append(summary_job)
+        script = pipeline_script.render(
+            PIPELINE_TEMPLATE,
+            self.scheduler,
+            header_vars,
+            jobs,
+            {'version': CHURPipelines.__version__, 'now': CHURPipelines.NOW})
+        self.pipe_logger.debug(
+            '%s:\n%s', self.scheduler.name,
+            ' '.join(single_job.command(self.scheduler)))
+        self.pipe_logger.debug(
+            '%s:\n%s', self.scheduler.name,
+            ' '.join(summary_job.command(self.scheduler, ['single'])))
+        handle = output_writer.OutputWriter(pname)
+        handle.write(script)
+        try:
+            handle.commit()
+        except OSError:
+            DieGracefully.die_gracefully(DieGracefully.BAD_OUTDIR)
         # Check if we want to automatically submit the script
         if self.nosubmit:
             qsub_dat = None
         else:
             qsub_cmd = ['bash', pname]
+            # The local scheduler runs all of the jobs before the script
+            # returns. Let its progress messages through to the terminal.
+            if self.scheduler.blocking:
+                qsub_err = None
+            else:
+                qsub_err = subprocess.PIPE
             qsub_proc = subprocess.Popen(
                 qsub_cmd,
                 shell=False,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
+                stderr=qsub_err)
             qsub_stdout, qsub_stderr = qsub_proc.communicate()
+            if qsub_stderr is None:
+                qsub_stderr = b''
             qsub_dat = (qsub_stdout, qsub_stderr, qsub_proc)
         return (pname, ss, keyname, qsub_dat)
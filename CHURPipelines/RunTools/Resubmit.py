@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""Define a class that resubmits only the failed and unfinished array tasks of
+a bulk RNAseq run. The pipeline script that set up the run is rewritten with a
+new array specification, optionally larger memory and time requests, and a
+summary job that depends on the new tasks and on any tasks that are still
+queued or running from earlier submissions. For Slurm runs, the queue is
+checked so that tasks that are still queued are not started twice."""
+
+import getpass
+import math
+import os
+import re
+import subprocess
+import sys
+
+import CHURPipelines
+from CHURPipelines import DieGracefully
+from CHURPipelines.ArgHandling import set_verbosity
+from CHURPipelines.FileOps import output_writer
+from CHURPipelines.RunTools import run_dir
+from CHURPipelines.RunTools import RunStatus
+
+# Upper bounds on the resources, as in Pipeline._check_scheduler()
+MAX_MEM = 512000
+MAX_MINUTES = 96 * 60
+
+# Slurm leaves jobs whose dependencies failed in the queue with this reason.
+# They will never start, so they are cancelled and rerun.
+NEVER_RUNS = 'DependencyNeverSatisfied'
+
+
+class Resubmit(object):
+    """Holds the state of a run and writes a pipeline script that reruns the
+    tasks that did not finish."""
+
+    def __init__(self, args):
+        """Initialize the resubmission object and read the state of the
+        run."""
+        self.resub_logger = set_verbosity.verb(args['verbosity'], __name__)
+        self.outdir = os.path.realpath(os.path.expanduser(args['outdir']))
+        self.mem_factor = args['mem_factor']
+        self.time_factor = args['time_factor']
+        self.purge = args['purge']
+        self.nosubmit = args['no_auto_submit']
+        for opt, val in [('--mem-factor', self.mem_factor),
+                         ('--time-factor', self.time_factor)]:
+            if val <= 0:
+                DieGracefully.die_gracefully(DieGracefully.BAD_NUMBER, opt)
+        run_files = run_dir.find_run_files(self.outdir, self.resub_logger)
+        if 'pipeline' not in run_files:
+            DieGracefully.die_gracefully(
+                DieGracefully.BAD_RUNDIR, self.outdir, 'a pipeline script')
+        self.pipeline = run_files['pipeline']
+        self.shard_key = run_dir.read_shard_key(run_files['keyfile'])
+        # Local runs finish all of their jobs before the pipeline script
+        # returns, so there is no queue to check
+        with open(self.pipeline, 'rt') as f:
+            self.local = 'local_executor' in f.read()
+        # Use the status reader to get the state of every task
+        status = RunStatus.RunStatus(
+            dict(args, watch=None, brief=True))
+        self.tasks, self.summary = status.collect()
+        return
+
+    def queued_jobs(self):
+        """Return a list of the jobs of this run that are still in the Slurm
+        queue, as (kind, job, array index, state, reason) tuples. The job IDs
+        of the run come from the record that the pipeline scripts keep, and
+        from the logs of the jobs that have started."""
+        ids = run_dir.read_job_ids(self.outdir)
+        for t in self.tasks:
+            if t['job'] != '-':
+                ids['single'].add(t['job'].split('_')[0])
+        if self.summary['job'] != '-':
+            ids['summary'].add(self.summary['job'])
+        self.resub_logger.debug('Job IDs of the run: %s', ids)
+        cmd = ['squeue', '-h', '-r', '-u', getpass.getuser(),
+               '-o', '%i|%T|%r']
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                shell=False,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+        except OSError as e:
+            DieGracefully.die_gracefully(
+                DieGracefully.RESUB_NO_QUEUE, self.outdir, str(e))
+        if proc.returncode != 0:
+            DieGracefully.die_gracefully(
+                DieGracefully.RESUB_NO_QUEUE, self.outdir,
+                err.decode('utf-8').strip())
+        queued = []
+        for line in out.decode('utf-8').splitlines():
+            tmp = line.strip().split('|')
+            if len(tmp) != 3:
+                continue
+            job, state, reason = tmp
+            base, _, task = job.partition('_')
+            for kind in run_dir.JOB_KINDS:
+                if base in ids[kind]:
+                    idx = int(task) if task.isdigit() else None
+                    queued.append((kind, job, idx, state, reason))
+        self.resub_logger.debug('Queued jobs of the run: %s', queued)
+        return queued
+
+    def select_tasks(self):
+        """Return the list of array indices to rerun, the list of jobs that
+        the new summary job has to wait for, and the list of jobs to cancel
+        before the resubmission, as Slurm job strings (e.g., '123456_7').
+        Tasks that failed or never ran are rerun, unless Slurm still has them
+        queued from an earlier submission, in which case the new summary job
+        waits for them instead. Queued tasks that will never start, the old
+        summary job, and the queued shards of rerun samples are cancelled."""
+        if self.local:
+            queued = []
+        else:
+            queued = self.queued_jobs()
+        in_queue = {}
+        cancel = []
+        for kind, job, idx, state, reason in queued:
+            if kind == 'summary' or (state == 'PENDING' and
+                                     reason == NEVER_RUNS):
+                cancel.append(job)
+            elif kind in ('single', 'gather') and idx is not None:
+                in_queue.setdefault(idx, []).append(job)
+        rerun = []
+        wait = []
+        for t in self.tasks:
+            if t['index'] in in_queue:
+                wait.extend(in_queue[t['index']])
+            elif self.local and t['state'] == 'Running':
+                wait.append(t['job'])
+            elif t['state'] != 'Done':
+                # Tasks that are not in the queue are rerun, even if their
+                # log says that they are running, since they were stopped
+                # without writing to it
+                rerun.append(t['index'])
+        # Shards of the samples that are rerun would race with the rerun,
+        # which aligns the whole sample if any shard is missing
+        rerun_samples = set(
+            t['sample'] for t in self.tasks if t['index'] in rerun)
+        for kind, job, idx, state, reason in queued:
+            if kind == 'shard' and job not in cancel and \
+                    self.shard_key.get(idx) in rerun_samples:
+                cancel.append(job)
+        running_summary = [
+            q[1] for q in queued
+            if q[0] == 'summary' and q[3] != 'PENDING']
+        if rerun and running_summary:
+            DieGracefully.die_gracefully(
+                DieGracefully.RESUB_SUMMARY_RUNNING, self.outdir,
+                running_summary)
+        self.resub_logger.debug('Tasks to rerun: %s', rerun)
+        self.resub_logger.debug('Jobs to wait for: %s', wait)
+        self.resub_logger.debug('Jobs to cancel: %s', cancel)
+        return (rerun, wait, cancel)
+
+    def _scale(self, line):
+        """Scale the --mem and --time requests on the line that starts the
+        single sample array. sbatch lines give the memory in MB with an 'mb'
+        suffix, and local executor lines give it without one, so the unit of
+        the line is kept."""
+        def new_mem(m):
+            mem = int(m.group(1))
+            mem = min(MAX_MEM, int(math.ceil(mem * self.mem_factor)))
+            return '--mem=' + str(mem) + (m.group(2) or '')
+
+        def new_time(m):
+            mins = int(m.group(1))
+            mins = min(MAX_MINUTES, int(math.ceil(mins * self.time_factor)))
+            return '--time=' + str(mins)
+        line = re.sub(r'--mem=([0-9]+)(mb)?', new_mem, line)
+        line = re.sub(r'--time=([0-9]+)', new_time, line)
+        return line
+
+    def write_script(self, rerun, running, cancel):
+        """Write the resubmission script next to the original pipeline script
+        and return its path. running is the list of jobs that the summary job
+        waits for, and cancel is the list of jobs that the script cancels
+        before it submits the new ones."""
+        with open(self.pipeline, 'rt') as f:
+            lines = f.readlines()
+        out = []
+        skip_guard = False
+        for line in lines:
+            if line.startswith('QSUB_ARRAY='):
+                line = 'QSUB_ARRAY="' + run_dir.compact_ranges(rerun) + '"\n'
+            elif line.startswith('SHARD_ARRAY=') or \
+                    line.startswith('GATHER_ARRAY='):
+                # Failed samples that were aligned in shards are rerun as
+                # whole samples. They keep the shard alignments that finished,
+                # and only align the whole sample again if any are missing.
+                line = line.split('=', 1)[0] + '=""\n'
+            elif line.startswith('SUMMARY_ONLY='):
+                line = 'SUMMARY_ONLY="false"\n'
+            elif line.startswith('PURGE=') and not self.purge:
+                # Keep the checkpoints of the failed samples, so they pick up
+                # from the section that failed
+                line = 'PURGE="false"\n'
+            elif line.startswith('if [ -f "${OUTDIR}/.in_progress" ]'):
+                # The .in_progress guard is for accidental double submission.
+                # Tasks from the first submission may still be running, so we
+                # do not want it here.
+                out.append('# .in_progress check skipped for resubmission\n')
+                if cancel:
+                    out.append(
+                        '# Cancel the queued jobs of earlier submissions '
+                        'that are replaced\n')
+                    out.append('scancel ' + ' '.join(cancel) + '\n')
+                skip_guard = True
+                continue
+            elif skip_guard:
+                if line.strip() == 'fi':
+                    skip_guard = False
+                continue
+            elif line.lstrip().startswith('single_id=$('):
+                line = self._scale(line)
+            elif '--depend=afterok:${single_id}' in line and running:
+                # The summary job also has to wait for the tasks that are
+                # still running from the first submission
+                line = line.replace(
+                    '--depend=afterok:${single_id}',
+                    '--depend=afterok:${single_id}:' + ':'.join(running))
+            out.append(line)
+        base = self.pipeline
+        if base.endswith('.sh'):
+            base = base[:-3]
+        rname = base + '.resubmit' + CHURPipelines.TIMESTAMP + '.sh'
+        if os.path.isfile(rname):
+            self.resub_logger.warning(
+                'Resubmission script %s exists. Overwriting!', rname)
+        try:
+            output_writer.write_text(rname, ''.join(out))
+        except OSError:
+            DieGracefully.die_gracefully(DieGracefully.BAD_OUTDIR)
+        return rname
+
+    def run(self):
+        """Write the resubmission script, and submit it unless told not
+        to."""
+        rerun, running, cancel = self.select_tasks()
+        if not rerun:
+            sys.stderr.write(
+                'No failed or unfinished samples found in ' + self.outdir +
+                '; nothing to resubmit.\n')
+            if running:
+                sys.stderr.write(
+                    str(len(running)) + ' task(s) are still queued or '
+                    'running.\n')
+            return
+        rname = self.write_script(rerun, running, cancel)
+        sys.stderr.write(
+            'Resubmitting ' + str(len(rerun)) + ' of ' + str(len(self.tasks)) +
+            ' array tasks: ' + run_dir.compact_ranges(rerun) + '\n')
+        if running:
+            sys.stderr.write(
+                'The summary job will also wait for ' + str(len(running)) +
+                ' task(s) that are still queued or running.\n')
+        if cancel:
+            sys.stderr.write(
+                'The resubmission script cancels ' + str(len(cancel)) +
+                ' queued job(s) of earlier submissions: ' +
+                ' '.join(cancel) + '\n')
+        sys.stderr.write('Resubmission script: ' + rname + '\n')
+        if self.nosubmit:
+            sys.stderr.write('Run it with "bash ' + rname + '"\n')
+            return
+        proc = subprocess.Popen(
+            ['bash', rname],
+            shell=False,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            DieGracefully.die_gracefully(
+                DieGracefully.BRNASEQ_SUBMIT_FAIL, (out, err, proc))
+        sys.stderr.write(out.decode('utf-8'))
+        return
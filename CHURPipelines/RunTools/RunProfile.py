@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""Define a class that reads the per-section resource profiles written by the
+single sample and summary scripts, and aggregates them into a per-section
+table with percentiles. This is meant to show which steps are the bottleneck
+in a run, and to guide the --mem, --ppn, and --walltime requests."""
+
+import csv
+import os
+import sys
+
+from CHURPipelines import DieGracefully
+from CHURPipelines.ArgHandling import set_verbosity
+
+# The profiles are written into the Logs directory of the output directory as
+# ${SAMPLENM}_Profile.tsv. The summary job writes BulkRNASeq_Profile.tsv.
+PROFILE_SUFFIX = '_Profile.tsv'
+
+# The columns of the aggregated table, in order
+TABLE_COLUMNS = [
+    'Section',
+    'Records',
+    'Failed',
+    'Wall.Share',
+    'Wall.p50',
+    'Wall.p90',
+    'Wall.p99',
+    'Wall.Max',
+    'CPU.p50',
+    'CPU.p90',
+    'CPU.Max',
+    'CPU.Efficiency',
+    'MaxRSS.GB.p50',
+    'MaxRSS.GB.p90',
+    'MaxRSS.GB.Max',
+    'MemScope',
+    'Read.GB.p50',
+    'Read.GB.Max',
+    'Write.GB.p50',
+    'Write.GB.Max']
+
+
+def percentile(vals, q):
+    """Return the q-th percentile (0-100) of a list of numbers, with linear
+    interpolation between the closest ranks. This matches the default method
+    of numpy.percentile() and R's quantile(), without needing either. Returns
+    None for an empty list."""
+    if not vals:
+        return None
+    s = sorted(vals)
+    pos = (len(s) - 1) * q / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (pos - lo)
+
+
+def _to_float(x):
+    """Return a float from a profile field, or None if it is missing or NA."""
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return None
+
+
+class RunProfile(object):
+    """Holds the profile records of one output directory."""
+
+    def __init__(self, args):
+        """Initialize the profile object. Find and read the profile files in
+        the Logs directory of the output directory."""
+        self.prof_logger = set_verbosity.verb(args['verbosity'], __name__)
+        self.outdir = os.path.realpath(os.path.expanduser(args['outdir']))
+        self.output = args['output']
+        self.records = []
+        # Keep the sections in the order that they are first seen, which is
+        # the order that they run in the scripts
+        self.sections = []
+        self._read_profiles()
+        return
+
+    def _read_profiles(self):
+        """Read all profile files with one listing of the Logs directory."""
+        logdir = os.path.join(self.outdir, 'Logs')
+        self.prof_logger.debug('Looking for profiles in %s', logdir)
+        try:
+            entries = [
+                e.path
+                for e
+                in os.scandir(logdir)
+                if e.name.endswith(PROFILE_SUFFIX) and e.is_file()]
+        except OSError:
+            DieGracefully.die_gracefully(
+                DieGracefully.BAD_RUNDIR, self.outdir, 'a Logs directory')
+        # Put the summary job last, so its sections go at the bottom
+        for p in sorted(entries, key=lambda x: x.endswith(
+                'BulkRNASeq' + PROFILE_SUFFIX)):
+            self.prof_logger.debug('Reading %s', p)
+            with open(p, 'rt') as f:
+                for row in csv.DictReader(f, delimiter='\t'):
+                    if not row.get('Section'):
+                        continue
+                    self.records.append(row)
+                    if row['Section'] not in self.sections:
+                        self.sections.append(row['Section'])
+        self.prof_logger.info(
+            'Read %i records from %i profiles', len(self.records),
+            len(entries))
+        if not self.records:
+            DieGracefully.die_gracefully(
+                DieGracefully.BAD_RUNDIR, self.outdir, 'any profile records')
+        return
+
+    def summarize(self):
+        """Aggregate the records into one row per section. Times are in
+        seconds, memory and I/O are in GB. The memory percentiles are only of
+        the peaks that were sampled from the section itself, and MemScope
+        lists the scopes of all of the records. Returns a list of lists in the
+        order of TABLE_COLUMNS."""
+        gb = 1024.0 ** 3
+        by_section = {s: [] for s in self.sections}
+        for r in self.records:
+            by_section[r['Section']].append(r)
+        total_wall = 0.0
+        walls = {}
+        for s in self.sections:
+            walls[s] = []
+            for r in by_section[s]:
+                start = _to_float(r['Start'])
+                end = _to_float(r['End'])
+                if start is not None and end is not None:
+                    walls[s].append(end - start)
+            total_wall += sum(walls[s])
+        table = []
+        for s in self.sections:
+            recs = by_section[s]
+            cpu = []
+            for r in recs:
+                u = _to_float(r['CPUUser'])
+                y = _to_float(r['CPUSys'])
+                if u is not None and y is not None:
+                    cpu.append(u + y)
+            # A peak with the 'job' scope is of the whole job so far, not of
+            # the section, so it is left out of the section percentiles
+            rss = [
+                _to_float(r['MaxRSSKB']) * 1024 / gb
+                for r in recs
+                if r['MemScope'] != 'job' and
+                _to_float(r['MaxRSSKB']) is not None]
+            rd = [
+                _to_float(r['ReadBytes']) / gb
+                for r in recs
+                if _to_float(r['ReadBytes']) is not None]
+            wr = [
+                _to_float(r['WriteBytes']) / gb
+                for r in recs
+                if _to_float(r['WriteBytes']) is not None]
+            failed = len([r for r in recs if r['ExitCode'] != '0'])
+            scopes = sorted(set(r['MemScope'] for r in recs))
+            if sum(walls[s]) > 0:
+                eff = sum(cpu) / sum(walls[s])
+            else:
+                eff = None
+            if total_wall > 0:
+                share = sum(walls[s]) / total_wall
+            else:
+                share = None
+            table.append([
+                s,
+                len(recs),
+                failed,
+                share,
+                percentile(walls[s], 50),
+                percentile(walls[s], 90),
+                percentile(walls[s], 99),
+                percentile(walls[s], 100),
+                percentile(cpu, 50),
+                percentile(cpu, 90),
+                percentile(cpu, 100),
+                eff,
+                percentile(rss, 50),
+                percentile(rss, 90),
+                percentile(rss, 100),
+                ','.join(scopes),
+                percentile(rd, 50),
+                percentile(rd, 100),
+                percentile(wr, 50),
+                percentile(wr, 100)])
+        return table
+
+    def write_table(self):
+        """Print the aggregated table to the terminal, and write it as a
+        tab-delimited file if an output file was given."""
+        table = self.summarize()
+        fmt_rows = [TABLE_COLUMNS]
+        for row in table:
+            fmt_row = []
+            for v in row:
+                if v is None:
+                    fmt_row.append('NA')
+                elif isinstance(v, float):
+                    fmt_row.append('{0:.2f}'.format(v))
+                else:
+                    fmt_row.append(str(v))
+            fmt_rows.append(fmt_row)
+        # Pad the columns for the terminal
+        widths = [
+            max(len(r[i]) for r in fmt_rows)
+            for i in range(len(TABLE_COLUMNS))]
+        for r in fmt_rows:
+            sys.stdout.write(
+                r[0].ljust(widths[0]) + ' ' +
+                ' '.join(v.rjust(w) for v, w in zip(r[1:], widths[1:])) +
+                '\n')
+        if self.output:
+            out = os.path.realpath(os.path.expanduser(self.output))
+            self.prof_logger.debug('Writing profile table to %s', out)
+            with open(out, 'wt') as f:
+                for r in fmt_rows:
+                    f.write('\t'.join(r) + '\n')
+        return
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""Define a class that reports the progress of a bulk RNAseq run from its
+output directory. The state of each array task is read from its Slurm error
+file, which gets a line each time the single sample script enters or finishes
+a section, when the job completes, and when it fails. Some sections of the
+single sample script run at the same time, so a task can be in more than one
+section. In watch mode, only the error files
+that have grown since the last check are read, and only the new lines."""
+
+import datetime
+import os
+import re
+import sys
+import time
+
+from CHURPipelines.ArgHandling import set_verbosity
+from CHURPipelines.RunTools import run_dir
+
+# The single sample and summary scripts write lines like
+#   # 2024-07-23 12:00:00: Entering section HISAT2
+# into the Slurm error file
+ERR_LINE_RE = re.compile(
+    r'^# ([0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}):? (.*)$')
+FAIL_RE = re.compile(r'^Failed in section (.+) with exit status ([0-9]+)$')
+TS_FMT = '%Y-%m-%d %H:%M:%S'
+
+# The order of the states in the table and the summary line
+STATES = ['Done', 'Running', 'Failed', 'Pending']
+
+
+def _fmt_secs(s):
+    """Return a number of seconds as H:MM:SS, or '-' for None."""
+    if s is None:
+        return '-'
+    s = int(s)
+    return '{h}:{m:02}:{s:02}'.format(h=s // 3600, m=(s % 3600) // 60,
+                                      s=s % 60)
+
+
+class RunStatus(object):
+    """Holds the state of the array tasks and the summary job of a run."""
+
+    def __init__(self, args):
+        """Initialize the status object. Find the samplesheet, array key, and
+        working directory of the run."""
+        self.status_logger = set_verbosity.verb(args['verbosity'], __name__)
+        self.outdir = os.path.realpath(os.path.expanduser(args['outdir']))
+        self.watch = args['watch']
+        self.brief = args['brief']
+        run_files = run_dir.find_run_files(self.outdir, self.status_logger)
+        self.key = run_dir.read_key(run_files['keyfile'])
+        sheet = run_dir.read_samplesheet(run_files['samplesheet'])
+        self.workdir = {s: sheet[s]['WorkingDir'] for s in sheet}
+        # Parsed state of each error file, keyed on path. We keep the size,
+        # mtime, and offset of each so that we only read what is new.
+        self.err_state = {}
+        return
+
+    def _read_err(self, path):
+        """Read the new lines of a Slurm error file and update its parsed
+        state. Files that have not changed since the last read are skipped
+        with just a stat() call."""
+        st = os.stat(path)
+        state = self.err_state.get(path)
+        if state and state['size'] == st.st_size and \
+                state['mtime'] == st.st_mtime:
+            return state
+        if not state or st.st_size < state['offset']:
+            # New file, or it was truncated; read from the start
+            state = {
+                'offset': 0,
+                'start': None,
+                'last': None,
+                'section': '-',
+                'running': [],
+                'state': 'Running',
+                'note': ''
+                }
+        with open(path, 'rb') as f:
+            f.seek(state['offset'])
+            dat = f.read()
+        # Only parse complete lines, and keep the partial line for next time
+        end = dat.rfind(b'\n') + 1
+        state['offset'] += end
+        for line in dat[:end].decode('utf-8', 'replace').splitlines():
+            if line.startswith('slurmstepd: error:'):
+                state['state'] = 'Failed'
+                state['note'] = line.replace(
+                    'slurmstepd: error:', '').strip(' *')
+                continue
+            m = ERR_LINE_RE.match(line)
+            if not m:
+                continue
+            ts = datetime.datetime.strptime(m.group(1), TS_FMT)
+            msg = m.group(2)
+            if state['start'] is None:
+                state['start'] = ts
+            state['last'] = ts
+            if msg.startswith('Entering section '):
+                sec = msg.replace('Entering section ', '', 1)
+                if sec not in state['running']:
+                    state['running'].append(sec)
+                state['section'] = ', '.join(state['running'])
+            elif msg.startswith('Finished section '):
+                # Keep showing the last section if none are left running
+                sec = msg.replace('Finished section ', '', 1)
+                if sec in state['running']:
+                    state['running'].remove(sec)
+                if state['running']:
+                    state['section'] = ', '.join(state['running'])
+            elif msg == 'Job complete':
+                state['state'] = 'Done'
+            elif msg.startswith('Found completed analysis'):
+                # The task exited early because the sample was finished by
+                # an earlier job; this does not tell us how long it takes
+                state['note'] = 'already complete'
+            else:
+                fm = FAIL_RE.match(msg)
+                if fm:
+                    state['state'] = 'Failed'
+                    state['section'] = fm.group(1)
+                    state['note'] = 'exit status ' + fm.group(2)
+        state['size'] = st.st_size
+        state['mtime'] = st.st_mtime
+        self.err_state[path] = state
+        return state
+
+    def _task_state(self, idx, sample, logs, now):
+        """Return a dictionary of the state of one array task."""
+        task = {
+            'index': idx,
+            'sample': sample,
+            'job': '-',
+            'state': 'Pending',
+            'section': '-',
+            'elapsed': None,
+            'note': ''
+            }
+        if idx in logs:
+            jid, path = logs[idx]
+            es = self._read_err(path)
+            task['job'] = str(jid) + '_' + str(idx)
+            task['state'] = es['state']
+            task['section'] = es['section']
+            task['note'] = es['note']
+            if es['start']:
+                if es['state'] == 'Running':
+                    task['elapsed'] = (now - es['start']).total_seconds()
+                else:
+                    task['elapsed'] = (
+                        es['last'] - es['start']).total_seconds()
+        else:
+            # No error file: the task has not started, or it was run from an
+            # earlier pipeline script whose logs were removed. The checkpoint
+            # file is the final word on whether the sample is finished.
+            done = os.path.join(
+                self.workdir.get(sample, ''), 'singlesamples', sample,
+                sample + '.done')
+            if os.path.isfile(done):
+                task['state'] = 'Done'
+                task['note'] = 'checkpoint only'
+        return task
+
+    def collect(self):
+        """Return a list of the task states and the summary job state."""
+        now = datetime.datetime.now()
+        logs, summary = run_dir.job_logs(self.outdir)
+        tasks = [self._task_state(i, s, logs, now) for i, s in self.key]
+        if summary:
+            es = self._read_err(summary[1])
+            summ = {
+                'job': str(summary[0]),
+                'state': es['state'],
+                'section': es['section'],
+                'note': es['note']}
+        else:
+            summ = {
+                'job': '-',
+                'state': 'Pending',
+                'section': '-',
+                'note': ''}
+        return (tasks, summ)
+
+    def eta(self, tasks):
+        """Estimate the time until the array finishes. This uses the median
+        run time of the finished tasks, and assumes the remaining tasks run
+        with the same concurrency as the tasks that are running now. Returns
+        None if no task has finished yet."""
+        durations = sorted(
+            t['elapsed']
+            for t in tasks
+            if t['state'] == 'Done' and t['elapsed'] and not t['note'])
+        if not durations:
+            return None
+        med = durations[len(durations) // 2]
+        running = [t for t in tasks if t['state'] == 'Running']
+        pending = len([t for t in tasks if t['state'] == 'Pending'])
+        left = sum(max(0.0, med - (t['elapsed'] or 0)) for t in running)
+        left += pending * med
+        return left / max(1, len(running))
+
+    def report(self, handle):
+        """Write the status of the run."""
+        tasks, summ = self.collect()
+        counts = {st: 0 for st in STATES}
+        for t in tasks:
+            counts[t['state']] += 1
+        handle.write('Run: ' + self.outdir + '\n')
+        handle.write('Checked at ' + datetime.datetime.now().strftime(TS_FMT)
+                     + '\n')
+        handle.write(
+            'Samples: ' + str(len(tasks)) + '  ' +
+            '  '.join(st + ': ' + str(counts[st]) for st in STATES) + '\n')
+        handle.write('Estimated time to finish the array: ' +
+                     _fmt_secs(self.eta(tasks)) + '\n')
+        handle.write('Summary job: ' + summ['job'] + ' ' + summ['state'])
+        if summ['section'] != '-' and summ['state'] != 'Done':
+            handle.write(' (' + summ['section'] + ')')
+        if summ['note']:
+            handle.write(' ' + summ['note'])
+        elif summ['state'] == 'Pending' and counts['Failed'] > 0:
+            # The summary job depends on the whole array finishing OK
+            handle.write(' (will not start until the failed samples are '
+                         'resubmitted)')
+        handle.write('\n')
+        if self.brief:
+            return (counts, summ)
+        handle.write('\n')
+        rows = [['Index', 'Sample', 'Job', 'State', 'Section', 'Elapsed',
+                 'Note']]
+        for t in tasks:
+            rows.append([
+                str(t['index']), t['sample'], t['job'], t['state'],
+                t['section'], _fmt_secs(t['elapsed']), t['note']])
+        widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+        for r in rows:
+            handle.write(
+                '  '.join(v.ljust(w) for v, w in zip(r, widths)).rstrip() +
+                '\n')
+        return (counts, summ)
+
+    def run(self):
+        """Print the status once, or repeatedly in watch mode. Watch mode
+        stops when every task and the summary job have finished, or when a
+        task has failed and the summary job will never start."""
+        if not self.watch:
+            self.report(sys.stdout)
+            return
+        try:
+            while True:
+                if sys.stdout.isatty():
+                    # Clear the terminal and move the cursor to the top
+                    sys.stdout.write('\033[2J\033[H')
+                counts, summ = self.report(sys.stdout)
+                sys.stdout.flush()
+                if counts['Running'] == 0 and counts['Pending'] == 0:
+                    if summ['state'] in ('Done', 'Failed') or \
+                            counts['Failed'] > 0:
+                        break
+                time.sleep(self.watch)
+        except KeyboardInterrupt:
+            pass
+        return
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""Functions for finding and reading the files that a bulk RNAseq run leaves
+in its output directory: the samplesheet, the array key, the pipeline script,
+and the Slurm output and error files. These are shared by the subcommands that
+inspect or act on a run that has already been set up."""
+
+import os
+import re
+
+from CHURPipelines import DieGracefully
+from CHURPipelines.FileOps import sheet_format
+
+# Slurm writes the job logs with these names; see the -o and -e options in
+# BulkRNAseq.qsub()
+SINGLE_ERR_RE = re.compile(
+    r'^bulk_rnaseq_single_sample-([0-9]+)\.([0-9]+)\.err$')
+SUMMARY_ERR_RE = re.compile(r'^run_summary_stats-([0-9]+)\.err$')
+
+# Each pipeline script adds a line with the IDs of the jobs that it started to
+# this file in the output directory: the single sample, shard, and gather
+# arrays and the summary job. Jobs that were not started are empty.
+JOB_IDS = 'bulk_rnaseq_job_ids.txt'
+JOB_KINDS = ['single', 'shard', 'gather', 'summary']
+
+
+def find_run_files(outdir, l):
+    """Return a dictionary with the paths to the samplesheet, array key, and
+    pipeline script of the run in an output directory. If the directory was
+    used for more than one run, the newest files are used."""
+    newest = {}
+    suffixes = {
+        'samplesheet': '.bulk_rnaseq.samplesheet.txt',
+        'keyfile': '.bulk_rnaseq.qsub_array.txt',
+        'pipeline': '.bulk_rnaseq.pipeline.sh'
+        }
+    try:
+        entries = list(os.scandir(outdir))
+    except OSError:
+        DieGracefully.die_gracefully(
+            DieGracefully.BAD_RUNDIR, outdir, 'the directory itself')
+    for e in entries:
+        for ftype, suf in suffixes.items():
+            if e.name.endswith(suf) and e.is_file():
+                mt = e.stat().st_mtime
+                if ftype not in newest or mt > newest[ftype][0]:
+                    newest[ftype] = (mt, e.path)
+    for ftype in ['samplesheet', 'keyfile']:
+        if ftype not in newest:
+            DieGracefully.die_gracefully(
+                DieGracefully.BAD_RUNDIR, outdir, 'a ' + ftype)
+    run_files = {ftype: newest[ftype][1] for ftype in newest}
+    l.debug('Run files: %s', run_files)
+    return run_files
+
+
+def read_key(keyfile):
+    """Return a list of (array index, sample name) tuples from the array key,
+    in order of the array index."""
+    key = []
+    with open(keyfile, 'rt') as f:
+        for line in f:
+            tmp = line.rstrip('\n').split('\t')
+            if len(tmp) != 2 or not tmp[0].isdigit():
+                continue
+            key.append((int(tmp[0]), tmp[1]))
+    return sorted(key)
+
+
+def read_shard_key(keyfile):
+    """Return a dictionary of the sample names of the shard array tasks,
+    keyed on shard array index. These are the three-column rows of the array
+    key."""
+    shards = {}
+    with open(keyfile, 'rt') as f:
+        for line in f:
+            tmp = line.rstrip('\n').split('\t')
+            if len(tmp) != 3 or not tmp[0].isdigit():
+                continue
+            shards[int(tmp[0])] = tmp[1]
+    return shards
+
+
+def read_job_ids(outdir):
+    """Return a dictionary of the sets of job IDs that the pipeline scripts
+    of a run have started, keyed on the kind of job (see JOB_KINDS). The sets
+    are empty if the run did not record its job IDs."""
+    ids = {kind: set() for kind in JOB_KINDS}
+    try:
+        with open(os.path.join(outdir, JOB_IDS), 'rt') as f:
+            for line in f:
+                tmp = line.rstrip('\n').split('\t')
+                for kind, jid in zip(JOB_KINDS, tmp):
+                    # sbatch --parsable adds the cluster name after a ;
+                    jid = jid.split(';')[0].strip()
+                    if jid:
+                        ids[kind].add(jid)
+    except OSError:
+        pass
+    return ids
+
+
+def read_samplesheet(sheet):
+    """Return a dictionary of the samplesheet rows, keyed on sample name. Each
+    value is a dictionary of the fields of the sample, keyed on column
+    name."""
+    return {r['SampleName']: r for r in sheet_format.read_sheet(sheet)}
+
+
+def job_logs(outdir):
+    """Scan the output directory once for the Slurm error files. Returns a
+    tuple of a dictionary of the newest single sample error file for each
+    array index, as (job ID, path), and the newest summary job error file as
+    (job ID, path), or None if there is no summary job error file yet."""
+    single = {}
+    summary = None
+    for e in os.scandir(outdir):
+        m = SINGLE_ERR_RE.match(e.name)
+        if m:
+            jid, idx = int(m.group(1)), int(m.group(2))
+            if idx not in single or jid > single[idx][0]:
+                single[idx] = (jid, e.path)
+            continue
+        m = SUMMARY_ERR_RE.match(e.name)
+        if m:
+            jid = int(m.group(1))
+            if not summary or jid > summary[0]:
+                summary = (jid, e.path)
+    return (single, summary)
+
+
+def compact_ranges(idx):
+    """Return a Slurm array string (e.g., '3,17,40-42') for a list of
+    integers."""
+    idx = sorted(set(idx))
+    parts = []
+    i = 0
+    while i < len(idx):
+        j = i
+        while j + 1 < len(idx) and idx[j + 1] == idx[j] + 1:
+            j += 1
+        if j > i:
+            parts.append(str(idx[i]) + '-' + str(idx[j]))
+        else:
+            parts.append(str(idx[i]))
+        i = j + 1
+    return ','.join(parts)
@@ -2,6 +2,7 @@
 """Define a sub-class of samplesheet that holds the data for bulk RNAseq
 samples."""
 
+import math
 import os
 import re
 import pprint
@@ -10,6 +11,7 @@ import pandas as pd
 from CHURPipelines import DieGracefully
 from CHURPipelines.SampleSheet import SampleSheet
 from CHURPipelines.ArgHandling import set_verbosity
+from CHURPipelines.FileOps import result_cache
 
 
 class BulkRNASeqSampleSheet(SampleSheet.Samplesheet):
@@ -60,7 +62,6 @@ class BulkRNASeqSampleSheet(SampleSheet.Samplesheet):
             self.useropts['rmdup'] = 'no'
         self.useropts['gtf'] = args['gtf']
         self.useropts['hisat2_idx'] = args['hisat2_idx']
-        self.useropts['hisat2_threads'] = '-p ' + str(args['ppn'])
         self.useropts['hisat2_other'] = '--no-mixed --new-summary'
         # Add flags to the HISAT2 options for strandness
         if args['strand'] == 'RF':
@@ -71,12 +72,41 @@ class BulkRNASeqSampleSheet(SampleSheet.Samplesheet):
             self.useropts['hisat2_other'] += ' --rna-strandness FR'
         elif args['strand'] == 'U':
             self.useropts['strand'] = '0'
+        # If a result cache was requested, keep the options that change the
+        # per-sample outputs but are not columns of the sheet. These go into
+        # the cache key along with the sheet columns.
+        self.use_cache = bool(args['cache_dir'])
+        self.cache_extra = {
+            'SUBSAMPLE': args['subsample'],
+            'RRNA_SCREEN': args['rrna_screen'],
+            'BAM_METRICS': args['bam_metrics']
+            }
+        # Samples with an R1 file larger than this are aligned in shards.
+        # Subsampled runs are small, so they are never sharded.
+        if args['subsample'] > 0:
+            self.shard_bytes = 0
+        else:
+            self.shard_bytes = int(args['shard_size'] * 1024 ** 3)
         # Set the column order to be the columns of the sample sheet. This will
         # eventually become the header of the sheet.
         self.column_order.extend([
             'Group',
             'FastqR1files',
             'FastqR2file',
+            'OutputDir',
+            'WorkingDir',
+            'TRIM',
+            'RMDUP',
+            'trimmomaticOpts',
+            'Hisat2index',
+            'Hisat2Options',
+            'Strand',
+            'AnnotationGTF',
+            'CacheKey',
+            'Shards'])
+        # These columns are set from the command line options, so they are
+        # usually the same for every sample and are written once in the sheet
+        self.run_columns.extend([
             'OutputDir',
             'WorkingDir',
             'TRIM',
@@ -170,8 +200,7 @@ class BulkRNASeqSampleSheet(SampleSheet.Samplesheet):
                     'RMDUP': self.useropts['rmdup'],
                     'trimmomaticOpts': self.finalopts['trimmomatic'],
                     'Hisat2index': self.useropts['hisat2_idx'],
-                    'Hisat2Options': self.useropts['hisat2_threads'] + ' ' +
-                                     self.useropts['hisat2_other'] + ' ' +
+                    'Hisat2Options': self.useropts['hisat2_other'] + ' ' +
                                      self.finalopts['hisat2'],
                     'Strand': self.useropts['strand'],
                     'AnnotationGTF': self.useropts['gtf']
@@ -190,14 +219,44 @@ class BulkRNASeqSampleSheet(SampleSheet.Samplesheet):
                     'RMDUP': self.useropts['rmdup'],
                     'trimmomaticOpts': self.finalopts['trimmomatic'],
                     'Hisat2index': self.useropts['hisat2_idx'],
-                    'Hisat2Options': self.useropts['hisat2_threads'] + ' ' +
-                                     se_hisat2_other + ' ' +
+                    'Hisat2Options': se_hisat2_other + ' ' +
                                      self.finalopts['hisat2'],
                     'Strand': self.useropts['strand'],
                     'AnnotationGTF': self.useropts['gtf']
                     }
+            # The cache key is left empty if caching was not requested. The
+            # single sample script treats an empty key as "do not cache."
+            if self.use_cache:
+                self.final_sheet[s]['CacheKey'] = result_cache.sample_key(
+                    self.final_sheet[s], self.cache_extra, self.sheet_logger)
+            else:
+                self.final_sheet[s]['CacheKey'] = ''
+            self.final_sheet[s]['Shards'] = str(
+                self._shard_count(self.samples[s]['R1']))
         self.sheet_logger.debug(
             'Samplesheet:\n%s',
             pprint.pformat(self.final_sheet))
         # Return the boolean list of PE/SE values. True=PE, False=SE
         return is_pe
+
+    def _shard_count(self, r1):
+        """Return the number of shards to align a sample in, from the size of
+        its R1 file. This is 1 unless sharding was requested and the file is
+        larger than the shard size."""
+        if not self.shard_bytes:
+            return 1
+        try:
+            size = os.path.getsize(r1)
+        except OSError:
+            return 1
+        return max(1, int(math.ceil(size / self.shard_bytes)))
+
+    def shards(self):
+        """Return a list of (sample name, shard number) tuples for the
+        samples that are aligned in shards, in the order of the shard array
+        indices."""
+        return [
+            (s, n + 1)
+            for s in sorted(self.final_sheet)
+            for n in range(int(self.final_sheet[s]['Shards']))
+            if int(self.final_sheet[s]['Shards']) > 1]
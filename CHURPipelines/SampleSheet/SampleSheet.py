@@ -12,6 +12,7 @@ from CHURPipelines import DieGracefully
 from CHURPipelines.FileOps import default_files
 from CHURPipelines.FileOps import default_dirs
 from CHURPipelines.FileOps import dir_funcs
+from CHURPipelines.FileOps import sheet_format
 from CHURPipelines.ArgHandling import bulk_rnaseq_args
 
 
@@ -24,6 +25,7 @@ class Samplesheet(object):
     #   Final (merged) options
     #   Samples to process
     #   Order of the columns
+    #   Columns that can be written once for the whole run
     #   Final sheet dictionary
     programs = []
     useropts = {}
@@ -31,6 +33,7 @@ class Samplesheet(object):
     finalopts = {}
     samples = {}
     column_order = []
+    run_columns = []
     final_sheet = {}
 
     def _resolve_options(self):
@@ -146,31 +149,30 @@ class Samplesheet(object):
                 DieGracefully.die_gracefully(DieGracefully.EMPTY_FASTQ)
         return
 
-    def write_sheet(self, od, pn, delim):
-        """Write the sheet into the given directory."""
+    def write_sheet(self, od, pn):
+        """Write the sheet into the given directory, with the row index that
+        the array jobs use to find their samples."""
         # Define a samplesheet output name
         ssname = default_files.default_samplesheet(pn)
         ssname = os.path.join(od, ssname)
         if os.path.isfile(ssname):
             self.sheet_logger.warning(
                 'Samplesheet %s exists. Overwriting', ssname)
-        # Write the data into the sheet
-        handle = open(ssname, 'w')
-        with open(ssname, 'w') as f:
-            for sample in sorted(self.final_sheet):
-                towrite = [sample] + [
-                    self.final_sheet[sample][c]
-                    for c
-                    in self.column_order]
-                handle.write(delim.join(towrite) + '\n')
-        # Add a new line
-        handle.write('\n')
-        # Add the software version data to the bottom of the samplesheet
-        handle.write('# Generated by CHURP version ' +
-                     CHURPipelines.__version__ + '\n')
-        handle.write('# Generated at ' + CHURPipelines.NOW + '\n')
-        # And write the major version as a comment for the PBS script to parse
-        handle.write('#' + CHURPipelines.__version__.split('.')[0] + '\n')
-        handle.flush()
-        handle.close()
+        # The rows are in the same order as the array key, so the row of a
+        # sample is found by its array index
+        rows = []
+        for sample in sorted(self.final_sheet):
+            row = {'SampleName': sample}
+            row.update(self.final_sheet[sample])
+            rows.append(row)
+        # Add the software version data to the top of the samplesheet
+        per_sample = sheet_format.write_sheet(
+            ssname,
+            ['SampleName'] + self.column_order,
+            rows,
+            self.run_columns,
+            ['Generated by CHURP version ' + CHURPipelines.__version__,
+             'Generated at ' + CHURPipelines.NOW])
+        self.sheet_logger.debug(
+            'Per-sample columns of the samplesheet: %s', per_sample)
         return ssname
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Define a sub-class of the Scheduler class that runs the jobs on the local
+machine. The single sample script is run for each sample in a bounded pool of
+processes, and the summary script is run when all samples have finished. This
+is for small projects on a workstation, and for testing the pipeline without
+a cluster."""
+
+import os
+import sys
+
+from CHURPipelines import DieGracefully
+from CHURPipelines.Schedulers import Scheduler
+
+
+class LocalScheduler(Scheduler.Scheduler):
+    """Sub-class of Scheduler for the local machine."""
+
+    name = 'local'
+    blocking = True
+
+    def __init__(self, args):
+        """Initialize the local scheduler. The total number of cores to use
+        defaults to all cores of the machine."""
+        Scheduler.Scheduler.__init__(self, args)
+        if args['max_cores']:
+            self.max_cores = args['max_cores']
+        else:
+            self.max_cores = os.cpu_count() or 1
+        try:
+            assert self.max_cores >= 1
+        except AssertionError:
+            DieGracefully.die_gracefully(
+                DieGracefully.BAD_NUMBER, '--max-cores')
+        if self.ppn > self.max_cores:
+            self.sched_logger.error(
+                'PPN value of %i is more than the %i cores available!',
+                self.ppn, self.max_cores)
+            DieGracefully.die_gracefully(DieGracefully.BAD_RESOURCES)
+        # The executor is run from the CHURP installation that wrote the
+        # pipeline script (CHURP_DIR), with the same Python interpreter
+        self.python = sys.executable
+        self.sched_logger.debug(
+            'Local scheduler: %i cores, %i per job',
+            self.max_cores, self.ppn)
+        return
+
+    def preamble(self):
+        """Write the path to the Python interpreter."""
+        return ['CHURP_PYTHON="' + self.python + '"']
+
+    def epilogue(self):
+        """Tell the user that the jobs have finished."""
+        return ['echo "All jobs finished on $(hostname)"']
+
+    def _executor(self, mode, out, err, resources=None):
+        """Return the executor options that are common to all jobs."""
+        res = self._resources(resources)
+        return [
+            'PYTHONPATH="${CHURP_DIR}"',
+            '"${CHURP_PYTHON}"',
+            '-m', 'CHURPipelines.Schedulers.local_executor',
+            mode,
+            '-o', out,
+            '-e', err,
+            '-c', str(res['ppn']),
+            '--mem=' + str(res['mem']),
+            '--max-cores', str(self.max_cores),
+            '--time=' + str(res['walltime'] * 60)]
+
+    def array_cmd(
+            self, script, export_vars, out, err, resources=None,
+            array_var='QSUB_ARRAY', depend=None):
+        """Return the executor command for a job array. Like single jobs,
+        the arrays run in the order of the script, so depend is not
+        passed."""
+        return self._executor('array', out, err, resources) + [
+            '--array="${' + array_var + '}"',
+            '--export=' + export_vars,
+            script,
+            '||',
+            'exit',
+            '1']
+
+    def job_cmd(
+            self, script, export_vars, out, err, depend=None, resources=None):
+        """Return the executor command for a single job. The jobs run one
+        after the other, so the dependency is always met by the time the job
+        starts. We do not need to pass it."""
+        return self._executor('job', out, err, resources) + [
+            '--export=' + export_vars,
+            script,
+            '||',
+            'exit',
+            '1']
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Define a general Scheduler object. A scheduler turns the single sample and
+summary scripts into the commands that the pipeline script uses to run them.
+The sub-classes write commands for a specific backend, e.g., Slurm or the
+local machine. Schedulers must define array_cmd and job_cmd."""
+
+import abc
+
+from CHURPipelines.ArgHandling import set_verbosity
+
+
+class Scheduler(abc.ABC):
+    """Define the Scheduler object."""
+
+    # The name of the scheduler, as given to the --scheduler option
+    name = ''
+    # Whether running the pipeline script waits for all jobs to finish. This
+    # is False for batch schedulers, which return once the jobs are queued.
+    blocking = False
+
+    def __init__(self, args):
+        """Initialize the scheduler with the resource requests for each
+        job."""
+        self.sched_logger = set_verbosity.verb(args['verbosity'], __name__)
+        self.queue = args['msi_queue']
+        self.group = args['pbs_group']
+        self.ppn = args['ppn']
+        self.mem = args['mem']
+        self.tmp_space = args['tmp_space']
+        self.walltime = args['walltime']
+        return
+
+    def _resources(self, resources=None):
+        """Return the resource requests for a job: the defaults from the
+        command line, updated with any requests from its job spec."""
+        res = {
+            'ppn': self.ppn,
+            'mem': self.mem,
+            'tmp_space': self.tmp_space,
+            'walltime': self.walltime
+            }
+        res.update(resources or {})
+        return res
+
+    def preamble(self):
+        """Return a list of lines to write into the pipeline script before
+        the header variables."""
+        return []
+
+    def checks(self):
+        """Return a list of lines to write into the pipeline script before
+        any jobs are run. These should exit if the environment is not right
+        for the scheduler."""
+        return []
+
+    def epilogue(self):
+        """Return a list of lines to write at the end of the pipeline script,
+        after the job IDs are printed."""
+        return []
+
+    @abc.abstractmethod
+    def array_cmd(
+            self, script, export_vars, out, err, resources=None,
+            array_var='QSUB_ARRAY', depend=None):
+        """Return the command, as a list, that runs a script for each index in
+        the array list in the variable array_var, after the jobs in depend
+        (colon-separated job IDs) finish successfully. The command should
+        print the job ID to stdout. The out and err arguments are Slurm-style
+        log name patterns, and resources overrides the default resource
+        requests."""
+        return []
+
+    @abc.abstractmethod
+    def job_cmd(
+            self, script, export_vars, out, err, depend=None, resources=None):
+        """Return the command, as a list, that runs a script once, after the
+        jobs in depend (colon-separated job IDs) finish successfully. The
+        command should print the job ID to stdout."""
+        return []
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Define a sub-class of the Scheduler class that submits jobs to Slurm with
+sbatch. This is the default scheduler, for running on the MSI clusters."""
+
+from CHURPipelines.Schedulers import Scheduler
+
+
+class SlurmScheduler(Scheduler.Scheduler):
+    """Sub-class of Scheduler for Slurm."""
+
+    name = 'slurm'
+    blocking = False
+
+    def preamble(self):
+        """Write the command to figure out the email address of the
+        submitting user."""
+        return [
+            'user_name="$(id -u -n)"',
+            'user_email="${user_name}@umn.edu"']
+
+    def checks(self):
+        """Write some logic to detect if we are running in a job allocation.
+        Quit the bash script if it is."""
+        return [
+            'if [ ! -z "${SLURM_JOB_ID+NULL}" ]',
+            '    then echo "You should run this script with \'bash\' from outside of a job allocation." > /dev/stderr',
+            '    exit 99',
+            'fi']
+
+    def epilogue(self):
+        """Tell the user where the job emails will go."""
+        return ['echo "Emails will be sent to ${user_email}"']
+
+    def _sbatch(self, out, err, resources=None):
+        """Return the sbatch options that are common to all jobs."""
+        res = self._resources(resources)
+        # Set the group string here
+        if self.group:
+            qsub_group = '-A ' + self.group
+        else:
+            qsub_group = ''
+        return [
+            'sbatch',
+            '--parsable',
+            '--ignore-pbs',
+            '-p', self.queue,
+            '--mail-type=BEGIN,END,FAIL',
+            '--mail-user="${user_email}"',
+            qsub_group,
+            '-o', out,
+            '-e', err,
+            '-N', '1',
+            '--mem=' + str(res['mem']) + 'mb',
+            '--tmp=' + str(res['tmp_space']) + 'mb',
+            '-n', '1',
+            '-c', str(res['ppn']),
+            '--time=' + str(res['walltime'] * 60)]
+
+    def array_cmd(
+            self, script, export_vars, out, err, resources=None,
+            array_var='QSUB_ARRAY', depend=None):
+        """Return the sbatch command for a job array."""
+        cmd = self._sbatch(out, err, resources)
+        if depend:
+            cmd.append('--depend=afterok:' + depend)
+        return cmd + [
+            '--array="${' + array_var + '}"',
+            '--export=' + export_vars,
+            script,
+            '||',
+            'exit',
+            '1']
+
+    def job_cmd(
+            self, script, export_vars, out, err, depend=None, resources=None):
+        """Return the sbatch command for a single job."""
+        cmd = self._sbatch(out, err, resources)
+        if depend:
+            cmd.append('--depend=afterok:' + depend)
+        return cmd + [
+            '--export=' + export_vars,
+            script,
+            '||',
+            'exit',
+            '1']
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""Run the single sample and summary scripts on the local machine. This is
+called by pipeline scripts that were written with "--scheduler local", as
+
+    python -m CHURPipelines.Schedulers.local_executor array [options] script
+    python -m CHURPipelines.Schedulers.local_executor job [options] script
+
+and takes a subset of the sbatch options. Array tasks are run in a pool of at
+most --max-cores / -c processes at a time. The jobs get the same environment
+variables that Slurm would set, and write their output into the same log
+files, so the status and resubmit subcommands work on local runs as well. The
+job ID is printed to stdout, and the exit status is non-zero if any task
+failed."""
+
+import argparse
+import datetime
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# Seconds between checks on the running tasks
+POLL_INTERVAL = 1
+# Seconds to wait after SIGTERM before killing a task that hit its time limit
+KILL_WAIT = 30
+# Job IDs are the time in seconds times this, plus the process ID. It is
+# larger than the largest process ID that Linux hands out (2^22).
+PID_SPAN = 10000000
+
+
+def parse_array(spec):
+    """Return a sorted list of indices from a Slurm array specification, e.g.,
+    '1-4,7'. Raises ValueError if the specification cannot be read."""
+    idx = set()
+    for part in spec.split(','):
+        if '-' in part:
+            start, end = part.split('-', 1)
+            idx.update(range(int(start), int(end) + 1))
+        else:
+            idx.add(int(part))
+    return sorted(idx)
+
+
+def parse_export(spec):
+    """Return a dictionary of variables from a Slurm --export value, e.g.,
+    'A=x,B=y'. The ALL and NONE keywords are ignored; the jobs always get the
+    environment of the executor."""
+    env = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        key, val = item.split('=', 1)
+        env[key] = val
+    return env
+
+
+def log_name(pattern, job_id, task=None):
+    """Fill in the Slurm filename patterns in a log file name."""
+    name = pattern.replace('%%', '\0')
+    name = name.replace('%A', str(job_id)).replace('%j', str(job_id))
+    if task is not None:
+        name = name.replace('%a', str(task))
+    return name.replace('\0', '%')
+
+
+def task_env(args, job_id, task=None):
+    """Return the environment for one job, with the variables that the
+    scripts expect from Slurm."""
+    env = dict(os.environ)
+    # Do not let array variables from an enclosing job leak into the tasks
+    for key in ['SLURM_ARRAY_JOB_ID', 'SLURM_ARRAY_TASK_ID']:
+        env.pop(key, None)
+    env.update(parse_export(args.export))
+    env['CHURP_SCHEDULER'] = 'local'
+    env['SLURM_JOB_ID'] = str(job_id)
+    env['SLURM_CPUS_PER_TASK'] = str(args.cpus)
+    if args.mem > 0:
+        env['SLURM_MEM_PER_NODE'] = str(args.mem)
+    if task is not None:
+        env['SLURM_ARRAY_JOB_ID'] = str(job_id)
+        env['SLURM_ARRAY_TASK_ID'] = str(task)
+    return env
+
+
+def start_task(script, env, out, err):
+    """Start the script in its own process group, so that it can be stopped
+    along with the programs that it runs."""
+    with open(out, 'ab') as out_h, open(err, 'ab') as err_h:
+        proc = subprocess.Popen(
+            ['bash', script],
+            stdin=subprocess.DEVNULL,
+            stdout=out_h,
+            stderr=err_h,
+            env=env,
+            start_new_session=True)
+    return proc
+
+
+def stop_task(proc):
+    """Send SIGTERM to the process group of a task, and SIGKILL if it is still
+    running after KILL_WAIT seconds."""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=KILL_WAIT)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+    return
+
+
+def run_tasks(tasks, slots, time_limit):
+    """Run a list of (label, script, env, out, err) tasks with at most slots
+    of them at a time. Tasks that run longer than time_limit seconds are
+    stopped, and a Slurm-style time limit message is written into their error
+    file. Returns a dictionary of exit status, keyed on label."""
+    queue = list(tasks)
+    running = {}
+    status = {}
+    try:
+        while queue or running:
+            while queue and len(running) < slots:
+                label, script, env, out, err = queue.pop(0)
+                sys.stderr.write('Starting ' + label + '\n')
+                proc = start_task(script, env, out, err)
+                running[label] = (proc, time.time(), err)
+            time.sleep(POLL_INTERVAL)
+            for label in list(running):
+                proc, started, err = running[label]
+                if proc.poll() is None:
+                    if time_limit and time.time() - started > time_limit:
+                        stop_task(proc)
+                        with open(err, 'at') as err_h:
+                            err_h.write(
+                                'slurmstepd: error: *** JOB ' + label +
+                                ' ON ' + socket.gethostname() +
+                                ' CANCELLED AT ' +
+                                datetime.datetime.now().isoformat(
+                                    timespec='seconds') +
+                                ' DUE TO TIME LIMIT ***\n')
+                    else:
+                        continue
+                status[label] = proc.returncode
+                del running[label]
+                sys.stderr.write(
+                    'Finished ' + label + ' with exit status ' +
+                    str(proc.returncode) + '\n')
+    except KeyboardInterrupt:
+        sys.stderr.write('Interrupted; stopping running tasks\n')
+        for proc, started, err in running.values():
+            stop_task(proc)
+        sys.exit(130)
+    return status
+
+
+def parse_args():
+    """Parse the sbatch-like arguments of the executor."""
+    ap = argparse.ArgumentParser(
+        description='Run CHURP jobs on the local machine.')
+    modes = ap.add_subparsers(dest='mode')
+    modes.required = True
+    array = modes.add_parser('array', help='Run a script for each index.')
+    job = modes.add_parser('job', help='Run a script once.')
+    array.add_argument(
+        '--array',
+        dest='array',
+        help='Slurm-style array indices, e.g., 1-4,7',
+        required=True)
+    for p in [array, job]:
+        p.add_argument('-o', dest='out', help='Output log name pattern.',
+                       required=True)
+        p.add_argument('-e', dest='err', help='Error log name pattern.',
+                       required=True)
+        p.add_argument('-c', dest='cpus', help='Cores for each job.',
+                       type=int, default=1)
+        p.add_argument('--max-cores', dest='max_cores',
+                       help='Total cores to use for all jobs.',
+                       type=int, default=os.cpu_count() or 1)
+        p.add_argument('--mem', dest='mem',
+                       help=('Memory of each job, in MB. It is not enforced, '
+                             'but the jobs size their tools to it.'),
+                       type=int, default=0)
+        p.add_argument('--time', dest='time',
+                       help='Time limit of each job, in minutes. 0 for none.',
+                       type=int, default=0)
+        p.add_argument('--export', dest='export',
+                       help='Variables to set, as VAR=value,VAR=value',
+                       default='')
+        p.add_argument('script', help='Script to run.')
+    return ap.parse_args()
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    script = os.path.realpath(args.script)
+    # Use the time as the job ID, so that it increases from one run to the
+    # next like a Slurm job ID. Two runs that start in the same second are
+    # told apart by their process IDs.
+    job_id = int(time.time()) * PID_SPAN + os.getpid() % PID_SPAN
+    sys.stdout.write(str(job_id) + '\n')
+    sys.stdout.flush()
+    slots = max(1, args.max_cores // max(1, args.cpus))
+    time_limit = args.time * 60
+    if args.mode == 'array':
+        try:
+            indices = parse_array(args.array)
+        except ValueError:
+            sys.stderr.write('Could not read array indices ' + args.array +
+                             '\n')
+            sys.exit(2)
+        sys.stderr.write(
+            'Running ' + str(len(indices)) + ' tasks of ' + script + ', ' +
+            str(slots) + ' at a time\n')
+        tasks = []
+        for i in indices:
+            tasks.append((
+                str(job_id) + '_' + str(i),
+                script,
+                task_env(args, job_id, i),
+                log_name(args.out, job_id, i),
+                log_name(args.err, job_id, i)))
+    else:
+        tasks = [(
+            str(job_id),
+            script,
+            task_env(args, job_id),
+            log_name(args.out, job_id),
+            log_name(args.err, job_id))]
+    status = run_tasks(tasks, slots, time_limit)
+    failed = [label for label in status if status[label] != 0]
+    if failed:
+        sys.stderr.write(
+            str(len(failed)) + ' of ' + str(len(status)) + ' jobs failed: ' +
+            ' '.join(sorted(failed)) + '\n')
+        sys.exit(1)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Render pipeline scripts from a template and a list of job specs. Each job
+spec says which script to run, whether it is an array, what to export into it,
+which other jobs it waits for, and any resources that differ from the defaults
+of the scheduler. The scheduler turns each spec into a command, and the
+commands are put into the template in order. Rendering does not touch the file
+system, so the same specs always give the same script.
+
+Templates are plain bash with two kinds of placeholders. @name in a line is
+replaced by a value if name is one of the values that are given to render(),
+and any other @ is left as it is, so that "${arr[@]}" and email addresses can
+be used in a template. A line that is only @name is replaced by a block of
+lines, and is dropped if the block is empty. The blocks are:
+
+    @preamble   Scheduler setup lines, e.g., the email address of the user
+    @variables  NAME="value" lines for the header variables
+    @checks     Scheduler checks that are run before any jobs
+    @jobs       The commands that start the jobs
+    @epilogue   Scheduler lines for the end of the script"""
+
+import re
+
+# The blocks that are filled in from the scheduler and the job specs
+BLOCKS = ['preamble', 'variables', 'checks', 'jobs', 'epilogue']
+
+
+class JobSpec(object):
+    """A job, or a job array, in a pipeline script."""
+
+    def __init__(
+            self, name, script, exports, out, err, array=False, depend=None,
+            skip_if=None, resources=None):
+        """Define a job. name is used for the variable that holds the job ID
+        (<name>_id). exports is a list of NAME="value" strings, out and err
+        are Slurm-style log name patterns, and depend is a list of the names
+        of the jobs that have to finish first. If skip_if is a bash condition,
+        the job is not started when it is true, and the jobs that depend on
+        it start without waiting for it. resources is a dictionary of
+        resource requests (ppn, mem, tmp_space, walltime) for this job that
+        override the defaults of the scheduler. array is True for an array
+        over the indices in ${QSUB_ARRAY}, or the name of another variable
+        that holds the array indices."""
+        self.name = name
+        self.script = script
+        self.exports = exports
+        self.out = out
+        self.err = err
+        self.array = array
+        self.depend = depend or []
+        self.skip_if = skip_if
+        self.resources = resources or {}
+        return
+
+    def id_var(self):
+        """Return the name of the variable that holds the job ID."""
+        return self.name + '_id'
+
+    def command(self, scheduler, skipped=()):
+        """Return the command, as a list, that starts the job. Dependencies
+        on jobs in skipped are left out."""
+        export_vars = ','.join(self.exports)
+        depend = ':'.join(
+            '${' + d + '_id}' for d in self.depend if d not in skipped)
+        if self.array:
+            if self.array is True:
+                array_var = 'QSUB_ARRAY'
+            else:
+                array_var = self.array
+            return scheduler.array_cmd(
+                self.script, export_vars, self.out, self.err,
+                resources=self.resources, array_var=array_var,
+                depend=depend or None)
+        return scheduler.job_cmd(
+            self.script, export_vars, self.out, self.err,
+            depend=depend or None, resources=self.resources)
+
+
+def job_lines(jobs, scheduler, skipped=(), indent=''):
+    """Return the lines that start the jobs. Jobs with a skip_if condition
+    are put into an if/else block with the jobs that do not depend on the
+    condition. Each distinct condition adds one level of if/else."""
+    conds = []
+    for j in jobs:
+        if j.skip_if and j.skip_if not in conds and j.name not in skipped:
+            conds.append(j.skip_if)
+    if not conds:
+        return [
+            indent + j.id_var() + '=$(' +
+            ' '.join(j.command(scheduler, skipped)) + ')'
+            for j in jobs
+            if j.name not in skipped]
+    # Jobs under the other conditions are handled one level down
+    cond = conds[0]
+    skip_now = set(skipped) | set(j.name for j in jobs if j.skip_if == cond)
+    lines = [indent + 'if ' + cond, indent + 'then']
+    lines.extend(job_lines(jobs, scheduler, skip_now, indent + '    '))
+    lines.append(indent + 'else')
+    lines.extend(job_lines(
+        [j if j.skip_if != cond else _unconditional(j) for j in jobs],
+        scheduler, skipped, indent + '    '))
+    lines.append(indent + 'fi')
+    return lines
+
+
+def _unconditional(j):
+    """Return a copy of a job spec without its skip_if condition."""
+    return JobSpec(
+        j.name, j.script, j.exports, j.out, j.err, array=j.array,
+        depend=j.depend, resources=j.resources)
+
+
+def render(template, scheduler, variables, jobs, values=None):
+    """Render a pipeline script. variables is a list of (name, value) tuples
+    for the header variables, jobs is a list of JobSpec in the order they are
+    started, and values is a dictionary of the inline @name values. Returns
+    the text of the script."""
+    values = values or {}
+    # Only the names that have values are placeholders
+    if values:
+        inline = re.compile(
+            '@(' + '|'.join(re.escape(k) for k in values) + r')\b')
+    else:
+        inline = None
+    blocks = {
+        'preamble': scheduler.preamble(),
+        'variables': [n + '="' + v + '"' for n, v in variables],
+        'checks': scheduler.checks(),
+        'jobs': job_lines(jobs, scheduler),
+        'epilogue': scheduler.epilogue()
+        }
+    out = []
+    for line in template.split('\n'):
+        if line.startswith('@') and line[1:] in BLOCKS:
+            out.extend(blocks[line[1:]])
+        elif inline:
+            out.append(inline.sub(lambda m: values[m.group(1)], line))
+        else:
+            out.append(line)
+    return '\n'.join(out)
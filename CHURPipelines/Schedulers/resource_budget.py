@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Divide the memory and cores of a single sample job among the tools that it
+runs. The single sample script runs its steps side by side when there are
+enough free cores and memory for them, so each step is given a memory
+reservation, and the tools whose footprint can be set (the Java heaps of BBDuk
+and Picard, and the sort buffer of samtools) are sized to fit in their
+reservation. The job computes its budget when it starts, from the memory and
+cores that it was given, so that a job that was resubmitted with more memory
+uses it. This is called by the single sample script as
+
+    python -m CHURPipelines.Schedulers.resource_budget --mem MB --cpus N
+
+and prints the budget as shell variable assignments. The pipeline uses
+MIN_MEM_MB to check --mem before the jobs are written."""
+
+import argparse
+import sys
+
+# Memory (MB) that is kept out of the budget for the job script, the step
+# runner, and the page cache
+RESERVE_MB = 1000
+# Memory (MB) that a JVM uses on top of its heap
+JVM_OVERHEAD_MB = 1000
+# HISAT2 holds the genome index in memory, so it needs the same amount of
+# memory for any --mem. This is enough for the human and mouse indices.
+HISAT2_MB = 8000
+# BBDuk preallocates its k-mer table to fill the heap. The SILVA k-mers fit in
+# 10 GB, and more than 19 GB does not make it any faster.
+BBDUK_MIN_HEAP_MB = 10000
+BBDUK_MAX_HEAP_MB = 19000
+# Picard only keeps a fixed number of records in memory, so a big heap mostly
+# helps MarkDuplicates with samples that have many read pairs
+PICARD_MIN_HEAP_MB = 2000
+PICARD_MAX_HEAP_MB = 16000
+# Smallest sort buffer (MB) for each samtools sort thread. Threads that would
+# get less than this are not used.
+SORT_MIN_THREAD_MB = 256
+# samtools sort uses a bit more than its buffers, so only part of the
+# reservation of the sorting step is given to them
+SORT_BUFFER_FRACTION = 0.75
+# The smallest --mem that holds the largest fixed step and the smallest BBDuk
+# heap. RNASeQC needs as much as HISAT2.
+MIN_MEM_MB = RESERVE_MB + max(
+    HISAT2_MB,
+    BBDUK_MIN_HEAP_MB + JVM_OVERHEAD_MB,
+    PICARD_MIN_HEAP_MB + JVM_OVERHEAD_MB)
+
+
+class ResourceBudget(object):
+    """The cores and memory of one single sample job, divided among its
+    steps."""
+
+    def __init__(self, mem_mb, cpus):
+        # Jobs that do not know their memory get the smallest budget
+        if mem_mb <= 0:
+            mem_mb = MIN_MEM_MB
+        self.mem_mb = mem_mb
+        self.cpus = max(1, cpus)
+        self.steps_mb = mem_mb - RESERVE_MB
+        # The steps on the way to the counts can use all but two cores, and
+        # those that can share the node start with half of them
+        self.half_cpu = max(1, self.cpus // 2)
+        self.big_cpu = self.cpus - 2 if self.cpus > 4 else self.cpus
+        # Give BBDuk a heap that lets it run alongside HISAT2 if that leaves
+        # it enough room. Otherwise, it runs by itself with what there is.
+        heap = min(
+            BBDUK_MAX_HEAP_MB,
+            self.steps_mb - HISAT2_MB - JVM_OVERHEAD_MB)
+        if heap < BBDUK_MIN_HEAP_MB:
+            heap = min(BBDUK_MAX_HEAP_MB, self.steps_mb - JVM_OVERHEAD_MB)
+        self.bbduk_heap_mb = max(heap, 0)
+        # Picard and samtools sort each get half of the memory, so that they
+        # can run next to the steps that are still going
+        self.picard_heap_mb = min(
+            PICARD_MAX_HEAP_MB,
+            max(PICARD_MIN_HEAP_MB, self.steps_mb // 2 - JVM_OVERHEAD_MB))
+        self.sort_mb = self.steps_mb // 2
+        self.sort_buffer_mb = int(self.sort_mb * SORT_BUFFER_FRACTION)
+        self.sort_cpu = max(
+            1, min(self.big_cpu, self.sort_buffer_mb // SORT_MIN_THREAD_MB))
+
+    def shell_vars(self):
+        """Return the budget as a list of (name, value) pairs, in the names
+        that the single sample script uses."""
+        return [
+            ('HALF_CPU', self.half_cpu),
+            ('BIG_CPU', self.big_cpu),
+            ('SORT_CPU', self.sort_cpu),
+            ('STEPS_MB', self.steps_mb),
+            ('HISAT2_MB', HISAT2_MB),
+            ('BBDUK_HEAP_MB', self.bbduk_heap_mb),
+            ('BBDUK_MB', self.bbduk_heap_mb + JVM_OVERHEAD_MB),
+            ('PICARD_HEAP_MB', self.picard_heap_mb),
+            ('PICARD_MB', self.picard_heap_mb + JVM_OVERHEAD_MB),
+            ('SORT_MB', self.sort_mb),
+            ('SORT_BUFFER_MB', self.sort_buffer_mb)]
+
+
+def main():
+    """Parse the arguments and print the budget."""
+    parser = argparse.ArgumentParser(
+        description=(
+            'Print the memory and cores of each tool in a single sample job '
+            'as shell variable assignments.'))
+    parser.add_argument(
+        '--mem', type=int, default=0,
+        help='Memory of the job, in MB. 0 if it is not known.')
+    parser.add_argument(
+        '--cpus', type=int, default=1, help='Cores of the job.')
+    args = parser.parse_args()
+    budget = ResourceBudget(args.mem, args.cpus)
+    for name, value in budget.shell_vars():
+        sys.stdout.write(name + '="' + str(value) + '"\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""Collate the per-sample summary files of a bulk RNAseq run into the tables
+in the allsamples directory that the HTML report reads. This is run by the
+summary job as
+
+    python3 -m CHURPipelines.Summary.collate --workdir <working directory>
+
+The single sample directories are listed once, and the summary files of each
+sample are read in a pool of threads, because most of the time is spent
+waiting on the file system. The tables are then written in sample order. With
+--bundle, the tables and the per-base quality summaries of every sample are
+also written into one SQLite file for the report. This module should only use
+the standard library, because it runs in the summary job environment, not the
+environment that CHURP was run from."""
+
+import argparse
+import concurrent.futures
+import os
+import re
+import sys
+
+from CHURPipelines.Summary import report_bundle
+
+# The tables that are written into the allsamples directory, in the order
+# that they are written
+TABLES = [
+    'Read_Counts.txt',
+    'Samtools_Stats.txt',
+    'HISAT_Stats.txt',
+    'IS_Stats.txt',
+    'RNASeq_Metrics.txt',
+    'RNASeq_Metrics_Unstranded.txt',
+    'rRNA_kmers.txt']
+
+# Tables that are only written if at least one sample has data for them. The
+# report checks for these files, e.g., there are no insert sizes if all
+# samples are single-end.
+OPTIONAL_TABLES = ['IS_Stats.txt']
+
+# How R's read.table() splits the lines of each table in the report. None is
+# any whitespace.
+TABLE_SEP = {
+    'RNASeq_Metrics.txt': '\t',
+    'RNASeq_Metrics_Unstranded.txt': '\t'}
+
+# The columns of the per-base quality summaries from FastQC
+QUAL_COLUMNS = ['Base', 'QMean', 'QMedian', 'Q25', 'Q75', 'Q10', 'Q90']
+
+# The 'SN' fields of the samtools stats output that are reported, in order
+BAMSTAT_FIELDS = [
+    'raw total sequences',
+    'reads duplicated',
+    'reads MQ0',
+    'maximum length',
+    'average length',
+    'average quality']
+
+
+def version_key(s):
+    """Return a key for sorting strings with embedded numbers in natural
+    order, like 'sort -V'."""
+    return [
+        (0, int(tok), '') if tok.isdigit() else (1, 0, tok)
+        for tok in re.split(r'([0-9]+)', s)
+        if tok]
+
+
+def read_text(path):
+    """Return the contents of a file, or None if it cannot be read."""
+    try:
+        with open(path, 'rt') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def last_fields(text):
+    """Return the last whitespace-delimited field of each line of the text,
+    as awk '{print $NF}' does, joined with newlines."""
+    return '\n'.join(
+        line.split()[-1] if line.split() else ''
+        for line in text.rstrip('\n').split('\n'))
+
+
+def find_count(names, suffix):
+    """Return the name of the read count file that ends with the suffix, or
+    None if there is not one."""
+    hits = sorted(n for n in names if n.endswith(suffix))
+    if hits:
+        return hits[0]
+    return None
+
+
+def collate_sample(sampledir, sample):
+    """Read the summary files of one sample. Returns a dictionary of the
+    lines to add to each table, keyed on table name, and a list of the rows
+    of the per-base quality summaries."""
+    rows = {t: '' for t in TABLES}
+    names = set(e.name for e in os.scandir(sampledir) if e.is_file())
+
+    def path(n):
+        return os.path.join(sampledir, n)
+
+    # Read counts before and after trimming. Missing R2 and trimmed counts
+    # are NA.
+    counts = []
+    for suffix in ['1.raw_readcount.txt', '2.raw_readcount.txt',
+                   '1.trimmed_readcount.txt', '2.trimmed_readcount.txt']:
+        fname = find_count(names, suffix)
+        text = read_text(path(fname)) if fname else None
+        if text is None:
+            counts.append('NA')
+        else:
+            counts.append(last_fields(text))
+    rows['Read_Counts.txt'] = '\t'.join([sample] + counts) + '\n'
+    # The HISAT2 summary is already one line with the sample name
+    text = read_text(path('hisat_map_summary.txt'))
+    if text:
+        rows['HISAT_Stats.txt'] = text
+    # Alignment summary from samtools stats
+    text = read_text(path(sample + '_bamstats.txt')) or ''
+    sn = [line for line in text.split('\n') if line.startswith('SN')]
+    vals = []
+    for field in BAMSTAT_FIELDS:
+        vals.append('\n'.join(
+            (line.split('\t') + ['', '', ''])[2]
+            for line in sn
+            if field in line))
+    rows['Samtools_Stats.txt'] = '\t'.join([sample] + vals) + '\n'
+    # The BBDuk rRNA screen stats
+    text = read_text(path('BBDuk_rRNA_Stats.txt')) or ''
+    matched = '\n'.join(
+        '\t'.join(line.split('\t')[1:3])
+        for line in text.split('\n')
+        if '#Matched' in line)
+    rows['rRNA_kmers.txt'] = sample + '\t' + matched + '\n'
+    # Insert size summaries, only for paired-end samples
+    if 'IS_Stats.txt' in names:
+        text = read_text(path('IS_Stats.txt')) or ''
+        rows['IS_Stats.txt'] = sample + '\t' + text.rstrip('\n') + '\n'
+    # And the RNASeQC metrics, without their header lines. These are
+    # optional.
+    for table, fname in [
+            ('RNASeq_Metrics.txt', sample + '.metrics.tsv'),
+            ('RNASeq_Metrics_Unstranded.txt',
+             sample + '_Unstranded.metrics.tsv')]:
+        text = read_text(os.path.join(sampledir, 'RNASeQC_Out', fname))
+        if text:
+            rows[table] = ''.join(
+                sample + '\t' + line + '\n'
+                for line in text.rstrip('\n').split('\n')[1:])
+    # The per-base quality summaries for the quality plots in the report
+    quals = []
+    for rtype in ['raw', 'trim']:
+        for read_no in ['1', '2']:
+            fname = sample + '_' + read_no + '.' + rtype + '_quals.txt'
+            if fname not in names:
+                continue
+            text = read_text(path(fname)) or ''
+            for line in text.split('\n'):
+                if not line.strip() or line.startswith('#'):
+                    continue
+                quals.append([sample, read_no, rtype] + line.split())
+    return (rows, quals)
+
+
+def table_rows(text, sep):
+    """Split the lines of a table as R's read.table() would."""
+    return [
+        line.split(sep)
+        for line in text.split('\n')
+        if line.strip()]
+
+
+def write_bundle(path, results):
+    """Write the collated tables and quality summaries into the report
+    bundle."""
+    tables = {}
+    for table in TABLES:
+        rows = []
+        for r in results:
+            rows.extend(table_rows(r[0][table], TABLE_SEP.get(table)))
+        ncol = max([len(r) for r in rows] + [1])
+        cols = ['V' + str(i + 1) for i in range(ncol)]
+        tables[table.replace('.txt', '')] = (cols, rows)
+    quals = []
+    for r in results:
+        quals.extend(r[1])
+    tables['Base_Quals'] = (['Sample', 'ReadNo', 'Type'] + QUAL_COLUMNS, quals)
+    report_bundle.write_bundle(path, tables)
+    return
+
+
+def collate(workdir, threads, bundle=None):
+    """Collate the summaries of all finished samples in the working
+    directory, and write the tables into the allsamples directory. If a
+    bundle path is given, also write the report bundle."""
+    ssdir = os.path.join(workdir, 'singlesamples')
+    outdir = os.path.join(workdir, 'allsamples')
+    samples = []
+    for e in sorted(os.scandir(ssdir), key=lambda x: version_key(x.path)):
+        if not e.is_dir():
+            continue
+        if not os.path.isfile(os.path.join(e.path, e.name + '.done')):
+            sys.stdout.write(
+                '# No .done file for ' + e.name + ', skipping.\n')
+            continue
+        samples.append((e.path, e.name))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(lambda s: collate_sample(*s), samples))
+    for table in TABLES:
+        tpath = os.path.join(outdir, table)
+        if os.path.exists(tpath):
+            os.remove(tpath)
+        if not results:
+            continue
+        text = ''.join(rows[table] for rows, quals in results)
+        if table in OPTIONAL_TABLES and not text:
+            continue
+        with open(tpath, 'wt') as f:
+            f.write(text)
+    if bundle:
+        write_bundle(bundle, results)
+        sys.stdout.write('# Wrote report data bundle ' + bundle + '\n')
+    sys.stdout.write(
+        '# Collected summaries for ' + str(len(samples)) + ' samples\n')
+    return
+
+
+def main():
+    """Main function."""
+    ap = argparse.ArgumentParser(
+        description='Collate per-sample summaries of a bulk RNAseq run.')
+    ap.add_argument(
+        '--workdir',
+        help='Working directory of the run.',
+        required=True)
+    ap.add_argument(
+        '--threads',
+        help='Number of files to read at once. Default: 16',
+        type=int,
+        default=16)
+    ap.add_argument(
+        '--bundle',
+        help='Also write the tables for the report into this SQLite file.',
+        default=None)
+    args = ap.parse_args()
+    collate(args.workdir, max(1, args.threads), args.bundle)
+    return
+
+
+if __name__ == '__main__':
+    main()
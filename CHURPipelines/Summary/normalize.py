@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+"""Normalize the merged counts of a bulk RNAseq run with NumPy, as
+summarize_bulk_rnaseq.R does with edgeR. This is run by the summary job when
+bulk_rnaseq is given --norm-engine numpy, as
+
+    python3 -m CHURPipelines.Summary.normalize --counts <featureCounts matrix> \\
+        --groups <experimental groups xlsx> --outdir <output directory> \\
+        --min-len <bp> --min-cts <counts>
+
+and writes three tables into the Counts directory:
+
+    cpm_list.txt            log2 CPM of every gene that passes the length
+                            filter, without normalization factors, with a
+                            prior count of 1 (edgeR cpm(log = TRUE))
+    norm_factors.txt        The library size and TMM normalization factor of
+                            each sample in a group (edgeR calcNormFactors())
+    filtered_cpm_list.txt   log2 CPM, with the TMM factors, of the genes that
+                            pass the expression filter and go into the DE tests
+
+The expression filter is the one in summarize_bulk_rnaseq.R: a gene is kept if
+at least as many samples as are in the smallest group have a CPM of at least
+the minimum counts at the median library size. Samples in the 'NULL' group are
+left out of the filter and of the TMM factors. The R script reads the factors
+and the filtered genes instead of computing them again. It still loads edgeR,
+which it needs for the plots and the DE tests, so this saves the time of the
+normalization, not of starting R. With --counts-only, the summary job stops
+after this module and does not start R at all.
+
+--check compares the cpm_list.txt that this writes with one that was written
+by edgeR for the same counts and minimum length, and --benchmark times each
+step on simulated counts. Messages are logged to stderr. This module needs
+NumPy and pandas, which are in the summary job environment."""
+
+import argparse
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from CHURPipelines.ArgHandling import set_verbosity
+
+# The number of leading annotation columns in a featureCounts matrix
+FC_ANNOT_COLS = 6
+# TMM trimming, as in edgeR: the fraction of the log ratios (M) and of the
+# average log expression (A) that is trimmed from each end
+TMM_LOGRATIO_TRIM = 0.3
+TMM_SUM_TRIM = 0.05
+# The largest difference between two log-CPM tables that is still a match.
+# write.table() keeps 15 significant digits.
+CHECK_TOLERANCE = 1e-8
+# The number of genes that are formatted at a time when writing a table
+WRITE_BLOCK = 5000
+# R reserved words, which make.names() appends a '.' to
+R_RESERVED = {
+    'if', 'else', 'repeat', 'while', 'function', 'for', 'next', 'break',
+    'TRUE', 'FALSE', 'NULL', 'Inf', 'NaN', 'NA', 'NA_integer_', 'NA_real_',
+    'NA_character_', 'NA_complex_', 'in'}
+
+
+def make_names(names, unique=True):
+    """Return the names as R's make.names() would. With unique, repeated names
+    are numbered as they are for the column names of read.table(). Missing
+    names become 'NA.'."""
+    out = []
+    for n in names:
+        if n is None:
+            n = 'NA'
+        s = re.sub(r'[^A-Za-z0-9._]', '.', str(n))
+        if not re.match(r'[A-Za-z]|\.(?![0-9])', s):
+            s = 'X' + s
+        if s in R_RESERVED:
+            s += '.'
+        out.append(s)
+    if not unique:
+        return out
+    # make.unique() numbers the repeats of a name in order
+    seen = set(out)
+    first = set()
+    counts = {}
+    for i, s in enumerate(out):
+        if s not in first:
+            first.add(s)
+            continue
+        k = counts.get(s, 0)
+        while True:
+            k += 1
+            cand = s + '.' + str(k)
+            if cand not in seen:
+                break
+        counts[s] = k
+        seen.add(cand)
+        out[i] = cand
+    return out
+
+
+def read_counts(path, min_len):
+    """Read a featureCounts matrix and drop the genes that are shorter than
+    min_len. Returns the gene IDs, the sample names (as R names them), and
+    the counts as a float array with one column per sample."""
+    fc = pd.read_csv(path, sep='\t', comment='#', low_memory=False)
+    fc = fc[fc['Length'] >= min_len]
+    genes = fc.iloc[:, 0].astype(str).to_numpy()
+    samples = make_names(list(fc.columns))[FC_ANNOT_COLS:]
+    counts = fc.iloc[:, FC_ANNOT_COLS:].to_numpy(dtype=np.float64)
+    return genes, samples, counts
+
+
+def read_groups(path, samples):
+    """Read the group of each sample from the first sheet of the experimental
+    groups xlsx. Returns a list of group names, made into R names as in the R
+    script, in the order of samples. Samples that are not in the sheet get
+    'NA.', as they do in R."""
+    sheet = pd.read_excel(
+        path, sheet_name=0, keep_default_na=False, dtype=str)
+    by_sample = dict(zip(
+        make_names(list(sheet['SampleName'])), list(sheet['Group'])))
+    return make_names([by_sample.get(s) for s in samples], unique=False)
+
+
+def log_cpm(counts, lib_size, prior_count=1.0):
+    """Return log2 counts per million, as edgeR's cpm(log = TRUE). The prior
+    count is scaled by library size, and twice the scaled prior is added to
+    each library size. lib_size should include any normalization factors."""
+    prior = prior_count * lib_size / lib_size.mean()
+    return np.log2((counts + prior) / (1e-6 * (lib_size + 2 * prior)))
+
+
+def expression_filter(counts, groups, min_cts):
+    """Return a boolean array of the genes that pass the expression filter
+    of summarize_bulk_rnaseq.R, and the CPM threshold that was used. counts
+    and groups are for the samples in a group only."""
+    lib_size = counts.sum(axis=0)
+    min_cpm = min_cts / (np.median(lib_size) / 1e6)
+    min_grp = min(groups.count(g) for g in set(groups))
+    cpm = counts / lib_size * 1e6
+    keep = (cpm >= min_cpm).sum(axis=1) >= min_grp
+    return keep, min_cpm
+
+
+def average_rank(x):
+    """Return the ranks of x, with ties given their average rank, like R's
+    rank()."""
+    order = np.argsort(x, kind='mergesort')
+    _, start, n = np.unique(x[order], return_index=True, return_counts=True)
+    ranks = np.empty(len(x))
+    ranks[order] = np.repeat(start + (n + 1) / 2.0, n)
+    return ranks
+
+
+def tmm_factor(obs, ref, lib_obs, lib_ref):
+    """Return the TMM factor of one sample against the reference sample,
+    as edgeR's .calcFactorTMM() with its default trimming and weights."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_r = np.log2((obs / lib_obs) / (ref / lib_ref))
+        abs_e = (np.log2(obs / lib_obs) + np.log2(ref / lib_ref)) / 2
+        v = (lib_obs - obs) / lib_obs / obs + (lib_ref - ref) / lib_ref / ref
+    fin = np.isfinite(log_r) & np.isfinite(abs_e)
+    log_r = log_r[fin]
+    abs_e = abs_e[fin]
+    v = v[fin]
+    if len(log_r) == 0 or np.abs(log_r).max() < 1e-6:
+        return 1.0
+    n = len(log_r)
+    lo_l = np.floor(n * TMM_LOGRATIO_TRIM) + 1
+    hi_l = n + 1 - lo_l
+    lo_s = np.floor(n * TMM_SUM_TRIM) + 1
+    hi_s = n + 1 - lo_s
+    rank_r = average_rank(log_r)
+    rank_e = average_rank(abs_e)
+    keep = (
+        (rank_r >= lo_l) & (rank_r <= hi_l) &
+        (rank_e >= lo_s) & (rank_e <= hi_s))
+    if not keep.any():
+        return 1.0
+    return 2 ** (np.sum(log_r[keep] / v[keep]) / np.sum(1 / v[keep]))
+
+
+def tmm_factors(counts, lib_size):
+    """Return the TMM normalization factors of the samples, as edgeR's
+    calcNormFactors(method = 'TMM'). The reference is the sample whose upper
+    quartile is closest to the mean upper quartile, and the factors are
+    scaled to a geometric mean of 1."""
+    counts = counts[(counts > 0).any(axis=1)]
+    if counts.shape[0] == 0:
+        return np.ones(counts.shape[1])
+    f75 = np.quantile(counts / lib_size, 0.75, axis=0)
+    if np.median(f75) < 1e-20:
+        ref = int(np.argmax(np.sqrt(counts).sum(axis=0)))
+    else:
+        ref = int(np.argmin(np.abs(f75 - f75.mean())))
+    f = np.array([
+        tmm_factor(counts[:, i], counts[:, ref], lib_size[i], lib_size[ref])
+        for i in range(counts.shape[1])])
+    return f / np.exp(np.mean(np.log(f)))
+
+
+def write_log_cpm(path, genes, samples, values):
+    """Write a log-CPM table like the R script does, with a 'genes' column
+    and 15 significant digits. The numbers are formatted by np.savetxt() in
+    blocks of genes, which is several times faster than pandas for large
+    tables, and the gene IDs are put in front of each line."""
+    with open(path, 'wt') as f:
+        f.write('\t'.join(['genes'] + list(samples)) + '\n')
+        for start in range(0, len(genes), WRITE_BLOCK):
+            buf = io.StringIO()
+            np.savetxt(
+                buf, values[start:start + WRITE_BLOCK], fmt='%.15g',
+                delimiter='\t')
+            lines = buf.getvalue().split('\n')
+            f.write(''.join(
+                g + '\t' + line + '\n'
+                for g, line in zip(genes[start:start + WRITE_BLOCK], lines)))
+    return
+
+
+def normalize(counts_path, groups_path, outdir, min_len, min_cts):
+    """Write the normalized tables of a run into outdir/Counts. Returns a list
+    of lines that describe what was done, for the log."""
+    countsdir = os.path.join(outdir, 'Counts')
+    genes, samples, counts = read_counts(counts_path, min_len)
+    lib_size = counts.sum(axis=0)
+    if np.any(lib_size == 0):
+        sys.stderr.write(
+            'The following samples had zero counts after removing genes '
+            'shorter than min_len, exiting early:\n' +
+            ','.join(s for s, n in zip(samples, lib_size) if n == 0) +
+            '\nPerhaps your GTF does not match your species?\n')
+        sys.exit(1)
+    write_log_cpm(
+        os.path.join(countsdir, 'cpm_list.txt'),
+        genes, samples, log_cpm(counts, lib_size))
+    msg = ['Genes longer than ' + str(min_len) + ' bp: ' + str(len(genes))]
+    # The filtered tables are only for the samples in a group, and are
+    # removed if there are none, so that the R script does not use the
+    # tables of an earlier run
+    groups = read_groups(groups_path, samples)
+    in_group = np.array([g != 'NULL.' for g in groups])
+    filt_paths = [
+        os.path.join(countsdir, 'norm_factors.txt'),
+        os.path.join(countsdir, 'filtered_cpm_list.txt')]
+    if not in_group.any():
+        for p in filt_paths:
+            if os.path.exists(p):
+                os.remove(p)
+        msg.append('No samples are in a group; no expression filter applied.')
+        return msg
+    g_counts = counts[:, in_group]
+    g_samples = [s for s, k in zip(samples, in_group) if k]
+    g_groups = [g for g, k in zip(groups, in_group) if k]
+    keep, min_cpm = expression_filter(g_counts, g_groups, min_cts)
+    g_counts = g_counts[keep]
+    g_lib = g_counts.sum(axis=0)
+    nf = tmm_factors(g_counts, g_lib)
+    pd.DataFrame({
+        'Sample': g_samples,
+        'Group': g_groups,
+        'LibSize': g_lib,
+        'NormFactor': nf}).to_csv(
+            filt_paths[0], sep='\t', index=False, float_format='%.15g')
+    write_log_cpm(
+        filt_paths[1], genes[keep], g_samples, log_cpm(g_counts, g_lib * nf))
+    msg.append(
+        "CPM threshold for 'unexpressed' (not log scale): " + str(min_cpm))
+    msg.append('Number of retained genes: ' + str(int(keep.sum())))
+    return msg
+
+
+def check(ours, theirs):
+    """Compare two log-CPM tables. Returns the largest absolute difference,
+    or None if they do not have the same genes and samples."""
+    a = pd.read_csv(ours, sep='\t', index_col=0)
+    b = pd.read_csv(theirs, sep='\t', index_col=0)
+    if list(a.columns) != list(b.columns) or set(a.index) != set(b.index):
+        return None
+    b = b.loc[a.index]
+    return float(np.abs(a.to_numpy() - b.to_numpy()).max())
+
+
+def benchmark(n_genes, n_samples, seed=42):
+    """Time each step on simulated negative binomial counts for two groups.
+    Returns a list of (step, seconds) tuples."""
+    rng = np.random.default_rng(seed)
+    mu = np.exp(rng.normal(4, 2, n_genes))[:, None] * \
+        rng.uniform(0.5, 1.5, n_samples)[None, :]
+    disp = 0.09 * np.exp(rng.normal(0, 0.5, n_genes))[:, None]
+    counts = rng.negative_binomial(1 / disp, 1 / (1 + mu * disp)).astype(
+        np.float64)
+    genes = np.array(['G' + str(i + 1) for i in range(n_genes)])
+    samples = ['S' + str(i + 1) for i in range(n_samples)]
+    groups = ['Ref', 'Test'] * (n_samples // 2) + ['Ref'] * (n_samples % 2)
+    times = []
+    t = time.time()
+    lib_size = counts.sum(axis=0)
+    values = log_cpm(counts, lib_size)
+    times.append(('log-CPM', time.time() - t))
+    t = time.time()
+    keep, _ = expression_filter(counts, groups, 10)
+    times.append(('Expression filter', time.time() - t))
+    t = time.time()
+    g_counts = counts[keep]
+    nf = tmm_factors(g_counts, g_counts.sum(axis=0))
+    times.append(('TMM factors', time.time() - t))
+    t = time.time()
+    with tempfile.TemporaryDirectory() as d:
+        write_log_cpm(os.path.join(d, 'cpm_list.txt'), genes, samples, values)
+    times.append(('Write cpm_list.txt', time.time() - t))
+    return times
+
+
+def main():
+    """Main function."""
+    ap = argparse.ArgumentParser(
+        description='Normalize the merged counts of a bulk RNAseq run.')
+    ap.add_argument(
+        '--counts',
+        help='featureCounts matrix of the run.')
+    ap.add_argument(
+        '--groups',
+        help='Experimental groups xlsx of the run.')
+    ap.add_argument(
+        '--outdir',
+        help='Output directory of the run. Tables are written into Counts.')
+    ap.add_argument(
+        '--min-len',
+        help='Minimum gene length, in bp. Default: 200',
+        type=int,
+        default=200)
+    ap.add_argument(
+        '--min-cts',
+        help='Minimum counts for a gene to be expressed. Default: 10',
+        type=float,
+        default=10)
+    ap.add_argument(
+        '--check',
+        metavar='<cpm_list.txt>',
+        help=('Compare the cpm_list.txt that is written with this one, from '
+              'edgeR, and exit with status 1 if they differ.'),
+        default=None)
+    ap.add_argument(
+        '--benchmark',
+        metavar='<genes>x<samples>',
+        help=('Time each step on simulated counts of this size, e.g., '
+              '60000x1000, instead of normalizing a run.'),
+        default=None)
+    args = ap.parse_args()
+    logger = set_verbosity.verb('info', __name__)
+    if args.benchmark:
+        n_genes, n_samples = (int(n) for n in args.benchmark.split('x'))
+        for step, secs in benchmark(n_genes, n_samples):
+            logger.info('%s\t%.2f', step, secs)
+        return
+    if not (args.counts and args.groups and args.outdir):
+        ap.error('--counts, --groups, and --outdir are required.')
+    for line in normalize(
+            args.counts, args.groups, args.outdir, args.min_len,
+            args.min_cts):
+        logger.info(line)
+    if args.check:
+        diff = check(
+            os.path.join(args.outdir, 'Counts', 'cpm_list.txt'), args.check)
+        if diff is None:
+            logger.error('The tables do not have the same genes and samples.')
+            sys.exit(1)
+        if diff > CHECK_TOLERANCE:
+            logger.error(
+                'Largest difference from %s: %s', args.check, str(diff))
+            sys.exit(1)
+        logger.info('Largest difference from %s: %s', args.check, str(diff))
+    return
+
+
+if __name__ == '__main__':
+    main()
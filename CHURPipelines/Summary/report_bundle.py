@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Write the tables that the HTML report reads into a single SQLite file, so
+that the report can load all of them with one file open instead of reading
+the allsamples tables and the quality files of every sample one at a time.
+Columns are typed from their values: a column is INTEGER or REAL if all of
+its values are numbers, and TEXT otherwise. NA is stored as NULL. Like the
+collation module, this only uses the standard library."""
+
+import os
+import sqlite3
+
+# The version of the bundle layout. The report falls back to the text files
+# if the version in the bundle does not match the one it expects.
+BUNDLE_VERSION = '1'
+
+
+def _is_int(v):
+    """Return True if a string is an integer."""
+    try:
+        int(v)
+        return True
+    except ValueError:
+        return False
+
+
+def _is_real(v):
+    """Return True if a string is a number."""
+    try:
+        float(v)
+        return True
+    except ValueError:
+        return False
+
+
+def column_types(rows, ncol):
+    """Return the SQLite type of each column of a list of rows of strings.
+    Missing values (None, '', 'NA') do not count against a numeric type, and
+    a column with only missing values is INTEGER, so that it reads into R as
+    numeric NA like it does with read.table()."""
+    types = []
+    for i in range(ncol):
+        vals = [r[i] for r in rows if r[i] not in (None, '', 'NA')]
+        if all(_is_int(v) for v in vals):
+            types.append('INTEGER')
+        elif vals and all(_is_real(v) for v in vals):
+            types.append('REAL')
+        else:
+            types.append('TEXT')
+    return types
+
+
+def _convert(v, t):
+    """Convert a string to the type of its column."""
+    if v in (None, 'NA') or (v == '' and t != 'TEXT'):
+        return None
+    if t == 'INTEGER':
+        return int(v)
+    if t == 'REAL':
+        return float(v)
+    return v
+
+
+def write_bundle(path, tables):
+    """Write a dictionary of tables into a new SQLite file. Each table is a
+    tuple of (column names, rows), where the rows are lists of strings. Rows
+    that are shorter than the column list are padded with NULL. The file is
+    written next to its final path and moved into place, so the report never
+    reads a partial bundle."""
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    con = sqlite3.connect(tmp)
+    try:
+        con.execute('CREATE TABLE bundle_info (Key TEXT, Value TEXT)')
+        con.execute(
+            'INSERT INTO bundle_info VALUES (?, ?)',
+            ('version', BUNDLE_VERSION))
+        for name in tables:
+            cols, rows = tables[name]
+            rows = [list(r) + [None] * (len(cols) - len(r)) for r in rows]
+            types = column_types(rows, len(cols))
+            con.execute(
+                'CREATE TABLE "' + name + '" (' +
+                ', '.join('"' + c + '" ' + t for c, t in zip(cols, types)) +
+                ')')
+            con.executemany(
+                'INSERT INTO "' + name + '" VALUES (' +
+                ', '.join(['?'] * len(cols)) + ')',
+                ([_convert(v, t) for v, t in zip(r, types)] for r in rows))
+        con.commit()
+    finally:
+        con.close()
+    os.replace(tmp, path)
+    return
@@ -4,14 +4,21 @@ set -e
 set -u
 set -o pipefail
 
-# Reset the PATH variable to a "stock" state so that personal libraries do not
-# interfere.
-export PATH="/opt/msi/bin:/usr/share/Modules/bin:/usr/local/bin:/usr/bin:/usr/local/sbin:/usr/sbin:/opt/ibutils/bin:/opt/puppetlabs/bin"
+# Jobs run with "--scheduler local" set CHURP_SCHEDULER, and use the programs
+# in the PATH of the user who started them. Only set up the MSI environment
+# for Slurm jobs.
+CHURP_SCHEDULER="${CHURP_SCHEDULER:-slurm}"
+if [ "${CHURP_SCHEDULER}" = "slurm" ]
+then
+    # Reset the PATH variable to a "stock" state so that personal libraries do
+    # not interfere.
+    export PATH="/opt/msi/bin:/usr/share/Modules/bin:/usr/local/bin:/usr/bin:/usr/local/sbin:/usr/sbin:/opt/ibutils/bin:/opt/puppetlabs/bin"
 
-# Load our conda environment
-module load python3/3.8.3_anaconda2020.07_mamba
-source /home/msistaff/public/CHURP_Deps/v1/Conda_Initialize.sh
-conda activate /home/msistaff/public/CHURP_Deps/v1/churp_env
+    # Load our conda environment
+    module load python3/3.8.3_anaconda2020.07_mamba
+    source /home/msistaff/public/CHURP_Deps/v1/Conda_Initialize.sh
+    conda activate /home/msistaff/public/CHURP_Deps/v1/churp_env
+fi
 
 # Export the PS4 variable for the trace
 # Taken from https://wiki.bash-hackers.org/scripting/debuggingtips
@@ -33,7 +40,7 @@ pipeline_error() {
     case "${1}" in
     "General")
         echo "${SampleSheet} is incompatible with this version of CHURP." >> /dev/stderr
-        echo "${SampleSheet} was generated with version ${SAMPLESHEET_VERSION}, and this script requires ${PIPELINE_VERSION}." > /dev/stderr
+        echo "${SampleSheet} has samplesheet schema ${SAMPLESHEET_VERSION:-1}, and this script requires ${SHEET_SCHEMA}." > /dev/stderr
         rm -f "${OUTDIR}/.in_progress"
         exit 100
         ;;
@@ -134,6 +141,54 @@ pipeline_error() {
         rm -f "${OUTDIR}/.in_progress"
         exit 112
         ;;
+    "BAM.Metrics")
+        echo "" >> "${LOG_FNAME}"
+        echo "#### CHURP caught an error #####" >> "${LOG_FNAME}"
+        echo "CHURP encountered an error while collecting the alignment metrics with pysam!" >> "${LOG_FNAME}"
+        echo "Please see the error messages above for details. Re-run CHURP with --bam-metrics tools to use samtools, RNASeQC, and Picard instead." >> "${LOG_FNAME}"
+        rm -f "${OUTDIR}/.in_progress"
+        exit 120
+        ;;
+    "Shard.Split")
+        echo "" >> "${LOG_FNAME}"
+        echo "#### CHURP caught an error #####" >> "${LOG_FNAME}"
+        echo "CHURP encountered an error while extracting a shard of the reads!" >> "${LOG_FNAME}"
+        echo "Please see the error messages above for details." >> "${LOG_FNAME}"
+        rm -f "${OUTDIR}/.in_progress"
+        exit 121
+        ;;
+    "Shard.Merge")
+        echo "" >> "${LOG_FNAME}"
+        echo "#### CHURP caught an error #####" >> "${LOG_FNAME}"
+        echo "CHURP encountered an error while merging the shard alignments!" >> "${LOG_FNAME}"
+        echo "Please see the error messages above for details. Re-run CHURP with --shard-size 0 to align the whole sample in one task." >> "${LOG_FNAME}"
+        rm -f "${OUTDIR}/.in_progress"
+        exit 122
+        ;;
+    "Copy.Back")
+        echo "" >> "${LOG_FNAME}"
+        echo "#### CHURP caught an error #####" >> "${LOG_FNAME}"
+        echo "CHURP encountered an error while copying the results from node-local space to the working directory!" >> "${LOG_FNAME}"
+        echo "Please check that there is space in ${WORKDIR}, or re-run CHURP without --stage-local." >> "${LOG_FNAME}"
+        rm -f "${OUTDIR}/.in_progress"
+        exit 123
+        ;;
+    "Resource.Budget")
+        echo "" >> "${LOG_FNAME}"
+        echo "#### CHURP caught an error #####" >> "${LOG_FNAME}"
+        echo "CHURP encountered an error while dividing the memory and cores of the job among the tools!" >> "${LOG_FNAME}"
+        echo "Please check that python3 can import CHURPipelines from ${CHURP_DIR}." >> "${LOG_FNAME}"
+        rm -f "${OUTDIR}/.in_progress"
+        exit 124
+        ;;
+    "Cache.Restore")
+        echo "" >> "${LOG_FNAME}"
+        echo "#### CHURP caught an error #####" >> "${LOG_FNAME}"
+        echo "CHURP encountered an error while restoring results from the cache!" >> "${LOG_FNAME}"
+        echo "Please check that there is space in ${WORKDIR}, or re-run CHURP without --cache-dir." >> "${LOG_FNAME}"
+        rm -f "${OUTDIR}/.in_progress"
+        exit 125
+        ;;
     "Alignment.Summary")
         echo "" >> "${LOG_FNAME}"
         echo "#### CHURP caught an error #####" >> "${LOG_FNAME}"
@@ -154,49 +209,244 @@ pipeline_error() {
     esac
 }
 
-# Check the major version of the pipeline. If they mismatch, then quit with an error
+# Define functions to record a resource profile for each section of the
+# script. See profile_functions.sh for how the peak memory is measured.
+source "${CHURP_DIR}/PBS/profile_functions.sh"
+# Record the last section with the exit status of the script, whether it
+# exits normally or through pipeline_error. Failures are also noted in the
+# Slurm error file, which is what the "status" subcommand reads.
+job_exit() {
+    profile_close "${1}"
+    # Node-local space is not kept after a failure, so everything that the
+    # steps made there is copied back first, and a rerun picks up from the
+    # checkpoints of the steps that finished
+    if [ -n "${STAGE_DIR:-}" ]; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Copying the files of ${SAMPLENM} from node-local space to ${SAMPLE_DIR} before removing it." >> "${LOG_FNAME}"
+        (cd "${STAGE_DIR}" && copy_back all) 2>> "${LOG_FNAME}" \
+            || echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Could not copy every file back; some steps will run again." >> "${LOG_FNAME}"
+        cd /
+        rm -rf "${STAGE_DIR}"
+    fi
+    if [ "${1}" -ne 0 ]; then
+        echo "# $(date '+%F %T'): Failed in section ${LOG_SECTION} with exit status ${1}" >> /dev/stderr
+    fi
+}
+trap 'job_exit "$?"' EXIT
+
+# Define a small runner for the steps of the analysis. Each step is a function
+# that is added with add_step, along with the sections that it depends on, the
+# least and most cores that it can use, and the memory (MB) that it needs.
+# run_steps starts every step whose dependencies have finished, as long as
+# there are enough free cores and memory for it, and gives it as many of the
+# free cores as it can use. Steps that are not added (e.g., Trimmomatic when
+# TRIM is not "yes") count as finished. Each step runs in a subshell with its
+# own profile record and reports its exit status through a FIFO. If a step
+# fails, the steps that are still running are stopped, and the script exits
+# with the status and the section of the step that failed.
+STEP_NAMES=()
+declare -A STEP_FUNC STEP_DEPS STEP_MINCPU STEP_MAXCPU STEP_MEM
+add_step() {
+    local name="${1}"
+    STEP_NAMES+=("${name}")
+    STEP_FUNC["${name}"]="${2}"
+    STEP_MINCPU["${name}"]="${3}"
+    STEP_MAXCPU["${name}"]="${4}"
+    STEP_MEM["${name}"]="${5}"
+    shift 5
+    STEP_DEPS["${name}"]="${*}"
+}
+run_step() {
+    LOG_SECTION="${1}"
+    STEP_CPUS="${2}"
+    # The peak memory of the step is sampled from the processes under this
+    # subshell, so the steps that run alongside it are not counted
+    # A step that is stopped because another one failed is recorded with the
+    # exit status of SIGTERM
+    trap 'exit 143' SIGTERM
+    trap 'profile_close "$?"' EXIT
+    echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+    profile_open
+    "${STEP_FUNC[${LOG_SECTION}]}"
+    echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
+}
+# Stop a process and everything that it started
+stop_tree() {
+    local children child
+    children=$(ps -o pid= --ppid "${1}" || true)
+    kill "${1}" 2> /dev/null || true
+    for child in ${children}
+    do
+        stop_tree "${child}"
+    done
+}
+run_steps() {
+    local name dep ready grant status child
+    local free_cpu="${NCPU}"
+    local free_mem="${STEPS_MB}"
+    local running=0
+    local failed=""
+    local fail_status=0
+    local fifo="${PWD}/.steps.${SLURM_JOB_ID}.fifo"
+    local -A state step_pid step_cpu
+    for name in "${STEP_NAMES[@]}"
+    do
+        state["${name}"]="waiting"
+    done
+    rm -f "${fifo}"
+    mkfifo "${fifo}"
+    exec 6<> "${fifo}"
+    rm -f "${fifo}"
+    while true
+    do
+        for name in "${STEP_NAMES[@]}"
+        do
+            if [[ -n "${failed}" || "${state[${name}]}" != "waiting" ]]; then
+                continue
+            fi
+            ready="true"
+            for dep in ${STEP_DEPS[${name}]}
+            do
+                if [ "${state[${dep}]:-done}" != "done" ]; then
+                    ready="false"
+                fi
+            done
+            if [ "${ready}" = "false" ]; then
+                continue
+            fi
+            grant=$(( free_cpu < ${STEP_MAXCPU[${name}]} ? free_cpu : ${STEP_MAXCPU[${name}]} ))
+            # A step that does not fit still runs if nothing else is running
+            if [ "${running}" -gt 0 ]; then
+                if [ "${grant}" -lt "${STEP_MINCPU[${name}]}" ]; then
+                    continue
+                fi
+                if [[ "${SLURM_MEM_PER_NODE:-0}" -gt 0 && "${STEP_MEM[${name}]}" -gt "${free_mem}" ]]; then
+                    continue
+                fi
+            fi
+            if [ "${grant}" -lt 1 ]; then
+                grant=1
+            fi
+            ( set +e; ( set -e; run_step "${name}" "${grant}" ); echo "${name} $?" >&6 ) &
+            step_pid["${name}"]="$!"
+            step_cpu["${name}"]="${grant}"
+            state["${name}"]="running"
+            running=$(( running + 1 ))
+            free_cpu=$(( free_cpu - grant ))
+            free_mem=$(( free_mem - ${STEP_MEM[${name}]} ))
+        done
+        if [ "${running}" -eq 0 ]; then
+            break
+        fi
+        read -r -u 6 name status
+        wait "${step_pid[${name}]}" || true
+        running=$(( running - 1 ))
+        free_cpu=$(( free_cpu + ${step_cpu[${name}]} ))
+        free_mem=$(( free_mem + ${STEP_MEM[${name}]} ))
+        if [[ "${status}" -ne 0 && -z "${failed}" ]]; then
+            state["${name}"]="failed"
+            failed="${name}"
+            fail_status="${status}"
+            for dep in "${STEP_NAMES[@]}"
+            do
+                if [ "${state[${dep}]}" = "running" ]; then
+                    echo "# $(date '+%F %T'): Stopping section ${dep} after ${failed} failed" >> /dev/stderr
+                    for child in $(ps -o pid= --ppid "${step_pid[${dep}]}" || true)
+                    do
+                        stop_tree "${child}"
+                    done
+                fi
+            done
+        else
+            state["${name}"]="done"
+        fi
+    done
+    exec 6>&-
+    if [ -n "${failed}" ]; then
+        LOG_SECTION="${failed}"
+        exit "${fail_status}"
+    fi
+}
+
+# Define read_samplesheet, which reads a row of the samplesheet into the SHEET
+# array, and the schema version that this script reads
+source "${CHURP_DIR}/PBS/samplesheet_functions.sh"
+
+# Check the samplesheet schema. If it is not the one this script reads, then
+# quit with an error. The major version of the pipeline is still used to pick
+# the dependencies directory.
 PIPELINE_VERSION="1"
-SAMPLESHEET_VERSION=$(tail -n 1 "${SampleSheet}" | sed -E 's/#//g')
-if [ "${SAMPLESHEET_VERSION}" -ne "${PIPELINE_VERSION}" ]
+SAMPLESHEET_VERSION=$(head -n 1 "${SampleSheet}" | awk -F '\t' '$1 == "#CHURP_SAMPLESHEET" { print $2 }')
+if [ "${SAMPLESHEET_VERSION:-1}" != "${SHEET_SCHEMA}" ]
 then
     pipeline_error "${LOG_SECTION}"
 fi
 
-# Parse SampleSheet using $SLURM_ARRAY_TASK_ID
-# Assume there is a header line, so for ID n, the sample is n+1
-# Sample Sheet: SampleNM, R1, R2, Trim (yes or no), TrimmomaticOption, Hisat2Index, Hisat2Option, GTF/GFF
-IN=$(head -n "${SLURM_ARRAY_TASK_ID}" "${SampleSheet}" | tail -1)
-# handle empty line and comment line. We return a 0 exit status because we do not
-# want a comment/blank line in the samplesheet to hold up the array jobs
-[ -z "${IN// }" ] && echo "You have submitted an empty line from the sample sheet to the job array. This array job will quit without error, but you should determine why this occured." && exit 0
-[ "$IN" = "#.*" ] && echo "You have submitted a comment line from the sample sheet to the job array. This array job will quit without error, but you should determine why this occured." && exit 0
-while IFS="|" read -ra OPTS; do 
-    SAMPLENM=${OPTS[0]}
-    EXPR_GROUP=${OPTS[1]}
-    R1FILE=${OPTS[2]}
-    R2FILE=${OPTS[3]}
-    OUTDIR=${OPTS[4]}
-    WORKDIR=${OPTS[5]}
-    TRIM=${OPTS[6]}
-    RMDUP=${OPTS[7]}
-    TRIMOPTS=${OPTS[8]}
-    HISAT2INDEX=${OPTS[9]}
-    HISAT2OPTS=${OPTS[10]}
-    STRAND=${OPTS[11]}
-    GTFFILE=${OPTS[12]}
-done <<< "$IN"
+# Shard tasks (SHARD_TASK=true) align one shard of the reads of a sample that
+# is aligned in shards. Their array index counts the shards of those samples in
+# the order of the sample sheet, so find the row of the sample and the number
+# of the shard from the Shards column.
+SHEET_ROW="${SLURM_ARRAY_TASK_ID}"
+SHARD_NUM=""
+if [ "${SHARD_TASK:-false}" = "true" ]
+then
+    read -r SHEET_ROW SHARD_NUM SHARD_COUNT < <(awk -F '\t' -v t="${SLURM_ARRAY_TASK_ID}" '
+        /^[#@]/ || NF == 0 { next }
+        !col { for (i = 1; i <= NF; i++) if ($i == "Shards") col = i; next }
+        $col > 1 { if (t <= $col) { print $1, t, $col; exit } t -= $col }' "${SampleSheet}") || true
+    if [ -z "${SHARD_NUM}" ]
+    then
+        echo "There is no shard for array index ${SLURM_ARRAY_TASK_ID} in the sample sheet. This array job will quit without error, but you should determine why this occured."
+        exit 0
+    fi
+fi
+
+# Find the row of this array task in the samplesheet. We return a 0 exit
+# status if there is not one, because we do not want a stray array index to
+# hold up the other array jobs
+if ! read_samplesheet "${SampleSheet}" "${SHEET_ROW}"
+then
+    echo "There is no row for array index ${SHEET_ROW} in the sample sheet. This array job will quit without error, but you should determine why this occured."
+    exit 0
+fi
+SAMPLENM="${SHEET[SampleName]}"
+EXPR_GROUP="${SHEET[Group]}"
+R1FILE="${SHEET[FastqR1files]}"
+R2FILE="${SHEET[FastqR2file]}"
+OUTDIR="${SHEET[OutputDir]}"
+WORKDIR="${SHEET[WorkingDir]}"
+TRIM="${SHEET[TRIM]}"
+RMDUP="${SHEET[RMDUP]}"
+TRIMOPTS="${SHEET[trimmomaticOpts]}"
+HISAT2INDEX="${SHEET[Hisat2index]}"
+HISAT2OPTS="${SHEET[Hisat2Options]}"
+STRAND="${SHEET[Strand]}"
+GTFFILE="${SHEET[AnnotationGTF]}"
+# The cache key is empty when the result cache is not in use
+CACHEKEY="${SHEET[CacheKey]:-}"
+# Samples with more than one shard have their reads aligned in shard tasks
+SHARDS="${SHEET[Shards]:-1}"
+SHARD_DIR="${WORKDIR}/shards/${SAMPLENM}"
 
 # Start the trace. In this case, we use file descriptor 5 to avoid clobbering
-# any other fds that are in use
+# any other fds that are in use. Shard tasks keep their own logs.
 LOGDIR="${OUTDIR}/Logs"
 mkdir -p "${LOGDIR}"
-TRACE_FNAME="${LOGDIR}/${SAMPLENM}_Trace.log"
-LOG_FNAME="${LOGDIR}/${SAMPLENM}_Analysis.log"
+if [ -n "${SHARD_NUM}" ]; then
+    LOG_PREFIX="${LOGDIR}/${SAMPLENM}_Shard${SHARD_NUM}"
+else
+    LOG_PREFIX="${LOGDIR}/${SAMPLENM}"
+fi
+TRACE_FNAME="${LOG_PREFIX}_Trace.log"
+LOG_FNAME="${LOG_PREFIX}_Analysis.log"
+PROFILE_FNAME="${LOG_PREFIX}_Profile.tsv"
+PROFILE_SAMPLE="${SAMPLENM}"
+PROFILE_JOB="${SLURM_ARRAY_JOB_ID:-${SLURM_JOB_ID}}_${SLURM_ARRAY_TASK_ID}"
 # Write the samplename to the .e PBS file
 echo "# $(date '+%F %T') Slurm error file for ${SAMPLENM}" >> /dev/stderr
 echo "# $(date '+%F %T'): For a human-readable log, see ${LOG_FNAME}" >> /dev/stderr
 echo "# $(date '+%F %T'): For a debugging trace, see ${TRACE_FNAME}" >> /dev/stderr
 echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+profile_section
 # We don't want to clobber the old files; just append to them
 echo "###############################################################################" >> "${LOG_FNAME}"
 echo "# $(date '+%F %T'): Analysis started for ${SAMPLENM}" >> "${LOG_FNAME}"
@@ -213,7 +463,9 @@ export BASH_XTRACEFD=5
 set -x
 
 # Set paths to BBDuk, seqtk, and the SILVA databases
-DEPS_DIR="/home/msistaff/public/CHURP_Deps/v${PIPELINE_VERSION}"
+# CHURP_DEPS_DIR can point local runs at their own copy of the databases and
+# supporting scripts
+DEPS_DIR="${CHURP_DEPS_DIR:-/home/msistaff/public/CHURP_Deps/v${PIPELINE_VERSION}}"
 SILVA_REF="${DEPS_DIR}/db/SILVA_138.1_LSU-SSU_NR99_Dedup_Kmers.fasta.gz"
 COLLAPSE_GTF="${DEPS_DIR}/Supp/GTEx_Pipeline/collapse_annotation.py"
 #RNASEQC="${DEPS_DIR}/Supp/RNASeQC/rnaseqc.v2.3.4.linux"
@@ -229,26 +481,138 @@ else
     echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): R2 file detected; running ${SAMPLENM} as paired-end" >> "${LOG_FNAME}"
 fi
 
+# The strandedness of the library, as RNASeQC takes it. A bit strange - if the
+# data are single-read data, then the strand has to be flipped. This was
+# confirmed with single-read pico v2 and pico v1 data.
+RNASEQC_STRANDED="none"
+if [[ "${STRAND}" = "2" && "${PE}" = "true" ]]; then
+    RNASEQC_STRANDED="RF"
+elif [[ "${STRAND}" = "1" && "${PE}" = "true" ]]; then
+    RNASEQC_STRANDED="FR"
+elif [[ "${STRAND}" = "2" && "${PE}" = "false" ]]; then
+    RNASEQC_STRANDED="FR"
+elif [[ "${STRAND}" = "1" && "${PE}" = "false" ]]; then
+    RNASEQC_STRANDED="RF"
+fi
+
+# Results that were restored from the cache are listed in .cache_restored,
+# after the key that they were restored for. If the key has changed since then
+# (e.g., a new GTF or new options), they are removed along with the sample
+# checkpoint, so that the steps below do not skip their work and re-use them.
+RESTORED="${WORKDIR}/singlesamples/${SAMPLENM}/.cache_restored"
+if [[ -f "${RESTORED}" && "$(head -n 1 "${RESTORED}")" != "${CACHEKEY}" ]]; then
+    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Results for ${SAMPLENM} were restored from the cache for another key; removing them." >> "${LOG_FNAME}"
+    tail -n +2 "${RESTORED}" | while read -r restored
+    do
+        rm -rf "${WORKDIR:?}/singlesamples/${SAMPLENM}/${restored:?}"
+    done
+    rm -f "${WORKDIR}/singlesamples/${SAMPLENM}/${SAMPLENM}.done" "${RESTORED}"
+fi
+
+# A shard task works in its own directory under ${WORKDIR}/shards, so that the
+# task that merges the shards can purge the sample directory without losing
+# them. It has nothing to do if the sample is already aligned or cached.
+if [ -n "${SHARD_NUM}" ]; then
+    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Aligning shard ${SHARD_NUM} of ${SHARD_COUNT} of ${SAMPLENM}." >> "${LOG_FNAME}"
+    if [ "${PURGE}" = "true" ]; then
+        rm -rf "${SHARD_DIR}/${SHARD_NUM}"
+    elif [[ -f "${WORKDIR}/singlesamples/${SAMPLENM}/${SAMPLENM}.done" || -f "${WORKDIR}/singlesamples/${SAMPLENM}/hisat2.done" ]]; then
+        echo "# $(date '+%F %T'): Found aligned reads for ${SAMPLENM}; not aligning shard ${SHARD_NUM}" >> /dev/stderr
+        exit 0
+    fi
+    if [[ -n "${CACHE_DIR:-}" && -n "${CACHEKEY}" && -d "${CACHE_DIR}/${CACHEKEY}" ]]; then
+        echo "# $(date '+%F %T'): Found cached results for ${SAMPLENM}; not aligning shard ${SHARD_NUM}" >> /dev/stderr
+        exit 0
+    fi
+    mkdir -p "${SHARD_DIR}/${SHARD_NUM}" && cd "${SHARD_DIR}/${SHARD_NUM}"
+    if [ -f shard.done ]; then
+        echo "# $(date '+%F %T'): Found aligned shard ${SHARD_NUM} of ${SAMPLENM}" >> /dev/stderr
+        echo "# $(date '+%F %T'): Job complete" >> /dev/stderr
+        exit 0
+    fi
+fi
+
 # check whether to purge files or not. $PURGE will be parsed by command line
-if [ "${PURGE}" = "true" ]; then
+if [[ -z "${SHARD_NUM}" && "${PURGE}" = "true" ]]; then
     echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): PURGE=true; deleting work directory for ${SAMPLENM} and re-running all analyses." >> "${LOG_FNAME}"
     rm -rf "${WORKDIR}/singlesamples/${SAMPLENM}"
 fi
 
 # set working directory
-mkdir -p "${WORKDIR}/singlesamples/${SAMPLENM}" && cd "${WORKDIR}/singlesamples/${SAMPLENM}"
+if [ -z "${SHARD_NUM}" ]; then
+    mkdir -p "${WORKDIR}/singlesamples/${SAMPLENM}" && cd "${WORKDIR}/singlesamples/${SAMPLENM}"
+fi
 
 # start workflow with check point
 if [ -f "${SAMPLENM}.done" ]; then
     echo "Found completed analysis, exit" >> "${LOG_FNAME}"
+    echo "# $(date '+%F %T'): Found completed analysis for ${SAMPLENM}" >> /dev/stderr
+    echo "# $(date '+%F %T'): Job complete" >> /dev/stderr
     exit 0
 fi
 
+# Look for this sample in the shared result cache. A cache entry is a
+# directory named by the cache key that holds the per-sample outputs and the
+# step checkpoint files. We restore everything into the sample directory, and
+# the checkpoints make the steps below skip their work. The BAM files are
+# large and are never written again, so they are hard linked when the cache is
+# on the same file system; the files of an entry are read-only, so they cannot
+# be changed through the links. Everything else is copied, so that later steps
+# and re-runs only change the sample directory. The time stamp of the entry is
+# updated when it is restored, so that entries that have not been used for a
+# while can be pruned by age.
+restore_cached() {
+    case "${1}" in
+        *.bam|*.bai)
+            ln "${1}" "${2}" 2> /dev/null || cp "${1}" "${2}"
+            ;;
+        *)
+            cp -r "${1}" "${2}" && chmod -R u+w "${2}"
+            ;;
+    esac
+}
+echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
+LOG_SECTION="Cache.Restore"
+echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+profile_section
+CACHE_HIT="false"
+if [[ -n "${CACHE_DIR:-}" && -n "${CACHEKEY}" && -z "${SHARD_NUM}" ]]; then
+    CACHE_ENTRY="${CACHE_DIR}/${CACHEKEY}"
+    if [ -d "${CACHE_ENTRY}" ]; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found cached results for ${SAMPLENM} in ${CACHE_ENTRY}; restoring them instead of re-running." >> "${LOG_FNAME}"
+        # List the restored results as they are restored, so that a partial
+        # restore is removed too if the key changes
+        echo "${CACHEKEY}" > "${RESTORED}"
+        touch "${CACHE_ENTRY}" 2> /dev/null || true
+        for cached in "${CACHE_ENTRY}"/*
+        do
+            basename "${cached}" >> "${RESTORED}"
+            rm -rf "${WORKDIR}/singlesamples/${SAMPLENM}/$(basename "${cached}")"
+            restore_cached "${cached}" "${WORKDIR}/singlesamples/${SAMPLENM}/$(basename "${cached}")" 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+        done
+        # The insert size metrics are written into the output directory
+        if [ -d "${CACHE_ENTRY}/InsertSizeMetrics" ]; then
+            mkdir -p "${OUTDIR}/InsertSizeMetrics"
+            for cached in "${CACHE_ENTRY}/InsertSizeMetrics/"*
+            do
+                rm -f "${OUTDIR}/InsertSizeMetrics/$(basename "${cached}")"
+                restore_cached "${cached}" "${OUTDIR}/InsertSizeMetrics/$(basename "${cached}")" 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+            done
+        fi
+        CACHE_HIT="true"
+    else
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): No cached results for ${SAMPLENM} (key ${CACHEKEY}); results will be added to ${CACHE_DIR}." >> "${LOG_FNAME}"
+    fi
+fi
+
 echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
 LOG_SECTION="Subsampling"
 echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+profile_section
 if [ "${SUBSAMPLE}" -eq 0 ]; then
     echo "# $(date '+%F %T'): Not subsampling reads for sample ${SAMPLENM} for analysis" >> "${LOG_FNAME}"
+elif [ "${CACHE_HIT}" = "true" ]; then
+    echo "# $(date '+%F %T'): Results for ${SAMPLENM} restored from cache; not subsampling reads" >> "${LOG_FNAME}"
 else
     echo "# $(date '+%F %T'): Subsampling ${SAMPLENM} to ${SUBSAMPLE} fragments for rRNA quantification" >> "${LOG_FNAME}"
     seqtk sample -s123 -2 "${R1FILE}" "${SUBSAMPLE}" | gzip -c > "${WORKDIR}/singlesamples/${SAMPLENM}/Subsample_R1.fastq.gz" 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
@@ -259,115 +623,197 @@ else
     fi
 fi
 
-
+# Merge the shard alignments of a sample that was aligned in shards. The
+# trimmed reads and the BAMs are concatenated in shard order, and the HISAT2
+# summaries are added up, so the steps below find them as if the whole sample
+# had been trimmed and aligned here. If any shard did not finish, the whole
+# sample is aligned instead.
 echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="rRNA.Subsampling"
+LOG_SECTION="Shard.Merge"
 echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-if [ ! -f subsamp.done ]; then
-    # subsample the FASTQ and assay for rRNA contamination
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Subsampling reads to ${RRNA_SCREEN} fragments." >> "${LOG_FNAME}"
-    seqtk sample -s123 -2 "${R1FILE}" "${RRNA_SCREEN}" > "${WORKDIR}/singlesamples/${SAMPLENM}/BBDuk_R1.fastq" 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
-    if [ "${PE}" = "true" ]; then
-        seqtk sample -s123 -2 "${R2FILE}" "${RRNA_SCREEN}" > "${WORKDIR}/singlesamples/${SAMPLENM}/BBDuk_R2.fastq" 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+profile_section
+merge_hisat2_summaries() {
+    # Sum the counts of each line, keyed on the text before the colon, then
+    # recompute the percentages from the "Total" line above them
+    awk '
+        /^\t/ && /: [0-9]+/ && !/Overall/ {
+            key = $0
+            sub(/:.*/, "", key)
+            val = $0
+            sub(/^[^:]*: /, "", val)
+            sub(/ .*/, "", val)
+            if (!(key in sum)) { order[++n] = key }
+            sum[key] += val
+        }
+        END {
+            print "HISAT2 summary stats:"
+            for (i = 1; i <= n; i++) {
+                key = order[i]
+                if (key ~ /Total/) {
+                    total = sum[key]
+                    print key ": " sum[key]
+                } else {
+                    printf "%s: %d (%.2f%%)\n", key, sum[key], (total > 0 ? 100 * sum[key] / total : 0)
+                }
+            }
+            if ("\tTotal pairs" in sum) {
+                reads = 2 * sum["\tTotal pairs"]
+            } else {
+                reads = sum["\tTotal reads"]
+            }
+            printf "\tOverall alignment rate: %.2f%%\n", (reads > 0 ? 100 * (reads - sum["\t\tAligned 0 time"]) / reads : 0)
+        }' "${@}"
+}
+merge_shards() {
+    local k trimmed
+    local -a shard_dirs=()
+    for k in $(seq 1 "${SHARDS}")
+    do
+        shard_dirs+=("${SHARD_DIR}/${k}")
+    done
+    if [ "${TRIM}" = "yes" ]; then
+        if [ "${PE}" = "true" ]; then
+            trimmed="1P 2P"
+        else
+            trimmed="trimmed"
+        fi
+        # Concatenated gzip files are a valid gzip file
+        for k in ${trimmed}
+        do
+            cat "${shard_dirs[@]/%//${SAMPLENM}_${k}.fq.gz}" > "${SAMPLENM}_${k}.fq.gz" || return 1
+        done
+        touch trimmomatic.done
+    fi
+    samtools cat -o "${SAMPLENM}.bam" "${shard_dirs[@]/%//${SAMPLENM}.bam}" || return 1
+    merge_hisat2_summaries "${shard_dirs[@]/%//alignment.summary}" > alignment.summary || return 1
+    touch hisat2.done
+}
+if [[ "${SHARDS}" -gt 1 && -z "${SHARD_NUM}" && ! -f hisat2.done ]]; then
+    SHARDS_DONE=0
+    for k in $(seq 1 "${SHARDS}")
+    do
+        if [ -f "${SHARD_DIR}/${k}/shard.done" ]; then
+            SHARDS_DONE=$(( SHARDS_DONE + 1 ))
+        fi
+    done
+    if [ "${SHARDS_DONE}" -eq "${SHARDS}" ]; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Merging the alignments of ${SHARDS} shards of ${SAMPLENM}." >> "${LOG_FNAME}"
+        merge_shards 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+        # Stick the alignment summary onto the analysis log
+        cat alignment.summary >> "${LOG_FNAME}"
+    else
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found ${SHARDS_DONE} of ${SHARDS} aligned shards of ${SAMPLENM}; aligning the whole sample instead." >> "${LOG_FNAME}"
     fi
-    touch subsamp.done
-else
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found subsampled reads" >> "${LOG_FNAME}"
 fi
 
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="BBDuk"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-# Check if the BBDuk analysis has been finished
-if [ ! -f bbduk.done ]; then
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Using BBDuk to search for rRNA contamination in subsampled reads." >> "${LOG_FNAME}"
-    if [ "${PE}" = "true" ]; then
-        bbduk.sh \
-            in="${WORKDIR}/singlesamples/${SAMPLENM}/BBDuk_R1.fastq" \
-            in2="${WORKDIR}/singlesamples/${SAMPLENM}/BBDuk_R2.fastq" \
-            ref="${SILVA_REF}" \
-            stats="${WORKDIR}/singlesamples/${SAMPLENM}/BBDuk_rRNA_Stats.txt" \
-            k=25 \
-            prealloc=t \
-            threads="${SLURM_CPUS_PER_TASK}" \
-            -Xmx19g \
-            2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+
+# The rest of the analysis is split into steps, which are run by run_steps.
+# Each step runs in its own subshell, so a step cannot set variables for the
+# steps after it. The file names that are shared between steps are set before
+# the steps start.
+step_rrna_subsample() {
+    if [ ! -f subsamp.done ]; then
+        # subsample the FASTQ and assay for rRNA contamination
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Subsampling reads to ${RRNA_SCREEN} fragments." >> "${LOG_FNAME}"
+        seqtk sample -s123 -2 "${R1FILE}" "${RRNA_SCREEN}" > "${RUN_DIR}/BBDuk_R1.fastq" 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+        if [ "${PE}" = "true" ]; then
+            seqtk sample -s123 -2 "${R2FILE}" "${RRNA_SCREEN}" > "${RUN_DIR}/BBDuk_R2.fastq" 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+        fi
+        touch subsamp.done
     else
-        bbduk.sh \
-            in="${WORKDIR}/singlesamples/${SAMPLENM}/BBDuk_R1.fastq" \
-            ref="${SILVA_REF}" \
-            stats="${WORKDIR}/singlesamples/${SAMPLENM}/BBDuk_rRNA_Stats.txt" \
-            k=25 \
-            prealloc=t \
-            threads="${SLURM_CPUS_PER_TASK}" \
-            -Xmx19g \
-             2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
-    fi
-    touch bbduk.done
-else
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found complete BBDuk analysis." >> "${LOG_FNAME}"
-fi
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found subsampled reads" >> "${LOG_FNAME}"
+    fi
+}
 
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="FastQC.Raw"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-if [ ! -f fastqc.done ]; then
-    if [ "${PE}" = "true" ]
-    then
-        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Running fastqc on ${R1FILE} and ${R2FILE}." >> "${LOG_FNAME}"
-        fastqc \
-            -t 2 \
-            --extract \
-            --outdir="${WORKDIR}/singlesamples/${SAMPLENM}" \
-            "${R1FILE}" \
-            "${R2FILE}" \
-            2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}" \
-        && touch fastqc.done
+step_bbduk() {
+    # Check if the BBDuk analysis has been finished
+    if [ ! -f bbduk.done ]; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Using BBDuk to search for rRNA contamination in subsampled reads." >> "${LOG_FNAME}"
+        if [ "${PE}" = "true" ]; then
+            bbduk.sh \
+                in="${RUN_DIR}/BBDuk_R1.fastq" \
+                in2="${RUN_DIR}/BBDuk_R2.fastq" \
+                ref="${SILVA_REF}" \
+                stats="${RUN_DIR}/BBDuk_rRNA_Stats.txt" \
+                k=25 \
+                prealloc=t \
+                threads="${STEP_CPUS}" \
+                "-Xmx${BBDUK_HEAP_MB}m" \
+                2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+        else
+            bbduk.sh \
+                in="${RUN_DIR}/BBDuk_R1.fastq" \
+                ref="${SILVA_REF}" \
+                stats="${RUN_DIR}/BBDuk_rRNA_Stats.txt" \
+                k=25 \
+                prealloc=t \
+                threads="${STEP_CPUS}" \
+                "-Xmx${BBDUK_HEAP_MB}m" \
+                 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+        fi
+        touch bbduk.done
     else
-        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Running fastqc on ${R1FILE}." >> "${LOG_FNAME}"
-        fastqc \
-            --extract \
-            --outdir="${WORKDIR}/singlesamples/${SAMPLENM}" \
-            "${R1FILE}" \
-            2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}" \
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found complete BBDuk analysis." >> "${LOG_FNAME}"
+    fi
+}
+
+step_fastqc_raw() {
+    if [ ! -f fastqc.done ]; then
+        if [ "${PE}" = "true" ]
+        then
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Running fastqc on ${R1FILE} and ${R2FILE}." >> "${LOG_FNAME}"
+            fastqc \
+                -t "${STEP_CPUS}" \
+                --extract \
+                --outdir="${RUN_DIR}" \
+                "${R1FILE}" \
+                "${R2FILE}" \
+                2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}" \
             && touch fastqc.done
+        else
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Running fastqc on ${R1FILE}." >> "${LOG_FNAME}"
+            fastqc \
+                --extract \
+                --outdir="${RUN_DIR}" \
+                "${R1FILE}" \
+                2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}" \
+                && touch fastqc.done
+        fi
     fi
-fi
 
-# The fastqc files are auto-extracted, so we search for the directories that
-# end in '_fastqc', pull out the total number of reads, then throw away the
-# directory
-for fastqc_out_dir in $(find "${WORKDIR}/singlesamples/${SAMPLENM}" -maxdepth 1 -type d -name '*_fastqc')
-do
-    read_no=$(basename "${fastqc_out_dir}" | sed -nr 's/.*_R?(1|2)_(001_)?fastqc/\1/p')
-    if [ -z "${read_no}" ]
-    then
-        read_no="1"
-    fi
-    out_pref="${SAMPLENM}_${read_no}.raw_readcount.txt"
-    echo "${SAMPLENM} $(grep '^Total Sequences' ${fastqc_out_dir}/fastqc_data.txt | cut -f 2)" > "${out_pref}"
-    awk '/>>Per base sequence quality/{flag=1; next} />>END_MODULE/{flag=0} flag' \
-        "${fastqc_out_dir}/fastqc_data.txt" \
-        | sed -e 's/ /./g' \
-        > "${WORKDIR}/singlesamples/${SAMPLENM}/${SAMPLENM}_${read_no}.raw_quals.txt"
-    rm -rf "${fastqc_out_dir}.processed"
-    mv -f "${fastqc_out_dir}" "${fastqc_out_dir}.processed"
-done
+    # The fastqc files are auto-extracted, so we search for the directories that
+    # end in '_fastqc', pull out the total number of reads, then throw away the
+    # directory. FastQC may be running on the trimmed reads at the same time, so
+    # their directories are left for the FastQC.Trimmed step.
+    for fastqc_out_dir in $(find "${RUN_DIR}" -maxdepth 1 -type d -name '*_fastqc' ! -name "${SAMPLENM}_1P_fastqc" ! -name "${SAMPLENM}_2P_fastqc" ! -name "${SAMPLENM}_trimmed_fastqc")
+    do
+        read_no=$(basename "${fastqc_out_dir}" | sed -nr 's/.*_R?(1|2)_(001_)?fastqc/\1/p')
+        if [ -z "${read_no}" ]
+        then
+            read_no="1"
+        fi
+        out_pref="${SAMPLENM}_${read_no}.raw_readcount.txt"
+        echo "${SAMPLENM} $(grep '^Total Sequences' ${fastqc_out_dir}/fastqc_data.txt | cut -f 2)" > "${out_pref}"
+        awk '/>>Per base sequence quality/{flag=1; next} />>END_MODULE/{flag=0} flag' \
+            "${fastqc_out_dir}/fastqc_data.txt" \
+            | sed -e 's/ /./g' \
+            > "${RUN_DIR}/${SAMPLENM}_${read_no}.raw_quals.txt"
+        rm -rf "${fastqc_out_dir}.processed"
+        mv -f "${fastqc_out_dir}" "${fastqc_out_dir}.processed"
+    done
+}
 
 # To use -basein option, fastq file must be in format *_R1_*.fastq and *_R2_*.fastq
 # trimmomatic can handle the -basein and -baseout options if there is only one
 # read (single end).
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="Trimmomatic"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-if [ "${TRIM}" = "yes" ]; then
+step_trimmomatic() {
     if [ ! -f trimmomatic.done ]; then
         if [ "${PE}" = "true" ]
         then
             echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Running trimmomatic on ${R1FILE} and ${R2FILE}." >> "${LOG_FNAME}"
             trimmomatic \
                 PE \
-                -threads "${SLURM_CPUS_PER_TASK}" \
+                -threads "${STEP_CPUS}" \
                 "${R1FILE}" "${R2FILE}" \
                 "${SAMPLENM}_1P.fq.gz" "${SAMPLENM}_1U.fq.gz" "${SAMPLENM}_2P.fq.gz" "${SAMPLENM}_2U.fq.gz" \
                 $(echo "${TRIMOPTS}" | envsubst) \
@@ -377,7 +823,7 @@ if [ "${TRIM}" = "yes" ]; then
             echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Running trimmomatic on ${R1FILE}." >> "${LOG_FNAME}"
             trimmomatic \
                 SE \
-                -threads "${SLURM_CPUS_PER_TASK}" \
+                -threads "${STEP_CPUS}" \
                 "${R1FILE}" \
                 "${SAMPLENM}_trimmed.fq.gz" \
                 $(echo "${TRIMOPTS}" | envsubst) \
@@ -385,17 +831,17 @@ if [ "${TRIM}" = "yes" ]; then
                 && touch trimmomatic.done
         fi
     fi
-    echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-    LOG_SECTION="FastQC.Trimmed"
-    echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+}
+
+step_fastqc_trimmed() {
     if [ ! -f fastqc.trim.done ]; then
         if [ "${PE}" = "true" ]
         then
             echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Running fastqc on trimmed fastq files." >> "${LOG_FNAME}"
             fastqc \
-                -t 2 \
+                -t "${STEP_CPUS}" \
                 --extract \
-                --outdir="${WORKDIR}/singlesamples/${SAMPLENM}" \
+                --outdir="${RUN_DIR}" \
                 "${SAMPLENM}_1P.fq.gz" \
                 "${SAMPLENM}_2P.fq.gz" \
                 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}" \
@@ -404,313 +850,620 @@ if [ "${TRIM}" = "yes" ]; then
             echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Running fastqc on trimmed fastq file." >> "${LOG_FNAME}"
             fastqc \
                 --extract \
-                --outdir="${WORKDIR}/singlesamples/${SAMPLENM}" \
+                --outdir="${RUN_DIR}" \
                 "${SAMPLENM}_trimmed.fq.gz" \
                 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}" \
                 && touch fastqc.trim.done
         fi
     fi
-fi
 
-for fastqc_out_dir in $(find "${WORKDIR}/singlesamples/${SAMPLENM}" -maxdepth 1 -type d -name '*_fastqc')
-do
-    read_no=$(basename "${fastqc_out_dir}" | sed -nr 's/.*(1|2)P_fastqc/\1/p')
-    # If the files are single-end, then $read_no is empty
-    if [ -z "${read_no}" ]
-    then
-        read_no="1"
-    fi
-    out_pref="${SAMPLENM}_${read_no}.trimmed_readcount.txt"
-    echo "${SAMPLENM} $(grep '^Total Sequences' ${fastqc_out_dir}/fastqc_data.txt | cut -f 2)" > "${out_pref}"
-    awk '/>>Per base sequence quality/{flag=1; next} />>END_MODULE/{flag=0} flag' \
-        "${fastqc_out_dir}/fastqc_data.txt" \
-        | sed -e 's/ /./g' \
-        > "${WORKDIR}/singlesamples/${SAMPLENM}/${SAMPLENM}_${read_no}.trim_quals.txt"
-    rm -rf "${fastqc_out_dir}.processed"
-    mv -f "${fastqc_out_dir}" "${fastqc_out_dir}.processed"
-done
+    for fastqc_out_dir in $(find "${RUN_DIR}" -maxdepth 1 -type d \( -name "${SAMPLENM}_1P_fastqc" -o -name "${SAMPLENM}_2P_fastqc" -o -name "${SAMPLENM}_trimmed_fastqc" \))
+    do
+        read_no=$(basename "${fastqc_out_dir}" | sed -nr 's/.*(1|2)P_fastqc/\1/p')
+        # If the files are single-end, then $read_no is empty
+        if [ -z "${read_no}" ]
+        then
+            read_no="1"
+        fi
+        out_pref="${SAMPLENM}_${read_no}.trimmed_readcount.txt"
+        echo "${SAMPLENM} $(grep '^Total Sequences' ${fastqc_out_dir}/fastqc_data.txt | cut -f 2)" > "${out_pref}"
+        awk '/>>Per base sequence quality/{flag=1; next} />>END_MODULE/{flag=0} flag' \
+            "${fastqc_out_dir}/fastqc_data.txt" \
+            | sed -e 's/ /./g' \
+            > "${RUN_DIR}/${SAMPLENM}_${read_no}.trim_quals.txt"
+        rm -rf "${fastqc_out_dir}.processed"
+        mv -f "${fastqc_out_dir}" "${fastqc_out_dir}.processed"
+    done
+}
 
 # HISAT2 chokes on quoted reads. We have to do this dumb quoting strategy because
 # some filenames may have spaces in them, and this protects it. My thought is that
 # the Perl wrapper script splits arguments with spaces in them
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="HISAT2"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-if [ ! -f hisat2.done ]; then
-    if [ "${TRIM}" = "yes" ]; then
-        if [ "${PE}" = "true" ]
-        then
-            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Aligning trimmed reads with HISAT2." >> "${LOG_FNAME}"
-            # This string is so ugly because we we have to quote the arguments to hisat2 in a weird way to protect them from splitting
-            hisat2 \
-                ${HISAT2OPTS} \
-                -x "${HISAT2INDEX}" \
-                -1 <(gzip -cd "${SAMPLENM}_1P.fq.gz" || cat "${SAMPLENM}_1P.fq") \
-                -2 <(gzip -cd "${SAMPLENM}_2P.fq.gz" || cat "${SAMPLENM}_2P.fq") \
-                2> alignment.summary \
-                | samtools view -hb -o "${SAMPLENM}.bam" - \
-                && touch hisat2.done \
-                || pipeline_error "${LOG_SECTION}"
+step_hisat2() {
+    if [ ! -f hisat2.done ]; then
+        if [ "${TRIM}" = "yes" ]; then
+            if [ "${PE}" = "true" ]
+            then
+                echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Aligning trimmed reads with HISAT2." >> "${LOG_FNAME}"
+                # This string is so ugly because we we have to quote the arguments to hisat2 in a weird way to protect them from splitting
+                hisat2 \
+                    ${HISAT2OPTS} \
+                    -p "${STEP_CPUS}" \
+                    -x "${HISAT2INDEX}" \
+                    -1 <(gzip -cd "${SAMPLENM}_1P.fq.gz" || cat "${SAMPLENM}_1P.fq") \
+                    -2 <(gzip -cd "${SAMPLENM}_2P.fq.gz" || cat "${SAMPLENM}_2P.fq") \
+                    2> alignment.summary \
+                    | samtools view -hb -o "${SAMPLENM}.bam" - \
+                    && touch hisat2.done \
+                    || pipeline_error "${LOG_SECTION}"
+            else
+                echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Aligning trimmed reads with HISAT2." >> "${LOG_FNAME}"
+                hisat2 \
+                    ${HISAT2OPTS} \
+                    -p "${STEP_CPUS}" \
+                    -x "${HISAT2INDEX}" \
+                    -U <(gzip -cd "${SAMPLENM}_trimmed.fq.gz" || cat "${SAMPLENM}_trimmed.fq.gz") \
+                    2> alignment.summary \
+                    | samtools view -hb -o "${SAMPLENM}.bam" - \
+                    && touch hisat2.done \
+                    || pipeline_error "${LOG_SECTION}"
+            fi
         else
-            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Aligning trimmed reads with HISAT2." >> "${LOG_FNAME}"
-            hisat2 \
-                ${HISAT2OPTS} \
-                -x "${HISAT2INDEX}" \
-                -U <(gzip -cd "${SAMPLENM}_trimmed.fq.gz" || cat "${SAMPLENM}_trimmed.fq.gz") \
-                2> alignment.summary \
-                | samtools view -hb -o "${SAMPLENM}.bam" - \
-                && touch hisat2.done \
-                || pipeline_error "${LOG_SECTION}"
-        fi
-    else
-        if [ "${PE}" = "true" ]
-        then
-            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Aligning reads with HISAT2." >> "${LOG_FNAME}"
-            hisat2 \
-                ${HISAT2OPTS} \
-                -x "${HISAT2INDEX}" \
-                -1 <(gzip -cd "${R1FILE}" || cat "${R1FILE}") \
-                -2 <(gzip -cd "${R2FILE}" || cat "${R2FILE}") \
-                2> alignment.summary \
-                | samtools view -hb -o "${SAMPLENM}.bam" - \
-                && touch hisat2.done \
-                || pipeline_error "${LOG_SECTION}"
-        else
-            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Aligning reads with HISAT2." >> "${LOG_FNAME}"
-            hisat2 \
-                ${HISAT2OPTS} \
-                -x "${HISAT2INDEX}" \
-                -U <(gzip -cd "${R1FILE}" || cat "${R1FILE}") \
-                2> alignment.summary \
-                | samtools view -hb -o "${SAMPLENM}.bam" - \
-                && touch hisat2.done \
-                || pipeline_error "${LOG_SECTION}"
+            if [ "${PE}" = "true" ]
+            then
+                echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Aligning reads with HISAT2." >> "${LOG_FNAME}"
+                hisat2 \
+                    ${HISAT2OPTS} \
+                    -p "${STEP_CPUS}" \
+                    -x "${HISAT2INDEX}" \
+                    -1 <(gzip -cd "${R1FILE}" || cat "${R1FILE}") \
+                    -2 <(gzip -cd "${R2FILE}" || cat "${R2FILE}") \
+                    2> alignment.summary \
+                    | samtools view -hb -o "${SAMPLENM}.bam" - \
+                    && touch hisat2.done \
+                    || pipeline_error "${LOG_SECTION}"
+            else
+                echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Aligning reads with HISAT2." >> "${LOG_FNAME}"
+                hisat2 \
+                    ${HISAT2OPTS} \
+                    -p "${STEP_CPUS}" \
+                    -x "${HISAT2INDEX}" \
+                    -U <(gzip -cd "${R1FILE}" || cat "${R1FILE}") \
+                    2> alignment.summary \
+                    | samtools view -hb -o "${SAMPLENM}.bam" - \
+                    && touch hisat2.done \
+                    || pipeline_error "${LOG_SECTION}"
+            fi
         fi
+        # Stick the alignment summary onto the analysis log
+        cat alignment.summary >> "${LOG_FNAME}"
     fi
-    # Stick the alignment summary onto the analysis log
-    cat alignment.summary >> "${LOG_FNAME}"
-fi
+}
 
 # Next, mark or remove duplicates
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="MarkDuplicates"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-if [ ! -f dup.done ]; then
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Soring raw HISAT2 BAM by query in prep for deduplication." >> "${LOG_FNAME}"
-    _JAVA_OPTIONS="-Djava.io.tmpdir=${WORKDIR}/singlesamples/${SAMPLENM}/picard_tmp" picard \
-        SortSam \
-        -I "${SAMPLENM}.bam" \
-        -O "${SAMPLENM}_Raw_QuerySort.bam" \
-        --SORT_ORDER "queryname" \
-        2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
-    if [ "${RMDUP}" = "yes" ]; then 
-        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Removing duplicate reads with Picard MarkDuplicates." >> "${LOG_FNAME}"
-        _JAVA_OPTIONS="-Djava.io.tmpdir=${WORKDIR}/singlesamples/${SAMPLENM}/picard_tmp" picard \
-            MarkDuplicates \
-            -I "${SAMPLENM}_Raw_QuerySort.bam" \
-            -O "${SAMPLENM}_Raw_DeDup.bam" \
-            --REMOVE_DUPLICATES "true" \
-            --ASSUME_SORT_ORDER "queryname" \
-            -M "${SAMPLENM}_MarkDup_Metrics.txt" \
+step_markdup() {
+    if [ ! -f dup.done ]; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Soring raw HISAT2 BAM by query in prep for deduplication." >> "${LOG_FNAME}"
+        _JAVA_OPTIONS="-Xmx${PICARD_HEAP_MB}m -Djava.io.tmpdir=${RUN_DIR}/picard_tmp" picard \
+            SortSam \
+            -I "${SAMPLENM}.bam" \
+            -O "${SAMPLENM}_Raw_QuerySort.bam" \
+            --SORT_ORDER "queryname" \
             2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
-        # Set the name of the bam to filter
-        TO_FLT="${SAMPLENM}_Raw_DeDup.bam"
+        if [ "${RMDUP}" = "yes" ]; then 
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Removing duplicate reads with Picard MarkDuplicates." >> "${LOG_FNAME}"
+            _JAVA_OPTIONS="-Xmx${PICARD_HEAP_MB}m -Djava.io.tmpdir=${RUN_DIR}/picard_tmp" picard \
+                MarkDuplicates \
+                -I "${SAMPLENM}_Raw_QuerySort.bam" \
+                -O "${SAMPLENM}_Raw_DeDup.bam" \
+                --REMOVE_DUPLICATES "true" \
+                --ASSUME_SORT_ORDER "queryname" \
+                -M "${SAMPLENM}_MarkDup_Metrics.txt" \
+                2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+        else
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Marking duplicate reads with Picard MarkDuplicates." >> "${LOG_FNAME}"
+            _JAVA_OPTIONS="-Xmx${PICARD_HEAP_MB}m -Djava.io.tmpdir=${RUN_DIR}/picard_tmp" picard \
+                MarkDuplicates \
+                -I "${SAMPLENM}_Raw_QuerySort.bam" \
+                -O "${SAMPLENM}_Raw_MarkDup.bam" \
+                --REMOVE_DUPLICATES "false" \
+                --ASSUME_SORT_ORDER "queryname" \
+                -M "${SAMPLENM}_MarkDup_Metrics.txt" \
+                2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+        fi
+        touch dup.done
     else
-        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Marking duplicate reads with Picard MarkDuplicates." >> "${LOG_FNAME}"
-        _JAVA_OPTIONS="-Djava.io.tmpdir=${WORKDIR}/singlesamples/${SAMPLENM}/picard_tmp" picard \
-            MarkDuplicates \
-            -I "${SAMPLENM}_Raw_QuerySort.bam" \
-            -O "${SAMPLENM}_Raw_MarkDup.bam" \
-            --REMOVE_DUPLICATES "false" \
-            --ASSUME_SORT_ORDER "queryname" \
-            -M "${SAMPLENM}_MarkDup_Metrics.txt" \
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found deduplicated/marked BAM files." >> "${LOG_FNAME}"
+    fi
+}
+
+# Next, remove unmapped reads and reads with MAPQ<60
+step_bam_filter() {
+    if [ ! -f mapq_flt.done ]; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Removing unmapped and MAPQ<60 reads for counting." >> "${LOG_FNAME}"
+        samtools view \
+            -bh \
+            -@ "${STEP_CPUS}" \
+            -F 4 \
+            -q 60 \
+            -o "${SAMPLENM}_MAPQFiltered.bam" \
+            "${TO_FLT}"
+        touch mapq_flt.done
+    else
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found filtered BAM for counting." >> "${LOG_FNAME}"
+    fi
+}
+
+# Next, sort by coord for IGV purposes
+step_coord_sort() {
+    if [ ! -f coord_sort.done ]; then
+        echo "$ ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T' ): Removing any old SAMtools sort files." >> "${LOG_FNAME}"
+        find "${RUN_DIR}" \
+            -mindepth 1 \
+            -maxdepth 1 \
+            -regextype posix-extended \
+            -regex '.*/temp\.[0-9]{4}+.bam' \
+            -exec rm {} \;
+        # The sort buffers of the step are split among its threads
+        local sort_mem=$(( SORT_BUFFER_MB / STEP_CPUS ))
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Sorting filtered BAM file by coordinate." >> "${LOG_FNAME}"
+        samtools sort \
+            -O bam \
+            -@ "${STEP_CPUS}" \
+            -m "${sort_mem}M" \
+            -T temp \
+            -o "${SAMPLENM}_MAPQFiltered_CoordSort.bam" \
+            "${SAMPLENM}_MAPQFiltered.bam" \
+            2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Sorting raw BAM file by coordinate." >> "${LOG_FNAME}"
+        samtools sort \
+            -O bam \
+            -@ "${STEP_CPUS}" \
+            -m "${sort_mem}M" \
+            -T temp \
+            -o "${SAMPLENM}_Raw_CoordSort.bam" \
+            "${TO_FLT}" \
             2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
-        TO_FLT="${SAMPLENM}_Raw_MarkDup.bam"
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Indexing coordinate-sorted BAM files." >> "${LOG_FNAME}"
+        samtools index "${SAMPLENM}_MAPQFiltered_CoordSort.bam"
+        samtools index "${SAMPLENM}_Raw_CoordSort.bam"
+        touch coord_sort.done
+    else
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found sorted and indexed BAM files." >> "${LOG_FNAME}"
     fi
-    touch dup.done
-else
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found deduplicated/marked BAM files." >> "${LOG_FNAME}"
-    # But, be sure to set the TO_FLT variable:
-    if [ "${RMDUP}" = "yes" ]; then
-        TO_FLT="${SAMPLENM}_Raw_DeDup.bam"
+}
+
+# Generate some stats on the raw BAM for the report
+step_bam_stats() {
+    if [ ! -f bamstats.done ]; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Generating alignment stats based on raw BAM." >> "${LOG_FNAME}"
+        samtools stats "${RAW_COORD}" > "${SAMPLENM}_bamstats.txt"
+        touch bamstats.done
     else
-        TO_FLT="${SAMPLENM}_Raw_MarkDup.bam"
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found raw BAM stats." >> "${LOG_FNAME}"
     fi
-fi
+}
 
-# Next, remove unmapped reads and reads with MAPQ<60
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="BAM.Filtering"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-if [ ! -f mapq_flt.done ]; then
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Removing unmapped and MAPQ<60 reads for counting." >> "${LOG_FNAME}"
-    samtools view \
-        -bh \
-        -@ "${SLURM_CPUS_PER_TASK}" \
-        -F 4 \
-        -q 60 \
-        -o "${SAMPLENM}_MAPQFiltered.bam" \
-        "${TO_FLT}"
-    touch mapq_flt.done
-else
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found filtered BAM for counting." >> "${LOG_FNAME}"
-fi
+# Try the RNASeQC metrics gathering. RNASeQC takes one strand setting per run,
+# so it is run twice for stranded libraries. For unstranded libraries, both
+# runs would be the same, so it is run once and the stranded metrics are a copy
+# of the unstranded ones. With --bam-metrics pysam-rnaseqc, both sets come from
+# one pass over the BAM instead.
+step_rnaseqc() {
+    echo "# $(date '+%F %T'): Note, this section is OPTIONAL (errors will not kill pipeline jobs)." >> /dev/stderr
+    if [ ! -f rnaseqc.done ]; then
+        if [ "${BAM_METRICS:-tools}" = "pysam-rnaseqc" ]; then
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Collecting unstranded and stranded RNAseq metrics in one pass over the raw BAM." >> "${LOG_FNAME}"
+            PYTHONPATH="${CHURP_DIR}" python3 -m CHURPipelines.FileOps.bam_metrics \
+                --metrics rnaseqc \
+                --bam "${RAW_COORD}" \
+                --gtf "${GTFFILE}" \
+                --sample "${SAMPLENM}" \
+                --paired "${PE}" \
+                --stranded "${RNASEQC_STRANDED}" \
+                --index-dir "${WORKDIR}/gene_index" \
+                --threads "${STEP_CPUS}" \
+                2>> "${LOG_FNAME}" || true
+            touch rnaseqc.done
+            return 0
+        fi
+        # The collapsed GTF is written once per run, by the first sample that
+        # needs it, and shared by the others. It is written to a temporary
+        # file and renamed, so a sample never reads a partial file. As with
+        # the gene index of bam_metrics, it is named by the path, size, and
+        # modification time of the GTF, so a working directory that is reused
+        # with a different or replaced GTF gets a new one, even if the new GTF
+        # is older than the collapsed one.
+        GTF_KEY=$(printf '%s\t%s\t%s' "$(readlink -f "${GTFFILE}")" "$(stat -L -c '%s' "${GTFFILE}")" "$(stat -L -c '%Y' "${GTFFILE}")" | sha1sum | cut -c 1-16)
+        COLLAPSED_GTF="${WORKDIR}/gene_index/collapsed.${GTF_KEY}.gtf"
+        if [ ! -s "${COLLAPSED_GTF}" ]; then
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): 'Collapsing' gene models in GTF for use with RNASeQC." >> "${LOG_FNAME}"
+            mkdir -p "${WORKDIR}/gene_index"
+            python "${COLLAPSE_GTF}" <(gzip -cd "${GTFFILE}" || cat "${GTFFILE}") "${COLLAPSED_GTF}.${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID}.tmp" \
+                && mv -f "${COLLAPSED_GTF}.${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID}.tmp" "${COLLAPSED_GTF}" \
+                || true
+            rm -f "${COLLAPSED_GTF}.${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID}.tmp"
+        else
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found collapsed GTF for RNASeQC." >> "${LOG_FNAME}"
+        fi
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Collecting unstranded RNAseq metrics with RNASeQC." >> "${LOG_FNAME}"
+        RNASEQC_OPTIONS="-v -v --sample=${SAMPLENM}_Unstranded --legacy"
+        "${RNASEQC}" \
+            "${COLLAPSED_GTF}" \
+            "${RUN_DIR}/${RAW_COORD}" \
+            "${RUN_DIR}/RNASeQC_Out" \
+            ${RNASEQC_OPTIONS} 2>> "${LOG_FNAME}" || true
+        if [ "${RNASEQC_STRANDED}" = "none" ]; then
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Library is unstranded; using the unstranded RNAseq metrics for both." >> "${LOG_FNAME}"
+            if [ -s "RNASeQC_Out/${SAMPLENM}_Unstranded.metrics.tsv" ]; then
+                {
+                    echo -e "Sample\t${SAMPLENM}"
+                    tail -n +2 "RNASeQC_Out/${SAMPLENM}_Unstranded.metrics.tsv"
+                } > "RNASeQC_Out/${SAMPLENM}.metrics.tsv"
+            fi
+        else
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Collecting stranded RNAseq metrics with RNASeQC." >> "${LOG_FNAME}"
+            RNASEQC_OPTIONS="-v -v --sample=${SAMPLENM} --legacy --stranded=${RNASEQC_STRANDED}"
+            "${RNASEQC}" \
+                "${COLLAPSED_GTF}" \
+                "${RUN_DIR}/${RAW_COORD}" \
+                "${RUN_DIR}/RNASeQC_Out" \
+                ${RNASEQC_OPTIONS} 2>> "${LOG_FNAME}" || true
+        fi
+        touch rnaseqc.done
+    else
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found RNAseq metrics checkpoint." >> "${LOG_FNAME}"
+    fi
+}
 
-# Next, sort by coord for IGV purposes
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="BAM.Coord.Sort"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-if [ ! -f coord_sort.done ]; then
-    echo "$ ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T' ): Removing any old SAMtools sort files." >> "${LOG_FNAME}"
-    find "${WORKDIR}/singlesamples/${SAMPLENM}" \
-        -mindepth 1 \
-        -maxdepth 1 \
-        -regextype posix-extended \
-        -regex '.*/temp\.[0-9]{4}+.bam' \
-        -exec rm {} \;
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Sorting filtered BAM file by coordinate." >> "${LOG_FNAME}"
-    samtools sort \
-        -O bam \
-        -@ "${SLURM_CPUS_PER_TASK}" \
-        -T temp \
-        -o "${SAMPLENM}_MAPQFiltered_CoordSort.bam" \
-        "${SAMPLENM}_MAPQFiltered.bam" \
-        2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Sorting raw BAM file by coordinate." >> "${LOG_FNAME}"
-    samtools sort \
-        -O bam \
-        -@ "${SLURM_CPUS_PER_TASK}" \
-        -T temp \
-        -o "${SAMPLENM}_Raw_CoordSort.bam" \
-        "${TO_FLT}" \
-        2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Indexing coordinate-sorted BAM files." >> "${LOG_FNAME}"
-    samtools index "${SAMPLENM}_MAPQFiltered_CoordSort.bam"
-    samtools index "${SAMPLENM}_Raw_CoordSort.bam"
-    touch coord_sort.done
+# Use picard to collect the insert size metrics, but only if paired end
+step_insert_size() {
+    if [ ! -f is_stats.done ]; then
+        if [ "${PE}" = "true" ]; then
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Collecting insert size metrics with Picard InsertSizeMetrics." >> "${LOG_FNAME}"
+            mkdir -p "${OUTDIR}/InsertSizeMetrics"
+            mkdir -p "${RUN_DIR}/picard_tmp"
+            _JAVA_OPTIONS="-Xmx${PICARD_HEAP_MB}m -Djava.io.tmpdir=${RUN_DIR}/picard_tmp -Djdk.lang.Process.launchMechanism=vfork" picard \
+                CollectInsertSizeMetrics \
+                -I "${RUN_DIR}/${FOR_COUNTS}" \
+                -O "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_metrics.txt" \
+                -H "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_hist.pdf" \
+                2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+            # Extract the mean, median, standard deviation from the metrics file
+            if [ -s "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_metrics.txt" ]; then
+                grep \
+                    -A 1 \
+                    '^MEDIAN_INSERT_SIZE' \
+                    "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_metrics.txt" \
+                    | tail -n 1 \
+                    | cut -f 1,6,7,10,12,16,18 \
+                    > "${RUN_DIR}/IS_Stats.txt"
+            else
+                # Echo seven NA into the IS stats file
+                echo -e 'NA\tNA\tNA\tNA\tNA\tNA\tNA' \
+                > "${RUN_DIR}/IS_Stats.txt"
+            fi
+        else
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Sample is single-read. No insert size metrics possible." >> "${LOG_FNAME}"
+        fi
+        touch is_stats.done
+    else
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found insert size metrics." >> "${LOG_FNAME}"
+    fi
+}
+
+# Collect the samtools stats, RNASeQC, and insert size metrics in one pass over
+# the raw BAM, instead of with the three steps above. The gene index is built
+# from the GTF by the first sample and shared by the others.
+step_bam_metrics() {
+    if [ ! -f bam_metrics.done ]; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Collecting alignment, RNAseq, and insert size metrics in one pass over the raw BAM." >> "${LOG_FNAME}"
+        mkdir -p "${OUTDIR}/InsertSizeMetrics"
+        PYTHONPATH="${CHURP_DIR}" python3 -m CHURPipelines.FileOps.bam_metrics \
+            --bam "${RAW_COORD}" \
+            --gtf "${GTFFILE}" \
+            --sample "${SAMPLENM}" \
+            --paired "${PE}" \
+            --stranded "${RNASEQC_STRANDED}" \
+            --index-dir "${WORKDIR}/gene_index" \
+            --threads "${STEP_CPUS}" \
+            --is-metrics "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_metrics.txt" \
+            2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+        touch bam_metrics.done
+    else
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found BAM metrics checkpoint." >> "${LOG_FNAME}"
+    fi
+}
+
+# Use awk to pick apart the alignment summary
+step_aln_summary() {
+    if [ "${PE}" = "true" ]
+    then
+        TOTAL_READS=$(awk '/Total pairs:/ {print $NF}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
+        UNMAP=$(awk '/Aligned concordantly or discordantly 0 time/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
+        SINGLE_MAP=$(awk '/Aligned concordantly 1 time/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
+        MULTI_MAP=$(awk '/Aligned concordantly >1 times/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
+        DISCO_MAP=$(awk '/Aligned discordantly 1 time/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
+    else
+        TOTAL_READS=$(awk '/Total reads:/ {print $NF}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
+        UNMAP=$(awk '/Aligned 0 time/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
+        SINGLE_MAP=$(awk '/Aligned 1 time/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
+        MULTI_MAP=$(awk '/Aligned >1 times/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
+        DISCO_MAP="NA"
+    fi
+    echo "${SAMPLENM} ${TOTAL_READS} ${UNMAP} ${SINGLE_MAP} ${MULTI_MAP} ${DISCO_MAP}" > "hisat_map_summary.txt"
+}
+
+# Set the names of the BAM files that are shared between steps and linked at
+# the end of the script
+if [ "${RMDUP}" = "yes" ]; then
+    TO_FLT="${SAMPLENM}_Raw_DeDup.bam"
 else
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found sorted and indexed BAM files." >> "${LOG_FNAME}"
+    TO_FLT="${SAMPLENM}_Raw_MarkDup.bam"
 fi
-
-# Set these variables for linking at the end of the script
 FOR_COUNTS="${SAMPLENM}_MAPQFiltered.bam"
 RAW_COORD="${SAMPLENM}_Raw_CoordSort.bam"
 RAW_COORD_IDX="${SAMPLENM}_Raw_CoordSort.bam.bai"
 FLT_COORD="${SAMPLENM}_MAPQFiltered_CoordSort.bam"
 FLT_COORD_IDX="${SAMPLENM}_MAPQFiltered_CoordSort.bam.bai"
+# The per-sample results that are kept after the intermediate files are
+# removed. They are copied back from node-local space, and stored in the cache.
+SAMPLE_RESULTS=(
+    "${FOR_COUNTS}"
+    "${RAW_COORD}"
+    "${RAW_COORD_IDX}"
+    "${FLT_COORD}"
+    "${FLT_COORD_IDX}"
+    "${SAMPLENM}_bamstats.txt"
+    "${SAMPLENM}_MarkDup_Metrics.txt"
+    "alignment.summary"
+    "hisat_map_summary.txt"
+    "BBDuk_rRNA_Stats.txt"
+    "IS_Stats.txt"
+    "RNASeQC_Out")
 
-# Generate some stats on the raw BAM for the report
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="BAM.Stats"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-if [ ! -f bamstats.done ]; then
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Generating alignment stats based on raw BAM." >> "${LOG_FNAME}"
-    samtools stats "${RAW_COORD}" > "${SAMPLENM}_bamstats.txt"
-    touch bamstats.done
-else
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found raw BAM stats." >> "${LOG_FNAME}"
-fi
-
-# Try the RNASeQC metrics gathering
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="RNASeQC"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-echo "# $(date '+%F %T'): Note, this section is OPTIONAL (errors will not kill pipeline jobs)." >> /dev/stderr
-if [ ! -f rnaseqc.done ]; then
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): 'Collapsing' gene models in GTF for use with RNASeQC." >> "${LOG_FNAME}"
-    python "${COLLAPSE_GTF}" <(gzip -cd "${GTFFILE}" || cat "${GTFFILE}") "${WORKDIR}/singlesamples/${SAMPLENM}/collapsed.gtf" || true
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Collecting unstranded RNAseq metrics with RNASeQC." >> "${LOG_FNAME}"
-    RNASEQC_OPTIONS="-v -v --sample=${SAMPLENM}_Unstranded --legacy"
-    "${RNASEQC}" \
-        "${WORKDIR}/singlesamples/${SAMPLENM}/collapsed.gtf" \
-        "${WORKDIR}/singlesamples/${SAMPLENM}/${RAW_COORD}" \
-        "${WORKDIR}/singlesamples/${SAMPLENM}/RNASeQC_Out" \
-        ${RNASEQC_OPTIONS} 2>> "${LOG_FNAME}" || true
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Collecting stranded RNAseq metrics with RNASeQC." >> "${LOG_FNAME}"
-    RNASEQC_OPTIONS="-v -v --sample=${SAMPLENM} --legacy"
-    # A bit strange - if the data are single-read data, then the strand has to
-    # be flipped. This was confirmed with single-read pico v2 and pico v1 data.
-    if [[ "${STRAND}" = "2" && "${PE}" = "true" ]]; then
-        RNASEQC_OPTIONS="${RNASEQC_OPTIONS} --stranded=RF"
-    elif [[ "${STRAND}" = "1" && "${PE}" = "true" ]]; then
-        RNASEQC_OPTIONS="${RNASEQC_OPTIONS} --stranded=FR"
-    elif [[ "${STRAND}" = "2" && "${PE}" = "false" ]]; then
-        RNASEQC_OPTIONS="${RNASEQC_OPTIONS} --stranded=FR"
-    elif [[ "${STRAND}" = "1" && "${PE}" = "false" ]]; then
-        RNASEQC_OPTIONS="${RNASEQC_OPTIONS} --stranded=RF"
-    fi
-    "${RNASEQC}" \
-        "${WORKDIR}/singlesamples/${SAMPLENM}/collapsed.gtf" \
-        "${WORKDIR}/singlesamples/${SAMPLENM}/${RAW_COORD}" \
-        "${WORKDIR}/singlesamples/${SAMPLENM}/RNASeQC_Out" \
-        ${RNASEQC_OPTIONS} 2>> "${LOG_FNAME}" || true
-    touch rnaseqc.done
-else
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found RNAseq metrics checkpoint." >> "${LOG_FNAME}"
-fi
+# The steps run in RUN_DIR. With STAGE_LOCAL_MB set, this is a directory in
+# node-local space (${TMPDIR}), so that the trimmed reads, the unsorted BAMs,
+# and the sort and Picard temporary files stay off the shared file system. The
+# files that are already in the sample directory are linked into it, so the
+# checkpoints work as usual. If the local space is not there, or is smaller
+# than STAGE_FACTOR times the size of the reads (or the --tmp request of the
+# job), the steps run in the sample directory instead.
+SAMPLE_DIR="${PWD}"
+RUN_DIR="${PWD}"
+STAGE_DIR=""
+STAGE_FACTOR="4"
+stage_local() {
+    local need avail f
+    if [[ -z "${TMPDIR:-}" || ! -d "${TMPDIR}" || ! -w "${TMPDIR}" ]]; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): TMPDIR is not a writable directory; running ${SAMPLENM} in ${SAMPLE_DIR}." >> "${LOG_FNAME}"
+        return 0
+    fi
+    need=$(stat -L -c '%s' "${R1FILE}" ${R2FILE:+"${R2FILE}"} | awk -v f="${STAGE_FACTOR}" '{ s += $1 } END { printf "%.0f", s * f }') || need=""
+    avail=$(df -P -k "${TMPDIR}" | awk -v l="${STAGE_LOCAL_MB}" 'NR == 2 { a = $4 * 1024; if (a > l * 1048576) a = l * 1048576; printf "%.0f", a }') || avail=""
+    if [[ -z "${need}" || -z "${avail}" || "${avail}" -lt "${need}" ]]; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): ${SAMPLENM} needs about ${need:-unknown} bytes of node-local space, and ${avail:-unknown} are available; running in ${SAMPLE_DIR}." >> "${LOG_FNAME}"
+        return 0
+    fi
+    STAGE_DIR="${TMPDIR}/churp.${SLURM_JOB_ID}.${SAMPLENM}"
+    rm -rf "${STAGE_DIR}"
+    if ! mkdir -p "${STAGE_DIR}"; then
+        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Could not make ${STAGE_DIR}; running ${SAMPLENM} in ${SAMPLE_DIR}." >> "${LOG_FNAME}"
+        STAGE_DIR=""
+        return 0
+    fi
+    for f in "${SAMPLE_DIR}"/*
+    do
+        if [ -e "${f}" ]; then
+            ln -s "${f}" "${STAGE_DIR}/"
+        fi
+    done
+    RUN_DIR="${STAGE_DIR}"
+    cd "${RUN_DIR}"
+    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Running the steps for ${SAMPLENM} in node-local space, ${RUN_DIR}." >> "${LOG_FNAME}"
+}
+# Copy the results that were made in node-local space back into the sample
+# directory. The checkpoints go last, so a checkpoint is never copied without
+# its results. With "all", which is used when the job fails, every file that
+# the steps made is copied, so that the intermediate files of the steps that
+# finished are there for the steps that did not.
+copy_back() {
+    local f
+    local -a files
+    if [ "${1:-}" = "all" ]; then
+        files=(*)
+    else
+        files=("${SAMPLE_RESULTS[@]}" *_readcount.txt *_quals.txt *_fastqc.html *_fastqc.zip)
+    fi
+    for f in "${files[@]}"
+    do
+        if [[ "${f}" != *.done && -e "${f}" && ! -L "${f}" ]]; then
+            rm -rf "${SAMPLE_DIR:?}/${f}" || return 1
+            cp -r "${f}" "${SAMPLE_DIR}/" || return 1
+        fi
+    done
+    for f in *.done
+    do
+        if [[ -e "${f}" && ! -L "${f}" ]]; then
+            cp "${f}" "${SAMPLE_DIR}/" || return 1
+        fi
+    done
+}
 
-# Use picard to collect the insert size metrics, but only if paired end
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="InsertSizeMetrics"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-if [ ! -f is_stats.done ]; then
+# A shard task trims and aligns its shard of the reads. The shard is every n-th
+# block of records of the FASTQ files, so that the mates of paired reads stay
+# in the same shard. The reads are split into all of the shards of the sample
+# in one pass, by the first of its shard tasks to take the lock directory in
+# ${SHARD_DIR}/split. The others wait for split.done, which holds the number
+# of shards, so that a split for another --shard-size is not used. The shards
+# are written to temporary files and renamed, so a task that is aligning its
+# shard keeps reading the old file if the reads are split again. The lock is
+# touched while the split runs, and a lock that has not been touched for ten
+# minutes was left by a task that died, so it is taken over.
+SHARD_BLOCK="100000"
+SPLIT_DIR="${SHARD_DIR}/split"
+split_ready() {
+    [ "$(cat "${SPLIT_DIR}/split.done" 2> /dev/null)" = "${SHARD_COUNT}" ] || return 1
+    [ -f "${SPLIT_DIR}/Shard${SHARD_NUM}_R1.fastq.gz" ] || return 1
     if [ "${PE}" = "true" ]; then
-        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Collecting insert size metrics with Picard InsertSizeMetrics." >> "${LOG_FNAME}"
-        mkdir -p "${OUTDIR}/InsertSizeMetrics"
-        mkdir -p "${WORKDIR}/singlesamples/${SAMPLENM}/picard_tmp"
-        _JAVA_OPTIONS="-Djava.io.tmpdir=${WORKDIR}/singlesamples/${SAMPLENM}/picard_tmp -Djdk.lang.Process.launchMechanism=vfork" picard \
-            CollectInsertSizeMetrics \
-            -I "${WORKDIR}/singlesamples/${SAMPLENM}/${FOR_COUNTS}" \
-            -O "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_metrics.txt" \
-            -H "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_hist.pdf" \
-            2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
-        # Extract the mean, median, standard deviation from the metrics file
-        if [ -s "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_metrics.txt" ]; then
-            grep \
-                -A 1 \
-                '^MEDIAN_INSERT_SIZE' \
-                "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_metrics.txt" \
-                | tail -n 1 \
-                | cut -f 1,6,7,10,12,16,18 \
-                > "${WORKDIR}/singlesamples/${SAMPLENM}/IS_Stats.txt"
+        [ -f "${SPLIT_DIR}/Shard${SHARD_NUM}_R2.fastq.gz" ] || return 1
+    fi
+}
+split_reads() {
+    # Each shard is compressed by its own gzip, so the shards are compressed
+    # in parallel while awk reads the FASTQ once
+    (gzip -cd "${1}" || cat "${1}") \
+        | awk -v n="${SHARD_COUNT}" -v b="${SHARD_BLOCK}" -v pre="${SPLIT_DIR}/Shard" -v suf="_${2}.fastq.gz.${SLURM_JOB_ID}.tmp" '
+            BEGIN { for (i = 1; i <= n; i++) out[i] = "gzip -1 > \"" pre i suf "\"" }
+            { print | out[int((NR - 1) / (4 * b)) % n + 1] }
+            END { for (i = 1; i <= n; i++) close(out[i]) }'
+}
+split_all_shards() {
+    local k r
+    local -a mates=(R1)
+    local r1_pid
+    if [ "${PE}" = "true" ]; then
+        mates+=(R2)
+    fi
+    rm -f "${SPLIT_DIR}/split.done"
+    split_reads "${SHEET[FastqR1files]}" R1 &
+    r1_pid="$!"
+    if [ "${PE}" = "true" ]; then
+        split_reads "${SHEET[FastqR2file]}" R2 || { wait "${r1_pid}"; return 1; }
+    fi
+    wait "${r1_pid}" || return 1
+    for k in $(seq 1 "${SHARD_COUNT}")
+    do
+        for r in "${mates[@]}"
+        do
+            # A shard past the end of the reads gets no records
+            if [ ! -e "${SPLIT_DIR}/Shard${k}_${r}.fastq.gz.${SLURM_JOB_ID}.tmp" ]; then
+                gzip -1 < /dev/null > "${SPLIT_DIR}/Shard${k}_${r}.fastq.gz.${SLURM_JOB_ID}.tmp" || return 1
+            fi
+            mv -f "${SPLIT_DIR}/Shard${k}_${r}.fastq.gz.${SLURM_JOB_ID}.tmp" "${SPLIT_DIR}/Shard${k}_${r}.fastq.gz" || return 1
+        done
+    done
+    echo "${SHARD_COUNT}" > "${SPLIT_DIR}/split.done"
+}
+step_shard_split() {
+    local status heartbeat_pid
+    mkdir -p "${SPLIT_DIR}"
+    until split_ready
+    do
+        if mkdir "${SPLIT_DIR}/lock" 2> /dev/null; then
+            if ! split_ready; then
+                echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Splitting the reads of ${SAMPLENM} into ${SHARD_COUNT} shards." >> "${LOG_FNAME}"
+                (while sleep 60; do touch "${SPLIT_DIR}/lock"; done) &
+                heartbeat_pid="$!"
+                status=0
+                split_all_shards 2>> "${LOG_FNAME}" || status="$?"
+                kill "${heartbeat_pid}" 2> /dev/null || true
+                rm -f "${SPLIT_DIR}"/Shard*.fastq.gz."${SLURM_JOB_ID}".tmp
+                rmdir "${SPLIT_DIR}/lock"
+                if [ "${status}" -ne 0 ]; then
+                    pipeline_error "${LOG_SECTION}"
+                fi
+            else
+                rmdir "${SPLIT_DIR}/lock"
+            fi
+        elif [ -n "$(find "${SPLIT_DIR}/lock" -maxdepth 0 -mmin +10 2> /dev/null)" ]; then
+            echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Taking over the stale split lock of ${SAMPLENM}." >> "${LOG_FNAME}"
+            rmdir "${SPLIT_DIR}/lock" 2> /dev/null || true
         else
-            # Echo seven NA into the IS stats file
-            echo -e 'NA\tNA\tNA\tNA\tNA\tNA\tNA' \
-            > "${WORKDIR}/singlesamples/${SAMPLENM}/IS_Stats.txt"
+            sleep 30
         fi
-    else
-        echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Sample is single-read. No insert size metrics possible." >> "${LOG_FNAME}"
+    done
+    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found shard ${SHARD_NUM} of ${SHARD_COUNT} in the split reads." >> "${LOG_FNAME}"
+}
+
+# Add the steps with the sections that they depend on, and the least and most
+# cores and the memory (MB) that each one can use. The steps are started in
+# this order when there is room for them, so the steps on the way to the
+# counts go first. The cores and the memory of the tools that can be sized
+# (the heaps of BBDuk and Picard, and the samtools sort buffers) come from the
+# budget of the job, so that BBDuk only runs alongside the alignment if --mem
+# has room for both of them.
+NCPU="${SLURM_CPUS_PER_TASK:-1}"
+BUDGET=$(PYTHONPATH="${CHURP_DIR}" python3 -m CHURPipelines.Schedulers.resource_budget \
+    --mem "${SLURM_MEM_PER_NODE:-0}" \
+    --cpus "${NCPU}" \
+    2>> "${LOG_FNAME}") || pipeline_error "Resource.Budget"
+eval "${BUDGET}"
+echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Resource budget: BBDuk heap ${BBDUK_HEAP_MB} MB, Picard heap ${PICARD_HEAP_MB} MB, samtools sort buffers ${SORT_BUFFER_MB} MB on up to ${SORT_CPU} threads, HISAT2 on up to ${BIG_CPU} threads." >> "${LOG_FNAME}"
+if [ -n "${SHARD_NUM}" ]; then
+    R1FILE="${SPLIT_DIR}/Shard${SHARD_NUM}_R1.fastq.gz"
+    if [ "${PE}" = "true" ]; then
+        R2FILE="${SPLIT_DIR}/Shard${SHARD_NUM}_R2.fastq.gz"
     fi
+    add_step "Shard.Split" step_shard_split 1 2 500
+    if [ "${TRIM}" = "yes" ]; then
+        add_step "Trimmomatic" step_trimmomatic "${HALF_CPU}" "${BIG_CPU}" 4000 "Shard.Split"
+    fi
+    add_step "HISAT2" step_hisat2 "${HALF_CPU}" "${BIG_CPU}" "${HISAT2_MB}" "Shard.Split" "Trimmomatic"
+    echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
+    profile_close 0
+    run_steps
+    LOG_SECTION="Cleanup"
+    echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+    profile_section
+    touch shard.done
+    rm -f "${R1FILE}" "${R2FILE}" "${SAMPLENM}_1U.fq.gz" "${SAMPLENM}_2U.fq.gz"
+    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Finished aligning shard ${SHARD_NUM} of ${SAMPLENM}." >> "${LOG_FNAME}"
+    echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
+    echo "# $(date '+%F %T'): Job complete" >> /dev/stderr
+    exec 5>&-
+    exit 0
+fi
+if [[ "${STAGE_LOCAL_MB:-0}" -gt 0 && "${CACHE_HIT}" = "false" ]]; then
+    stage_local
+fi
+if [ "${TRIM}" = "yes" ]; then
+    add_step "Trimmomatic" step_trimmomatic "${HALF_CPU}" "${BIG_CPU}" 4000
+fi
+add_step "HISAT2" step_hisat2 "${HALF_CPU}" "${BIG_CPU}" "${HISAT2_MB}" "Trimmomatic"
+add_step "MarkDuplicates" step_markdup 1 2 "${PICARD_MB}" "HISAT2"
+add_step "BAM.Filtering" step_bam_filter 1 "${BIG_CPU}" 1000 "MarkDuplicates"
+add_step "BAM.Coord.Sort" step_coord_sort 1 "${SORT_CPU}" "${SORT_MB}" "BAM.Filtering"
+add_step "FastQC.Raw" step_fastqc_raw 1 2 1000
+add_step "rRNA.Subsampling" step_rrna_subsample 1 1 500
+add_step "BBDuk" step_bbduk 1 2 "${BBDUK_MB}" "rRNA.Subsampling"
+if [ "${TRIM}" = "yes" ]; then
+    add_step "FastQC.Trimmed" step_fastqc_trimmed 1 2 1000 "Trimmomatic"
+fi
+add_step "Alignment.Summary" step_aln_summary 1 1 100 "HISAT2"
+if [ "${BAM_METRICS:-tools}" = "pysam" ]; then
+    add_step "BAM.Metrics" step_bam_metrics 1 "${BIG_CPU}" 8000 "BAM.Coord.Sort"
 else
-    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Found insert size metrics." >> "${LOG_FNAME}"
+    add_step "InsertSizeMetrics" step_insert_size 1 1 "${PICARD_MB}" "BAM.Filtering"
+    add_step "BAM.Stats" step_bam_stats 1 1 500 "BAM.Coord.Sort"
+    if [ "${BAM_METRICS:-tools}" = "pysam-rnaseqc" ]; then
+        add_step "RNASeQC" step_rnaseqc 1 "${BIG_CPU}" 8000 "BAM.Coord.Sort"
+    else
+        add_step "RNASeQC" step_rnaseqc 1 1 8000 "BAM.Coord.Sort"
+    fi
 fi
-
-# Use awk to pick apart the alignment summary
 echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="Alignment.Summary"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-if [ "${PE}" = "true" ]
-then
-    TOTAL_READS=$(awk '/Total pairs:/ {print $NF}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
-    UNMAP=$(awk '/Aligned concordantly or discordantly 0 time/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
-    SINGLE_MAP=$(awk '/Aligned concordantly 1 time/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
-    MULTI_MAP=$(awk '/Aligned concordantly >1 times/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
-    DISCO_MAP=$(awk '/Aligned discordantly 1 time/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
-else
-    TOTAL_READS=$(awk '/Total reads:/ {print $NF}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
-    UNMAP=$(awk '/Aligned 0 time/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
-    SINGLE_MAP=$(awk '/Aligned 1 time/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
-    MULTI_MAP=$(awk '/Aligned >1 times/ {F=NF-1; print $F}' alignment.summary 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}")
-    DISCO_MAP="NA"
+profile_close 0
+run_steps
+
+if [ -n "${STAGE_DIR}" ]; then
+    LOG_SECTION="Copy.Back"
+    echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+    profile_open
+    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Copying the results of ${SAMPLENM} from node-local space to ${SAMPLE_DIR}." >> "${LOG_FNAME}"
+    copy_back 2>> "${LOG_FNAME}" || pipeline_error "${LOG_SECTION}"
+    cd "${SAMPLE_DIR}"
+    rm -rf "${STAGE_DIR}"
+    STAGE_DIR=""
+    echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
 fi
-echo "${SAMPLENM} ${TOTAL_READS} ${UNMAP} ${SINGLE_MAP} ${MULTI_MAP} ${DISCO_MAP}" > "hisat_map_summary.txt"
 
 # the final step is to link the sorted.rmdup.bam file to the allsamples/
 # directory, as just the samplename. This is a bit of a hack to get featureCounts
 # to not print huge paths as samplenames
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
 LOG_SECTION="Cleanup"
 echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+profile_section
 echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Linking ${SAMPLENM} into ${WORKDIR}/allsamples" >> "${LOG_FNAME}"
 mkdir -p "${WORKDIR}/allsamples"
 ln -sf "${WORKDIR}/singlesamples/${SAMPLENM}/${FOR_COUNTS}" "${WORKDIR}/allsamples/${SAMPLENM}"
@@ -728,6 +1481,56 @@ touch "${SAMPLENM}.done"
 # Finally, let's clean up
 echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Removing HISAT2 bam, markdup/dedup bam, and raw querysort bam to reduce disk usage." >> "${LOG_FNAME}"
 rm -f "${SAMPLENM}.bam" "${SAMPLENM}_Raw_MarkDup.bam" "${SAMPLENM}_Raw_DeDup.bam" "${SAMPLENM}_Raw_QuerySort.bam"
+rm -rf "${SHARD_DIR}"
+
+# Copy the per-sample results into the shared cache. The entry is assembled in
+# a temporary directory and renamed into place, so other jobs never see a
+# partial entry. A failure here does not fail the sample.
+echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
+LOG_SECTION="Cache.Store"
+echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+profile_section
+echo "# $(date '+%F %T'): Note, this section is OPTIONAL (errors will not kill pipeline jobs)." >> /dev/stderr
+cache_store() {
+    local tmp_entry="${CACHE_DIR}/.${CACHEKEY}.${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID}.tmp"
+    local to_cache=(
+        "${SAMPLE_RESULTS[@]}"
+        subsamp.done bbduk.done fastqc.done trimmomatic.done fastqc.trim.done
+        hisat2.done dup.done mapq_flt.done coord_sort.done bamstats.done
+        rnaseqc.done is_stats.done bam_metrics.done)
+    rm -rf "${tmp_entry}"
+    mkdir -p "${tmp_entry}" || return 1
+    for f in "${to_cache[@]}" *_readcount.txt *_quals.txt
+    do
+        if [ -e "${f}" ]; then
+            cp -rL "${f}" "${tmp_entry}/" || return 1
+        fi
+    done
+    if [ -f "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_metrics.txt" ]; then
+        mkdir -p "${tmp_entry}/InsertSizeMetrics" || return 1
+        cp -L "${OUTDIR}/InsertSizeMetrics/${SAMPLENM}_"* "${tmp_entry}/InsertSizeMetrics/" || return 1
+    fi
+    echo -e "${SAMPLENM}\t$(date '+%F %T')\t${SampleSheet}" > "${tmp_entry}/cache_source.txt"
+    chmod -R g+rX "${tmp_entry}" || true
+    # If another job stored the same key while we were copying, keep theirs
+    if [ -d "${CACHE_DIR}/${CACHEKEY}" ]; then
+        rm -rf "${tmp_entry}"
+        return 0
+    fi
+    # The files of the entry are read-only, so that the samples that restore
+    # it cannot change them. The directories are writable by the group, so
+    # that anyone who shares the cache can remove or replace the entry.
+    find "${tmp_entry}" -type f -exec chmod a-w {} + || { rm -rf "${tmp_entry}"; return 1; }
+    find "${tmp_entry}" -type d -exec chmod ug+rwx {} + || { rm -rf "${tmp_entry}"; return 1; }
+    mv -T "${tmp_entry}" "${CACHE_DIR}/${CACHEKEY}" || { rm -rf "${tmp_entry}"; return 1; }
+}
+if [[ -n "${CACHE_DIR:-}" && -n "${CACHEKEY}" && "${CACHE_HIT}" = "false" ]]; then
+    echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Storing results for ${SAMPLENM} in ${CACHE_DIR}/${CACHEKEY}" >> "${LOG_FNAME}"
+    cache_store || echo "# ${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID} $(date '+%F %T'): Could not store results in the cache; continuing." >> "${LOG_FNAME}"
+fi
+
+echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
+echo "# $(date '+%F %T'): Job complete" >> /dev/stderr
 
 # And close the file descriptor we were using for the trace
 exec 5>&-
@@ -0,0 +1,173 @@
+#!/bin/bash
+# Functions to record a resource profile for each section of the single sample
+# and summary scripts, which source this file. Each section gets one row in a
+# tab-delimited file with the wall time, CPU time, peak memory, and I/O of the
+# commands that ran in it. The CPU and I/O counters in /proc include all child
+# processes that have finished, which is every command in a section by the
+# time the next one starts.
+#
+# The peak memory of a section is sampled from its own processes while it
+# runs, the way Slurm accounting samples a job: every PROF_MEM_INTERVAL
+# seconds, the resident memory of the processes under the shell of the
+# section is added up, and the high-water mark (VmHWM) of the largest one is
+# read, and the peak is the largest of these. Commands that finish between two
+# samples can be missed, and a section that ends before the first sample has
+# no peak (NA). If the processes cannot be sampled at all, because ps is not
+# available, the peak of the memory cgroup of the job so far is recorded
+# instead, and the MemScope column says "job". That is the peak of every
+# section up to this one, so 'churp profile' leaves it out of the section
+# percentiles. The cgroup files belong to the scheduler and are only read; the
+# job-level peak is what Slurm reports as MaxRSS.
+#
+# The scripts set PROFILE_FNAME, PROFILE_SAMPLE, and PROFILE_JOB, and
+# LOG_SECTION is the name of the section.
+PROFILE_FNAME=""
+PROFILE_OPEN="false"
+PROF_MEM_INTERVAL=2
+PROF_MEM_PID=""
+CLK_TCK=$(getconf CLK_TCK)
+profile_mem_file() {
+    local cg_id cg_ctrl cg_path
+    PROF_MEM_FILE=""
+    while IFS=":" read -r cg_id cg_ctrl cg_path
+    do
+        if [[ "${cg_ctrl}" = "memory" && -f "/sys/fs/cgroup/memory${cg_path}/memory.max_usage_in_bytes" ]]; then
+            PROF_MEM_FILE="/sys/fs/cgroup/memory${cg_path}/memory.max_usage_in_bytes"
+        elif [[ "${cg_id}" = "0" && -f "/sys/fs/cgroup${cg_path}/memory.peak" ]]; then
+            PROF_MEM_FILE="/sys/fs/cgroup${cg_path}/memory.peak"
+        fi
+    done < "/proc/$$/cgroup"
+}
+# Write the peak memory (KB) of the processes under a shell into a file,
+# until the shell exits or the sampler is stopped. The sampler leaves itself
+# out of the total.
+profile_mem_sampler() {
+    local root="${1}"
+    local out="${2}"
+    local self="${BASHPID}"
+    local peak=0
+    local kb
+    set +x
+    while kill -0 "${root}" 2> /dev/null
+    do
+        kb=$(ps -e -o pid=,ppid=,rss= 2> /dev/null | awk -v root="${root}" -v self="${self}" '
+            { parent[$1] = $2; rss[$1] = $3 }
+            END {
+                total = 0
+                hwm = 0
+                for (p in parent) {
+                    q = p
+                    n = 0
+                    while (q != root && q != self && q in parent && n < 100) {
+                        q = parent[q]
+                        n++
+                    }
+                    if (q != root || p == root) {
+                        continue
+                    }
+                    total += rss[p]
+                    f = "/proc/" p "/status"
+                    while ((getline line < f) > 0) {
+                        if (line ~ /^VmHWM:/) {
+                            split(line, v, " ")
+                            if (v[2] > hwm) {
+                                hwm = v[2]
+                            }
+                        }
+                    }
+                    close(f)
+                }
+                print (total > hwm ? total : hwm)
+            }') || kb=0
+        if [ "${kb:-0}" -gt "${peak}" ]; then
+            peak="${kb}"
+            echo "${peak}" > "${out}"
+        fi
+        sleep "${PROF_MEM_INTERVAL}"
+    done
+}
+profile_snapshot() {
+    local stat_f io_key io_val now
+    # Fields 14-17 of the stat file are the user and system CPU ticks of this
+    # shell and of its finished children. BASHPID is the subshell of a step
+    # when the steps run concurrently.
+    read -ra stat_f < "/proc/${BASHPID}/stat"
+    PROF_CPU_USER=$(( stat_f[13] + stat_f[15] ))
+    PROF_CPU_SYS=$(( stat_f[14] + stat_f[16] ))
+    PROF_RCHAR="NA"
+    PROF_WCHAR="NA"
+    while read -r io_key io_val
+    do
+        case "${io_key}" in
+            "rchar:") PROF_RCHAR="${io_val}" ;;
+            "wchar:") PROF_WCHAR="${io_val}" ;;
+        esac
+    done < "/proc/${BASHPID}/io"
+    now="${EPOCHREALTIME:-$(date '+%s.%N')}"
+    PROF_TIME="${now:0:14}"
+}
+profile_open() {
+    # The PID of this shell has to be taken before the sampler is started,
+    # since BASHPID in its arguments would be the sampler itself
+    local shell_pid="${BASHPID}"
+    profile_snapshot
+    PROF_START_TIME="${PROF_TIME}"
+    PROF_START_USER="${PROF_CPU_USER}"
+    PROF_START_SYS="${PROF_CPU_SYS}"
+    PROF_START_RCHAR="${PROF_RCHAR}"
+    PROF_START_WCHAR="${PROF_WCHAR}"
+    PROF_SECTION="${LOG_SECTION}"
+    PROF_MEM_OUT="${TMPDIR:-/tmp}/.churp_mem.${shell_pid}.${RANDOM}"
+    rm -f "${PROF_MEM_OUT}"
+    if command -v ps > /dev/null; then
+        profile_mem_sampler "${shell_pid}" "${PROF_MEM_OUT}" > /dev/null 2>&1 &
+        PROF_MEM_PID="$!"
+    fi
+    PROFILE_OPEN="true"
+}
+profile_close() {
+    local max_rss="NA"
+    local mem_scope="section"
+    local cpu_cs cpu_user cpu_sys
+    local read_b="NA"
+    local write_b="NA"
+    if [[ "${PROFILE_OPEN}" = "false" || -z "${PROFILE_FNAME}" ]]; then
+        return 0
+    fi
+    local sampled="false"
+    profile_snapshot
+    if [ -n "${PROF_MEM_PID}" ]; then
+        kill "${PROF_MEM_PID}" 2> /dev/null || true
+        wait "${PROF_MEM_PID}" 2> /dev/null || true
+        PROF_MEM_PID=""
+        sampled="true"
+    fi
+    # Convert the CPU ticks to seconds with two decimals
+    cpu_cs=$(( (PROF_CPU_USER - PROF_START_USER) * 100 / CLK_TCK ))
+    printf -v cpu_user '%d.%02d' $(( cpu_cs / 100 )) $(( cpu_cs % 100 ))
+    cpu_cs=$(( (PROF_CPU_SYS - PROF_START_SYS) * 100 / CLK_TCK ))
+    printf -v cpu_sys '%d.%02d' $(( cpu_cs / 100 )) $(( cpu_cs % 100 ))
+    if [ -s "${PROF_MEM_OUT}" ]; then
+        max_rss=$(< "${PROF_MEM_OUT}")
+    elif [[ "${sampled}" = "false" && -n "${PROF_MEM_FILE}" ]]; then
+        max_rss=$(( $(< "${PROF_MEM_FILE}") / 1024 ))
+        mem_scope="job"
+    fi
+    rm -f "${PROF_MEM_OUT}"
+    if [[ "${PROF_RCHAR}" != "NA" && "${PROF_START_RCHAR}" != "NA" ]]; then
+        read_b=$(( PROF_RCHAR - PROF_START_RCHAR ))
+        write_b=$(( PROF_WCHAR - PROF_START_WCHAR ))
+    fi
+    if [ ! -s "${PROFILE_FNAME}" ]; then
+        echo -e "Sample\tJobID\tSection\tStart\tEnd\tCPUUser\tCPUSys\tMaxRSSKB\tMemScope\tReadBytes\tWriteBytes\tExitCode" > "${PROFILE_FNAME}"
+    fi
+    echo -e "${PROFILE_SAMPLE}\t${PROFILE_JOB}\t${PROF_SECTION}\t${PROF_START_TIME}\t${PROF_TIME}\t${cpu_user}\t${cpu_sys}\t${max_rss}\t${mem_scope}\t${read_b}\t${write_b}\t${1}" >> "${PROFILE_FNAME}"
+    PROFILE_OPEN="false"
+}
+# Close the record of the previous section and open one for the section that
+# is being entered
+profile_section() {
+    profile_close 0
+    profile_open
+}
+profile_mem_file
@@ -4,14 +4,21 @@ set -e
 set -u
 set -o pipefail
 
-# Reset the PATH variable to a "stock" state so that personal libraries do not
-# interfere.
-export PATH="/opt/msi/bin:/usr/share/Modules/bin:/usr/local/bin:/usr/bin:/usr/local/sbin:/usr/sbin:/opt/ibutils/bin:/opt/puppetlabs/bin"
+# Jobs run with "--scheduler local" set CHURP_SCHEDULER, and use the programs
+# in the PATH of the user who started them. Only set up the MSI environment
+# for Slurm jobs.
+CHURP_SCHEDULER="${CHURP_SCHEDULER:-slurm}"
+if [ "${CHURP_SCHEDULER}" = "slurm" ]
+then
+    # Reset the PATH variable to a "stock" state so that personal libraries do
+    # not interfere.
+    export PATH="/opt/msi/bin:/usr/share/Modules/bin:/usr/local/bin:/usr/bin:/usr/local/sbin:/usr/sbin:/opt/ibutils/bin:/opt/puppetlabs/bin"
 
-# Load our conda environment
-module load python3/3.8.3_anaconda2020.07_mamba
-source /home/msistaff/public/CHURP_Deps/v1/Conda_Initialize.sh
-conda activate /home/msistaff/public/CHURP_Deps/v1/churp_env
+    # Load our conda environment
+    module load python3/3.8.3_anaconda2020.07_mamba
+    source /home/msistaff/public/CHURP_Deps/v1/Conda_Initialize.sh
+    conda activate /home/msistaff/public/CHURP_Deps/v1/churp_env
+fi
 
 # Export the PS4 variable for the trace
 # Taken from https://wiki.bash-hackers.org/scripting/debuggingtips
@@ -33,7 +40,7 @@ pipeline_error() {
     case "${1}" in
     "General")
         echo "${SampleSheet} is incompatible with this version of CHURP." >> /dev/stderr
-        echo "${SampleSheet} was generated with version ${SAMPLESHEET_VERSION}, and this script requires ${PIPELINE_VERSION}." > /dev/stderr
+        echo "${SampleSheet} has samplesheet schema ${SAMPLESHEET_VERSION:-1}, and this script requires ${SHEET_SCHEMA}." > /dev/stderr
         rm -f "${OUTDIR}/.in_progress"
         exit 100
         ;;
@@ -55,6 +62,13 @@ pipeline_error() {
         rm -f "${OUTDIR}/.in_progress"
         exit 115
         ;;
+    "Normalize")
+        echo "#### CHURP caught an error #####" >> "${LOG_FNAME}"
+        echo "The NumPy normalization of the counts matrix encountered an error." >> "${LOG_FNAME}"
+        echo "Please check that your experimental groups spreadsheet is properly formatted, or run again with --norm-engine r." >> "${LOG_FNAME}"
+        rm -f "${OUTDIR}/.in_progress"
+        exit 116
+        ;;
     "HTML.Report")
         echo "#### CHURP caught an error #####" >> "${LOG_FNAME}"
         echo "CHURP was unable to produce a summary HTML report for your run." >> "${LOG_FNAME}"
@@ -74,36 +88,51 @@ pipeline_error() {
     esac
 }
 
-# Check for PBS/Samplesheet version agreement
-PIPELINE_VERSION="1"
-SAMPLESHEET_VERSION=$(tail -n 1 "${SampleSheet}" | sed -E 's/#//g')
-if [ "${SAMPLESHEET_VERSION}" -ne "${PIPELINE_VERSION}" ]
+# Define functions to record a resource profile for each section of the
+# script. See profile_functions.sh for how the peak memory is measured.
+source "${CHURP_DIR}/PBS/profile_functions.sh"
+# Record the last section with the exit status of the script, whether it
+# exits normally or through pipeline_error. Failures are also noted in the
+# Slurm error file, which is what the "status" subcommand reads.
+job_exit() {
+    profile_close "${1}"
+    if [ "${1}" -ne 0 ]; then
+        echo "# $(date '+%F %T'): Failed in section ${LOG_SECTION} with exit status ${1}" >> /dev/stderr
+    fi
+}
+trap 'job_exit "$?"' EXIT
+
+# Define read_samplesheet, which reads a row of the samplesheet into the SHEET
+# array, and the schema version that this script reads
+source "${CHURP_DIR}/PBS/samplesheet_functions.sh"
+
+# Check for PBS/Samplesheet schema agreement
+SAMPLESHEET_VERSION=$(head -n 1 "${SampleSheet}" | awk -F '\t' '$1 == "#CHURP_SAMPLESHEET" { print $2 }')
+if [ "${SAMPLESHEET_VERSION:-1}" != "${SHEET_SCHEMA}" ]
 then
     pipeline_error "${LOG_SECTION}"
 fi
 
-# Read the first line of the samplesheet to get the working directory and the
-# GTF. This is not super elegant, but it works with the samplesheet format
-IN=$(head -n 1 "${SampleSheet}")
-# handle empty line and comment line. We return a 0 exit status because we do not
-# want a comment/blank line in the samplesheet to hold up the array jobs
-[ -z "${IN// }" ] && echo "hit an empty line in sample sheet" && exit 0
-[ "$IN" = "#.*" ] && echo "hit a comment line in sample sheet" && exit 0
-while IFS="|" read -ra OPTS; do 
-    SAMPLENM=${OPTS[0]}
-    EXPR_GROUP=${OPTS[1]}
-    R1FILE=${OPTS[2]}
-    R2FILE=${OPTS[3]}
-    OUTDIR=${OPTS[4]}
-    WORKDIR=${OPTS[5]}
-    TRIM=${OPTS[6]}
-    RMDUP=${OPTS[7]}
-    TRIMOPTS=${OPTS[8]}
-    HISAT2INDEX=${OPTS[9]}
-    HISAT2OPTS=${OPTS[10]}
-    STRAND=${OPTS[11]}
-    GTFFILE=${OPTS[12]}
-done <<< "$IN"
+# Read the first sample of the samplesheet to get the working directory and
+# the GTF. These are shared by all samples, so any row would do.
+if ! read_samplesheet "${SampleSheet}" 1
+then
+    echo "hit an empty sample sheet"
+    exit 0
+fi
+SAMPLENM="${SHEET[SampleName]}"
+EXPR_GROUP="${SHEET[Group]}"
+R1FILE="${SHEET[FastqR1files]}"
+R2FILE="${SHEET[FastqR2file]}"
+OUTDIR="${SHEET[OutputDir]}"
+WORKDIR="${SHEET[WorkingDir]}"
+TRIM="${SHEET[TRIM]}"
+RMDUP="${SHEET[RMDUP]}"
+TRIMOPTS="${SHEET[trimmomaticOpts]}"
+HISAT2INDEX="${SHEET[Hisat2index]}"
+HISAT2OPTS="${SHEET[Hisat2Options]}"
+STRAND="${SHEET[Strand]}"
+GTFFILE="${SHEET[AnnotationGTF]}"
 
 # Make directories for the output files. We want to keep the outdir organized
 LOGDIR="${OUTDIR}/Logs"
@@ -112,6 +141,9 @@ PLOTSDIR="${OUTDIR}/Plots"
 DEGDIR="${OUTDIR}/DEGs"
 LOG_FNAME="${LOGDIR}/BulkRNASeq_Analysis.log"
 TRACE_FNAME="${LOGDIR}/BulkRNASeq_Trace.log"
+PROFILE_FNAME="${LOGDIR}/BulkRNASeq_Profile.tsv"
+PROFILE_SAMPLE="SUMMARY"
+PROFILE_JOB="${SLURM_JOB_ID}"
 
 mkdir -p "${LOGDIR}" "${COUNTSDIR}" "${PLOTSDIR}" "${DEGDIR}"
 
@@ -120,14 +152,21 @@ echo "# $(date '+%F %T') Standard error file for summary job" >> /dev/stderr
 echo "# $(date '+%F %T'): For a human-readable log, see ${LOG_FNAME}" >> /dev/stderr
 echo "# $(date '+%F %T'): For a debugging trace, see ${TRACE_FNAME}" >> /dev/stderr
 echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+profile_section
 # Print the loaded modules to stderr and a log file
-module list -t
+if [ "${CHURP_SCHEDULER}" = "slurm" ]
+then
+    module list -t
+fi
 # We don't want to clobber the old files; just append to them
 echo "###############################################################################" >> "${LOG_FNAME}"
 echo "# $(date '+%F %T'): Summary job started" >> "${LOG_FNAME}"
 echo "# $(date '+%F %T'): Job ID: ${SLURM_JOB_ID}" >> "${LOG_FNAME}"
 echo '#BEGIN_MODULES' >> "${LOG_FNAME}"
-module list -t 2>> "${LOG_FNAME}"
+if [ "${CHURP_SCHEDULER}" = "slurm" ]
+then
+    module list -t 2>> "${LOG_FNAME}"
+fi
 echo '#END_MODULES' >> "${LOG_FNAME}"
 
 # Set up trace logging after loading modules to avoid dumping tons of module-related messages to the log
@@ -157,6 +196,7 @@ mkdir -p "${WORKDIR}/allsamples" && cd "${WORKDIR}/allsamples"
 echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
 LOG_SECTION="featureCounts"
 echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+profile_section
 echo "# ${SLURM_JOB_ID} $(date '+%F %T'): Making a counts matrix for all samples." >> "${LOG_FNAME}"
 BAM_LIST=($(find . -type l -exec basename {} \;| sort -V))
 if [ "${PE}" = "true" ]
@@ -183,32 +223,13 @@ else
         "${BAM_LIST[@]}"   || pipeline_error "${LOG_SECTION}"
 fi
 
-# Summarize the merged count data, including descriptive summaries and differential expression tests if >1 group present.
-echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="edgeR"
-echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-echo "# ${SLURM_JOB_ID} $(date '+%F %T'): Running edgeR analysis on counts" >> "${LOG_FNAME}"
-Rscript \
-    "${RSUMMARY}" \
-    "${OUTDIR}" \
-    "${WORKDIR}" \
-    "${SampleSheet}" \
-    "${WORKDIR}/allsamples/subread_counts.txt" \
-    "${MINLEN}" \
-    "${MINCPM}" \
-    "${GroupSheet}" \
-    &> Rout.txt || pipeline_error "${LOG_SECTION}"
-
-echo "# ----- Output from ${RSUMMARY} below" >> "${LOG_FNAME}"
-cat Rout.txt >> "${LOG_FNAME}"
-echo "# ----- End output from ${RSUMMARY}" >> "${LOG_FNAME}"
-
 # Copy the merged counts into the output directory. The -u option to cp causes
 # the copy to happen only if the source file is newer than the destination file
 # or if the destination does not exist.
 echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
 LOG_SECTION="GTF.Summary"
 echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+profile_section
 echo "# ${SLURM_JOB_ID} $(date '+%F %T'): Copying merged counts matrix and summary into ${COUNTSDIR}" >> "${LOG_FNAME}"
 cp -u subread_counts.txt "${COUNTSDIR}/subread_counts.txt"
 cp -u subread_counts.txt.summary "${COUNTSDIR}/subread_counts.txt.summary"
@@ -307,102 +328,125 @@ NR>2 {
     print $0
 }' "${COUNTSDIR}/subread_counts.txt" > "${COUNTSDIR}/subread_counts.trimmed.txt"
 
-# Then compress the files of interest
-echo "# ${SLURM_JOB_ID} $(date '+%F %T'): Compressing the trimmed counts matrices" >> "${LOG_FNAME}"
-# We have to use a subshell here because zip will store the full path to the
-# counts files in the archive. If we do not use the subshell, then when the
-# user expands the file, it will 
-rm -f "${OUTDIR}/Counts.zip"
-(cd "${OUTDIR}" && zip -r "./Counts.zip" "Counts/cpm_list.txt" "Counts/subread_counts_gene_symbol.txt" "Counts/subread_counts.trimmed.txt")
-
 # Link the work directories to the output directory
 echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
 LOG_SECTION="Linking"
 echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+profile_section
 rm -f "${OUTDIR}/singlesamples_work_directory" "${OUTDIR}/allsamples_work_directory"
 ln -sf "${WORKDIR}/singlesamples" "${OUTDIR}/singlesamples_work_directory"
 ln -sf "${WORKDIR}/allsamples" "${OUTDIR}/allsamples_work_directory"
 
-# Prepare to generate HTML report by making unified files for everything. We
-# will have to iterate over every sample
-# Remove old summary files
+# Prepare to generate HTML report by making unified files for everything. The
+# collation script rewrites the tables in allsamples from the summaries of
+# each finished sample.
 echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
 LOG_SECTION="Collate.Samples"
-rm -f \
-    "${WORKDIR}/allsamples/Read_Counts.txt" \
-    "${WORKDIR}/allsamples/Samtools_Stats.txt" \
-    "${WORKDIR}/allsamples/HISAT_Stats.txt" \
-    "${WORKDIR}/allsamples/IS_Stats.txt" \
-    "${WORKDIR}/allsamples/RNASeq_Metrics.txt" \
-    "${WORKDIR}/allsamples/RNASeq_Metrics_Unstranded.txt" \
-    "${WORKDIR}/allsamples/rRNA_kmers.txt"
-# Use find to dig up all singlesample directories in the work director
-SDIRS=($(find "${WORKDIR}/singlesamples" -maxdepth 1 -mindepth 1 -type d | sort -V))
-for sampledir in "${SDIRS[@]}"
-do
-    sample=$(basename "${sampledir}")
-    if [ ! -f "${sampledir}/${sample}.done" ]; then
-        echo "# $(date '+%F %T'): No .done file for ${sample}, skipping." >> "${LOG_FNAME}"
-        continue
-    fi
-    echo "# ${SLURM_JOB_ID} $(date '+%F %T'): Collecting summaries for ${sample}" >> "${LOG_FNAME}"
-    # Make the read counts files
-    RAW_R1=$(find "${WORKDIR}/singlesamples/${sample}" -maxdepth 1 -type f -name '*1.raw_readcount.txt')
-    RAW_R2=$(find "${WORKDIR}/singlesamples/${sample}" -maxdepth 1 -type f -name '*2.raw_readcount.txt')
-    R1_COUNT=$(awk '{print $NF}' "${RAW_R1}")
-    if [ -z "${RAW_R2}" ]
-    then
-        R2_COUNT="NA"
-    else
-        R2_COUNT=$(awk '{print $NF}' "${RAW_R2}")
-    fi
-    TRIMMED_R1=$(find "${WORKDIR}/singlesamples/${sample}" -maxdepth 1 -type f -name '*1.trimmed_readcount.txt')
-    TRIMMED_R2=$(find "${WORKDIR}/singlesamples/${sample}" -maxdepth 1 -type f -name '*2.trimmed_readcount.txt')
-    if [ -z "${TRIMMED_R1}" ]
-    then
-        TR1_COUNT="NA"
-    else
-        TR1_COUNT=$(awk '{print $NF}' "${TRIMMED_R1}")
-    fi
-    if [ -z "${TRIMMED_R2}" ]
+echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+profile_section
+echo "# ${SLURM_JOB_ID} $(date '+%F %T'): Collecting summaries for all samples" >> "${LOG_FNAME}"
+PYTHONPATH="${CHURP_DIR}" python3 -m CHURPipelines.Summary.collate \
+    --workdir "${WORKDIR}" \
+    --threads "$(( SLURM_CPUS_PER_TASK * 4 ))" \
+    --bundle "${WORKDIR}/allsamples/Report_Data.sqlite" \
+    >> "${LOG_FNAME}" \
+    || pipeline_error "${LOG_SECTION}"
+
+# With --norm-engine numpy, write cpm_list.txt, the expression filter, and the
+# TMM factors with NumPy. summarize_bulk_rnaseq.R reads them instead of
+# computing them.
+if [ "${NORM_ENGINE:-r}" = "numpy" ]
+then
+    echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
+    LOG_SECTION="Normalize"
+    echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+    profile_section
+    echo "# ${SLURM_JOB_ID} $(date '+%F %T'): Normalizing counts with NumPy" >> "${LOG_FNAME}"
+    PYTHONPATH="${CHURP_DIR}" python3 -m CHURPipelines.Summary.normalize \
+        --counts "${WORKDIR}/allsamples/subread_counts.txt" \
+        --groups "${GroupSheet}" \
+        --outdir "${OUTDIR}" \
+        --min-len "${MINLEN}" \
+        --min-cts "${MINCPM}" \
+        >> "${LOG_FNAME}" 2>&1 \
+        || pipeline_error "${LOG_SECTION}"
+fi
+
+# Summarize the merged count data, including descriptive summaries and
+# differential expression tests if >1 group present, and generate the HTML
+# report. Both are done in one R session by run_summary.R, so that the
+# libraries and the data are loaded once, and the report uses the tables that
+# the DE tests left in memory. run_summary.R marks the start of the report on
+# fd 3, and exits with status 2 if the report fails.
+# Copying the report template is an ugly workaround, but sidesteps the problem
+# of write-locked public dirs for Rmarkdown/knitr
+#
+# With --counts-only, the count tables are all that the user asked for, so R
+# is not started and the report and the DE tables are left as they were.
+if [ "${COUNTS_ONLY:-false}" = "true" ]
+then
+    echo "# ${SLURM_JOB_ID} $(date '+%F %T'): --counts-only: skipping the edgeR analysis and the HTML report; the report and the DE tables were not updated" >> "${LOG_FNAME}"
+else
+    echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
+    LOG_SECTION="edgeR"
+    echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
+    profile_section
+    echo "# ${SLURM_JOB_ID} $(date '+%F %T'): Running edgeR analysis on counts and generating the HTML report" >> "${LOG_FNAME}"
+    cp -u "${BULK_RNASEQ_REPORT}" "./Report.Rmd"
+    RDRIVER="$(dirname "${RSUMMARY}")/run_summary.R"
+    R_STATUS=0
+    Rscript \
+        "${RDRIVER}" \
+        "${OUTDIR}" \
+        "${WORKDIR}" \
+        "${SampleSheet}" \
+        "${WORKDIR}/allsamples/subread_counts.txt" \
+        "${MINLEN}" \
+        "${MINCPM}" \
+        "${GroupSheet}" \
+        "${DE_ENGINE:-qlf}" \
+        "${WORKDIR}/allsamples/Report.Rmd" \
+        "${OUTDIR}/Bulk_RNAseq_Report.html" \
+        "churp_version=${CHURP_VERSION}" \
+        "outdir=${OUTDIR}" \
+        "workdir=${WORKDIR}" \
+        "pipeline=${PIPE_SCRIPT}" \
+        "samplesheet=${SampleSheet}" \
+        "detail_limit=${DETAIL_LIMIT:-96}" \
+        "de_engine=${DE_ENGINE:-qlf}" \
+        3>&2 &> Rout.txt || R_STATUS="$?"
+
+    echo "# ----- Output from ${RDRIVER} below" >> "${LOG_FNAME}"
+    cat Rout.txt >> "${LOG_FNAME}"
+    echo "# ----- End output from ${RDRIVER}" >> "${LOG_FNAME}"
+    if [ "${R_STATUS}" -eq 2 ]
     then
-        TR2_COUNT="NA"
-    else
-        TR2_COUNT=$(awk '{print $NF}' "${TRIMMED_R2}")
-    fi
-    echo -e "${sample}\t${R1_COUNT}\t${R2_COUNT}\t${TR1_COUNT}\t${TR2_COUNT}" >> "${WORKDIR}/allsamples/Read_Counts.txt"
-    cat "${WORKDIR}/singlesamples/${sample}/hisat_map_summary.txt" >> "${WORKDIR}/allsamples/HISAT_Stats.txt"
-    # Then, get alignment summary files
-    BAMSTAT="${WORKDIR}/singlesamples/${sample}/${sample}_bamstats.txt"
-    NMAPPED=$(grep '^SN' "${BAMSTAT}" | grep 'raw total sequences' | cut -f 3)
-    DUPLICATED=$(grep '^SN' "${BAMSTAT}" | grep 'reads duplicated' | cut -f 3)
-    MQ0=$(grep '^SN' "${BAMSTAT}" | grep 'reads MQ0' | cut -f 3)
-    MAXLEN=$(grep '^SN' "${BAMSTAT}" | grep 'maximum length' | cut -f 3)
-    AVGLEN=$(grep '^SN' "${BAMSTAT}" | grep 'average length' | cut -f 3)
-    AVGQUAL=$(grep '^SN' "${BAMSTAT}" | grep 'average quality' | cut -f 3)
-    echo -e "${sample}\t${NMAPPED}\t${DUPLICATED}\t${MQ0}\t${MAXLEN}\t${AVGLEN}\t${AVGQUAL}" >> "${WORKDIR}/allsamples/Samtools_Stats.txt"
-    # Get the BBDuk rRNA screen stats
-    echo -e "${sample}\t$(grep '#Matched' ${WORKDIR}/singlesamples/${sample}/BBDuk_rRNA_Stats.txt | cut -f 2-3)" >> "${WORKDIR}/allsamples/rRNA_kmers.txt"
-    # Then, get the insert size summaries. These are really simple.
-    if [ -f "${WORKDIR}/singlesamples/${sample}/IS_Stats.txt" ]
+        LOG_SECTION="HTML.Report"
+        pipeline_error "${LOG_SECTION}"
+    elif [ "${R_STATUS}" -ne 0 ]
     then
-        echo -e "${sample}\t$(cat ${WORKDIR}/singlesamples/${sample}/IS_Stats.txt)" >> "${WORKDIR}/allsamples/IS_Stats.txt"
+        pipeline_error "${LOG_SECTION}"
     fi
-    # And collect the RNAseq metrics into a single file for summarization
-    # Add the || true to the end of the command because these are optional steps
-    sed -e "s/^/${sample}\t/g" <(tail -n +2 "${WORKDIR}/singlesamples/${sample}/RNASeQC_Out/${sample}.metrics.tsv") >> "${WORKDIR}/allsamples/RNASeq_Metrics.txt" || true
-    sed -e "s/^/${sample}\t/g" <(tail -n +2 "${WORKDIR}/singlesamples/${sample}/RNASeQC_Out/${sample}_Unstranded.metrics.tsv") >> "${WORKDIR}/allsamples/RNASeq_Metrics_Unstranded.txt" || true
-done
-
-# We will generate an HTML report
-# This is an ugly workaround, but sidesteps the problem of write-locked public dirs for Rmarkdown/knitr
+    LOG_SECTION="HTML.Report"
+fi
+
+# Then compress the files of interest. This has to wait for the R session,
+# because summarize_bulk_rnaseq.R writes the CPM table.
 echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
-LOG_SECTION="HTML.Report"
+LOG_SECTION="Counts.Archive"
 echo "# $(date '+%F %T'): Entering section ${LOG_SECTION}" >> /dev/stderr
-cp -u "${BULK_RNASEQ_REPORT}" "./Report.Rmd"
-Rscript -e "library(rmarkdown); rmarkdown::render('./Report.Rmd', output_file='"${OUTDIR}/Bulk_RNAseq_Report.html"', params=list(churp_version='"${CHURP_VERSION}"', outdir='"${OUTDIR}"', workdir='"${WORKDIR}"', pipeline='"${PIPE_SCRIPT}"', samplesheet='"${SampleSheet}"'))" || pipeline_error "${LOG_SECTION}"
+profile_section
+echo "# ${SLURM_JOB_ID} $(date '+%F %T'): Compressing the trimmed counts matrices" >> "${LOG_FNAME}"
+# We have to use a subshell here because zip will store the full path to the
+# counts files in the archive. If we do not use the subshell, then when the
+# user expands the file, it will 
+rm -f "${OUTDIR}/Counts.zip"
+(cd "${OUTDIR}" && zip -r "./Counts.zip" "Counts/cpm_list.txt" "Counts/subread_counts_gene_symbol.txt" "Counts/subread_counts.trimmed.txt")
 rm -f "${OUTDIR}/.in_progress"
 echo "# ${SLURM_JOB_ID} $(date '+%F %T'): Done summarizing bulk RNAseq run" >> "${LOG_FNAME}"
 
+echo "# $(date '+%F %T'): Finished section ${LOG_SECTION}" >> /dev/stderr
+echo "# $(date '+%F %T'): Job complete" >> /dev/stderr
+
 # Close the trace file descriptor
 exec 5>&-
@@ -0,0 +1,54 @@
+#!/bin/bash
+# Functions to read the samplesheet, for the single sample and summary scripts,
+# which source this file. read_samplesheet reads a row of the samplesheet into
+# the SHEET array, keyed on column name. SHEET_SCHEMA is the version of the
+# samplesheet that it reads, from the '#CHURP_SAMPLESHEET' line at the top.
+#
+# The fields that are shared by all samples are on '@Column<TAB>Value' lines
+# at the top of the sheet, followed by a header of the per-sample columns. The
+# row for an array index is found through the fixed-width .idx file next to
+# the sheet, which holds the byte offset and length of each row, so that a job
+# does not have to parse the whole sheet. If the index is missing or does not
+# point at the right row, the sheet is scanned instead.
+SHEET_SCHEMA="2"
+SHEET_IDX_WIDTH="22"
+declare -A SHEET
+read_samplesheet() {
+    local sheet="${1}"
+    local idx="${2}"
+    local line=""
+    local row=""
+    local rec=""
+    local i
+    local -a cols=()
+    local -a vals=()
+    while IFS= read -r line; do
+        case "${line}" in
+            "#"*|"")
+                ;;
+            "@"*)
+                line="${line:1}"
+                SHEET["${line%%$'\t'*}"]="${line#*$'\t'}"
+                ;;
+            *)
+                mapfile -t cols < <(printf '%s\n' "${line}" | tr '\t' '\n')
+                break
+                ;;
+        esac
+    done < "${sheet}"
+    if [ -f "${sheet}.idx" ]; then
+        rec=$(dd if="${sheet}.idx" bs="${SHEET_IDX_WIDTH}" skip=$(( idx - 1 )) count=1 2> /dev/null)
+        if [[ "${rec}" =~ ^([0-9]+)\ ([0-9]+)$ ]]; then
+            row=$(dd if="${sheet}" iflag=skip_bytes,count_bytes skip=$(( 10#${BASH_REMATCH[1]} )) count=$(( 10#${BASH_REMATCH[2]} )) 2> /dev/null)
+        fi
+    fi
+    if [ "${row%%$'\t'*}" != "${idx}" ]; then
+        row=$(awk -F '\t' -v i="${idx}" '$1 == i { print; exit }' "${sheet}")
+    fi
+    [ -z "${row}" ] && return 1
+    mapfile -t vals < <(printf '%s\n' "${row}" | tr '\t' '\n')
+    for i in "${!cols[@]}"; do
+        SHEET["${cols[${i}]}"]="${vals[${i}]:-}"
+    done
+    return 0
+}
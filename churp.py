@@ -7,6 +7,9 @@ supported:
     - group_template
     - bulk_rnaseq
     - genome_aliases
+    - profile
+    - status
+    - resubmit
 Questions should be directed to help@msi.umn.edu.
 Version: 0.3.0-dev
 2023-08-17
@@ -128,6 +131,33 @@ def brnaseq(args):
     return
 
 
+def run_profile(args):
+    """This function aggregates the per-section resource profiles of a run
+    and prints a table of them."""
+    from CHURPipelines.RunTools import RunProfile
+    p = RunProfile.RunProfile(args)
+    p.write_table()
+    return
+
+
+def run_status(args):
+    """This function prints the progress of a run from its output
+    directory."""
+    from CHURPipelines.RunTools import RunStatus
+    s = RunStatus.RunStatus(args)
+    s.run()
+    return
+
+
+def run_resubmit(args):
+    """This function resubmits the failed and unfinished samples of a
+    run."""
+    from CHURPipelines.RunTools import Resubmit
+    r = Resubmit.Resubmit(args)
+    r.run()
+    return
+
+
 def main():
     """The main function. This function is a very high-level function, and
     it should really only have the logic and structure of the pipeline that is
@@ -141,7 +171,10 @@ def main():
         cmd = {
             'bulk_rnaseq': brnaseq,
             'group_template': expr_group,
-            'genome_aliases': org_aliases
+            'genome_aliases': org_aliases,
+            'profile': run_profile,
+            'status': run_status,
+            'resubmit': run_resubmit
             }
         cmd[pipe_args['pipeline']](pipe_args)
     return
@@ -0,0 +1,173 @@
+#!/bin/bash
+# Run bulk_rnaseq end to end on the reads in Test_Data with
+# "--scheduler local", using the stand-in tools in stubs/bin in place of the
+# aligners and QC programs, and check that every sample and the summary job
+# finished. Then rerun the summary job with --counts-only, and check that it
+# does not start R, and fail a sample that runs in node-local space, and check
+# that its rerun picks up from the steps that finished. The stand-ins write files in the formats that the single sample
+# and summary scripts read, so this tests the pipeline script, the local
+# executor, the step runner, and the Python summary modules, but not the
+# results of the real tools, or the R summary and report. Run it as
+#
+#     bash tests/e2e/run_e2e.sh [output directory]
+#
+# with python3 and the CHURP Python dependencies in the PATH. The output and
+# working directories are made in a new temporary directory if none is given.
+set -e
+set -u
+set -o pipefail
+
+E2E_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+CHURP_DIR="$(cd "${E2E_DIR}/../.." && pwd)"
+TEST_DATA="${CHURP_DIR}/Test_Data"
+RUN_DIR="${1:-$(mktemp -d)}"
+OUTDIR="${RUN_DIR}/Output"
+WORKDIR="${RUN_DIR}/Work"
+NSAMPLES="5"
+
+export PATH="${E2E_DIR}/stubs/bin:${PATH}"
+export CHURP_DEPS_DIR="${E2E_DIR}/stubs/deps"
+
+fail() {
+    echo "FAIL: ${1}" >&2
+    exit 1
+}
+
+mkdir -p "${RUN_DIR}"
+echo "Writing the pipeline script into ${OUTDIR}"
+# churp.py exits with the code of the message that it ends with, which is not
+# 0 even when it succeeds, so look for the pipeline script instead
+python3 "${CHURP_DIR}/churp.py" bulk_rnaseq \
+    --fq-folder "${TEST_DATA}/Test_Project_010" \
+    --hisat2-index "${TEST_DATA}/Genome/genome_snp_tran" \
+    --gtf "${TEST_DATA}/Genome/annotations.gtf" \
+    --adapters "${TEST_DATA}/test_adapters.fasta" \
+    --output-dir "${OUTDIR}" \
+    --working-dir "${WORKDIR}" \
+    --norm-engine numpy \
+    --rrna-screen 100 \
+    --scheduler local \
+    --queue amdsmall \
+    --max-cores 4 \
+    --ppn 2 \
+    --mem 12000 \
+    --no-submit \
+    || true
+PIPELINE=$(ls "${OUTDIR}"/*.bulk_rnaseq.pipeline.sh 2> /dev/null) || fail "churp.py did not write a pipeline script"
+
+echo "Running ${PIPELINE}"
+if ! bash "${PIPELINE}"; then
+    tail -n 20 "${OUTDIR}"/*.err >&2 || true
+    fail "the pipeline script exited with an error"
+fi
+
+# Every sample finished, and wrote its results
+for i in $(seq 1 "${NSAMPLES}")
+do
+    printf -v SAMPLE 'Sample%02d' "${i}"
+    SDIR="${WORKDIR}/singlesamples/${SAMPLE}"
+    [ -f "${SDIR}/${SAMPLE}.done" ] || fail "${SAMPLE} has no .done file"
+    [ -s "${SDIR}/hisat_map_summary.txt" ] || fail "${SAMPLE} has no HISAT2 summary"
+    [ -s "${SDIR}/IS_Stats.txt" ] || fail "${SAMPLE} has no insert size stats"
+    [ -L "${WORKDIR}/allsamples/${SAMPLE}" ] || fail "${SAMPLE} is not linked into allsamples"
+    [ -s "${OUTDIR}/Logs/${SAMPLE}_Profile.tsv" ] || fail "${SAMPLE} has no resource profile"
+done
+if [ "$(grep -l 'Job complete' "${OUTDIR}"/bulk_rnaseq_single_sample-*.err | wc -l)" -ne "${NSAMPLES}" ]; then
+    fail "not all single sample jobs logged 'Job complete'"
+fi
+# The samples share one collapsed GTF, named by the GTF that it came from
+if [ "$(ls "${WORKDIR}"/gene_index/collapsed.*.gtf | wc -l)" -ne 1 ]; then
+    fail "there is not exactly one collapsed GTF in gene_index"
+fi
+grep -q 'Found collapsed GTF' "${OUTDIR}"/Logs/Sample*_Analysis.log || fail "no sample re-used the collapsed GTF"
+
+# The summary job finished, and wrote the counts and the collated tables
+grep -q 'Job complete' "${OUTDIR}"/run_summary_stats-*.err || fail "the summary job did not log 'Job complete'"
+for f in \
+    "Counts/subread_counts.txt" \
+    "Counts/subread_counts_gene_symbol.txt" \
+    "Counts/cpm_list.txt" \
+    "Counts.zip" \
+    "Bulk_RNAseq_Report.html" \
+    "bulk_rnaseq_job_ids.txt"
+do
+    [ -s "${OUTDIR}/${f}" ] || fail "${f} is missing or empty"
+done
+if [ "$(wc -l < "${WORKDIR}/allsamples/HISAT_Stats.txt")" -ne "${NSAMPLES}" ]; then
+    fail "HISAT_Stats.txt does not have a row for each sample"
+fi
+[ ! -e "${OUTDIR}/.in_progress" ] || fail ".in_progress was not removed"
+
+# A --counts-only rerun of the summary job rewrites the count tables, and does
+# not start R, so the report that was removed is not written again
+echo "Rerunning the summary job with --counts-only"
+rm -f "${OUTDIR}/Bulk_RNAseq_Report.html" "${OUTDIR}/Counts.zip" "${PIPELINE}"
+python3 "${CHURP_DIR}/churp.py" bulk_rnaseq \
+    --fq-folder "${TEST_DATA}/Test_Project_010" \
+    --hisat2-index "${TEST_DATA}/Genome/genome_snp_tran" \
+    --gtf "${TEST_DATA}/Genome/annotations.gtf" \
+    --adapters "${TEST_DATA}/test_adapters.fasta" \
+    --output-dir "${OUTDIR}" \
+    --working-dir "${WORKDIR}" \
+    --norm-engine numpy \
+    --counts-only \
+    --summary-only \
+    --min-counts 20 \
+    --scheduler local \
+    --queue amdsmall \
+    --max-cores 4 \
+    --ppn 2 \
+    --mem 12000 \
+    --no-submit \
+    || true
+PIPELINE=$(ls "${OUTDIR}"/*.bulk_rnaseq.pipeline.sh 2> /dev/null) || fail "churp.py did not write a --counts-only pipeline script"
+if ! bash "${PIPELINE}"; then
+    tail -n 20 "${OUTDIR}"/run_summary_stats-*.err >&2 || true
+    fail "the --counts-only pipeline script exited with an error"
+fi
+[ -s "${OUTDIR}/Counts.zip" ] || fail "the --counts-only summary job did not write Counts.zip"
+[ ! -e "${OUTDIR}/Bulk_RNAseq_Report.html" ] || fail "the --counts-only summary job ran R"
+grep -q 'skipping the edgeR analysis' "${OUTDIR}/Logs/BulkRNASeq_Analysis.log" || fail "the --counts-only summary job did not log that it skipped R"
+
+# A sample that runs in node-local space and fails in a late step keeps the
+# steps that finished, so its rerun does not align the reads again
+echo "Running one sample with --stage-local, and failing its insert size step"
+STAGE_RUN="${RUN_DIR}/Staged"
+mkdir -p "${STAGE_RUN}/Reads" "${STAGE_RUN}/node_tmp"
+ln -s "${TEST_DATA}/Test_Project_010/Sample01_R1_001.fastq.gz" "${TEST_DATA}/Test_Project_010/Sample01_R2_001.fastq.gz" "${STAGE_RUN}/Reads/"
+python3 "${CHURP_DIR}/churp.py" bulk_rnaseq \
+    --fq-folder "${STAGE_RUN}/Reads" \
+    --hisat2-index "${TEST_DATA}/Genome/genome_snp_tran" \
+    --gtf "${TEST_DATA}/Genome/annotations.gtf" \
+    --adapters "${TEST_DATA}/test_adapters.fasta" \
+    --output-dir "${STAGE_RUN}/Output" \
+    --working-dir "${STAGE_RUN}/Work" \
+    --stage-local \
+    --tmp 1000 \
+    --scheduler local \
+    --queue amdsmall \
+    --max-cores 4 \
+    --ppn 2 \
+    --mem 12000 \
+    --no-submit \
+    || true
+PIPELINE=$(ls "${STAGE_RUN}"/Output/*.bulk_rnaseq.pipeline.sh 2> /dev/null) || fail "churp.py did not write a --stage-local pipeline script"
+SDIR="${STAGE_RUN}/Work/singlesamples/Sample01"
+SLOG="${STAGE_RUN}/Output/Logs/Sample01_Analysis.log"
+TMPDIR="${STAGE_RUN}/node_tmp" E2E_FAIL_INSERT_SIZE=1 bash "${PIPELINE}" > /dev/null 2>&1 || true
+grep -q 'in node-local space' "${SLOG}" || fail "the --stage-local sample did not run in node-local space"
+[ ! -f "${SDIR}/Sample01.done" ] || fail "the failed --stage-local sample has a .done file"
+[ -f "${SDIR}/hisat2.done" ] || fail "the failed --stage-local sample did not keep its HISAT2 checkpoint"
+[ -z "$(ls -A "${STAGE_RUN}/node_tmp")" ] || fail "the failed --stage-local sample left files in node-local space"
+echo "Rerunning the failed sample"
+if ! TMPDIR="${STAGE_RUN}/node_tmp" bash "${PIPELINE}"; then
+    tail -n 20 "${STAGE_RUN}"/Output/*.err >&2 || true
+    fail "the rerun of the --stage-local pipeline script exited with an error"
+fi
+[ -f "${SDIR}/Sample01.done" ] || fail "the rerun --stage-local sample has no .done file"
+[ -s "${SDIR}/IS_Stats.txt" ] || fail "the rerun --stage-local sample has no insert size stats"
+if [ "$(grep -c 'reads with HISAT2' "${SLOG}")" -ne 1 ]; then
+    fail "the rerun --stage-local sample aligned its reads again"
+fi
+
+echo "PASS: ${NSAMPLES} samples and the summary job finished in ${RUN_DIR}"
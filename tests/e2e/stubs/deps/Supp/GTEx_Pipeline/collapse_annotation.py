@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+"""Stand-in for the GTEx collapse_annotation.py in the end-to-end test. It
+copies the GTF unchanged."""
+
+import shutil
+import sys
+
+# The GTF comes in through a process substitution, which copyfile() refuses
+with open(sys.argv[1], 'rb') as src, open(sys.argv[2], 'wb') as dst:
+    shutil.copyfileobj(src, dst)
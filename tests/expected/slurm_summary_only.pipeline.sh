@@ -0,0 +1,58 @@
+#!/bin/bash
+# Generated by CHURP version 1.0.1
+# Generated at <NOW>
+set -e
+set -u
+set -o pipefail
+user_name="$(id -u -n)"
+user_email="${user_name}@umn.edu"
+CHURP_VERSION="1.0.1"
+SUMMARY_ONLY="true"
+KEYFILE="<RUN_DIR>/Output/<DATE>.<USER>.bulk_rnaseq.qsub_array.txt"
+QSUB_ARRAY="1-5"
+OUTDIR="<RUN_DIR>/Output"
+WORKDIR="<RUN_DIR>/Work"
+DE_SCRIPT="<CHURP_DIR>/R_Scripts/summarize_bulk_rnaseq.R"
+REPORT_SCRIPT="<CHURP_DIR>/R_Scripts/bulk_rnaseq_report.Rmd"
+CHURP_DIR="<CHURP_DIR>"
+GROUPSHEET="<RUN_DIR>/Output/experimental_groups.xlsx"
+SAMPLESHEET="<RUN_DIR>/Output/<DATE>.<USER>.bulk_rnaseq.samplesheet.txt"
+PURGE="false"
+RRNA_SCREEN="10000"
+SUBSAMPLE="0"
+CACHE_DIR=""
+PIPE_SCRIPT="$(cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null && pwd )/$(basename $0)"
+if [ ! -z "${SLURM_JOB_ID+NULL}" ]
+    then echo "You should run this script with 'bash' from outside of a job allocation." > /dev/stderr
+    exit 99
+fi
+if [ -f "${OUTDIR}/.in_progress" ]
+then
+    echo "ERROR: ${OUTDIR}/.in_progress" exists. > /dev/stderr
+    echo "Job already submitted; aborting." > /dev/stderr
+    echo "Remove this file to allow job resbumission." > /dev/stderr
+    exit 1
+fi
+touch "${OUTDIR}/.in_progress"
+if [ "${SUMMARY_ONLY}" = "true" ]
+then
+    summary_id=$(sbatch --parsable --ignore-pbs -p amdsmall --mail-type=BEGIN,END,FAIL --mail-user="${user_email}"  -o "${OUTDIR}/run_summary_stats-%j.out" -e "${OUTDIR}/run_summary_stats-%j.err" -N 1 --mem=12000mb --tmp=12000mb -n 1 -c 6 --time=720 --export=SampleSheet="${SAMPLESHEET}",GroupSheet="${GROUPSHEET}",CHURP_VERSION="${CHURP_VERSION}",CHURP_DIR="${CHURP_DIR}",MINLEN="200",MINCPM="10",DETAIL_LIMIT="96",DE_ENGINE="qlf",NORM_ENGINE="r",COUNTS_ONLY="false",RSUMMARY="${DE_SCRIPT}",PIPE_SCRIPT="${PIPE_SCRIPT}",BULK_RNASEQ_REPORT="${REPORT_SCRIPT}" <CHURP_DIR>/PBS/run_summary_stats.sh || exit 1)
+else
+    single_id=$(sbatch --parsable --ignore-pbs -p amdsmall --mail-type=BEGIN,END,FAIL --mail-user="${user_email}"  -o "${OUTDIR}/bulk_rnaseq_single_sample-%A.%a.out" -e "${OUTDIR}/bulk_rnaseq_single_sample-%A.%a.err" -N 1 --mem=12000mb --tmp=12000mb -n 1 -c 6 --time=720 --array="${QSUB_ARRAY}" --export=SampleSheet="${SAMPLESHEET}",PURGE="${PURGE}",RRNA_SCREEN="${RRNA_SCREEN}",SUBSAMPLE="${SUBSAMPLE}",CACHE_DIR="${CACHE_DIR}",CHURP_DIR="${CHURP_DIR}",BAM_METRICS="tools",STAGE_LOCAL_MB="0" <CHURP_DIR>/PBS/bulk_rnaseq_single_sample.sh || exit 1)
+    summary_id=$(sbatch --parsable --ignore-pbs -p amdsmall --mail-type=BEGIN,END,FAIL --mail-user="${user_email}"  -o "${OUTDIR}/run_summary_stats-%j.out" -e "${OUTDIR}/run_summary_stats-%j.err" -N 1 --mem=12000mb --tmp=12000mb -n 1 -c 6 --time=720 --depend=afterok:${single_id} --export=SampleSheet="${SAMPLESHEET}",GroupSheet="${GROUPSHEET}",CHURP_VERSION="${CHURP_VERSION}",CHURP_DIR="${CHURP_DIR}",MINLEN="200",MINCPM="10",DETAIL_LIMIT="96",DE_ENGINE="qlf",NORM_ENGINE="r",COUNTS_ONLY="false",RSUMMARY="${DE_SCRIPT}",PIPE_SCRIPT="${PIPE_SCRIPT}",BULK_RNASEQ_REPORT="${REPORT_SCRIPT}" <CHURP_DIR>/PBS/run_summary_stats.sh || exit 1)
+fi
+echo "You are running CHURP version ${CHURP_VERSION}"
+echo "Output and logs will be written to ${OUTDIR}"
+echo "Sbatch array to samplename key: ${KEYFILE}"
+if [ "${SUMMARY_ONLY}" = "true" ]
+    then echo "--summary-only" specified. No single samples job array ID
+    else echo "Single samples job array ID: ${single_id:-none}"
+fi
+if [ -n "${shard_id:-}" ]
+then
+    echo "Shard job array ID: ${shard_id}"
+    echo "Gather job array ID: ${gather_id}"
+fi
+echo "Summary job ID: ${summary_id}"
+echo -e "${single_id:-}\t${shard_id:-}\t${gather_id:-}\t${summary_id}" >> "${OUTDIR}/bulk_rnaseq_job_ids.txt"
+echo "Emails will be sent to ${user_email}"
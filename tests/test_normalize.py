@@ -0,0 +1,78 @@
+"""Check CHURPipelines.Summary.normalize on the small run in
+tests/data/normalize. subread_counts.txt has five samples: S1 and S2 in group
+A, S3 and S4 in group B, and S5 in the 'NULL' group. Apart from two genes that
+change in one sample each (G09 in S2 and G10 in S4), every sample is 1, 2, 1,
+or 3 times the same profile, so TMM trims the two genes and the factors have a
+closed form: the scale of each sample divided by its library size, scaled to a
+geometric mean of 1. G11 is too low to pass the
+expression filter, and G12 is shorter than --min-len. The library sizes of
+S1-S4 over the kept genes are powers of two, so the log ratios of the
+unchanged genes are exactly equal, and tie in the ranks that TMM trims by.
+
+The expected tables were not written by edgeR. They were worked out by hand
+for these counts from the definitions in edgeR (calcNormFactors(method =
+'TMM'), cpm(log = TRUE, prior.count = 1)) and the expression filter of
+summarize_bulk_rnaseq.R, which the closed form above makes exact:
+
+    norm_factors.txt        TMM factors of S1-S4
+    kept_genes.txt          Genes that pass the expression filter
+    cpm_list.txt            log2 CPM of every sample, without the factors
+    filtered_cpm_list.txt   log2 CPM of the kept genes, with the factors
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from CHURPipelines.Summary import normalize
+
+DATA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'data', 'normalize')
+GROUPS = {'S1': 'A', 'S2': 'A', 'S3': 'B', 'S4': 'B', 'S5': 'NULL'}
+MIN_LEN = 200
+MIN_CTS = 10
+
+
+def run_normalize(tmp_path):
+    """Normalize the fixture counts into tmp_path. Returns the Counts
+    directory."""
+    groups = str(tmp_path / 'experimental_groups.xlsx')
+    pd.DataFrame({
+        'SampleName': list(GROUPS),
+        'Group': list(GROUPS.values())}).to_excel(groups, index=False)
+    os.mkdir(str(tmp_path / 'Counts'))
+    normalize.normalize(
+        os.path.join(DATA_DIR, 'subread_counts.txt'), groups, str(tmp_path),
+        MIN_LEN, MIN_CTS)
+    return str(tmp_path / 'Counts')
+
+
+def test_tmm_factors(tmp_path):
+    countsdir = run_normalize(tmp_path)
+    ours = pd.read_csv(
+        os.path.join(countsdir, 'norm_factors.txt'), sep='\t', index_col=0)
+    theirs = pd.read_csv(
+        os.path.join(DATA_DIR, 'norm_factors.txt'), sep='\t', index_col=0)
+    assert list(ours.index) == list(theirs.index)
+    assert list(ours['Group']) == ['A', 'A', 'B', 'B']
+    np.testing.assert_allclose(
+        ours['NormFactor'], theirs['NormFactor'], rtol=1e-12)
+
+
+def test_expression_filter(tmp_path):
+    countsdir = run_normalize(tmp_path)
+    ours = pd.read_csv(
+        os.path.join(countsdir, 'filtered_cpm_list.txt'), sep='\t')
+    with open(os.path.join(DATA_DIR, 'kept_genes.txt'), 'r') as f:
+        kept = f.read().split()
+    assert list(ours['genes']) == kept
+
+
+def test_log_cpm(tmp_path):
+    countsdir = run_normalize(tmp_path)
+    for table in ['cpm_list.txt', 'filtered_cpm_list.txt']:
+        diff = normalize.check(
+            os.path.join(countsdir, table), os.path.join(DATA_DIR, table))
+        assert diff is not None, table
+        assert diff <= normalize.CHECK_TOLERANCE, table
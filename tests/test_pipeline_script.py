@@ -0,0 +1,131 @@
+"""Check the pipeline scripts that bulk_rnaseq writes for the reads in
+Test_Data against the scripts in tests/expected. The parts that change from
+run to run (the time, the date and user name in the file names, and the
+paths) are replaced with placeholders before the scripts are compared. If a
+change to the scripts is intended, write the new expected scripts with
+
+    CHURP_UPDATE_EXPECTED=1 python -m pytest tests/test_pipeline_script.py
+"""
+
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+from CHURPipelines import DieGracefully
+from CHURPipelines.Schedulers import Slurm
+from CHURPipelines.Schedulers import pipeline_script
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+CHURP_DIR = os.path.dirname(TESTS_DIR)
+TEST_DATA = os.path.join(CHURP_DIR, 'Test_Data')
+EXPECTED_DIR = os.path.join(TESTS_DIR, 'expected')
+
+SCHEDULER_ARGS = {
+    'slurm': [],
+    'local': ['--max-cores', '4', '--ppn', '2']}
+
+
+def run_churp(run_dir, scheduler, extra_args):
+    """Run churp.py bulk_rnaseq with --no-submit, and return the process and
+    the output directory."""
+    outdir = os.path.join(run_dir, 'Output')
+    cmd = [
+        sys.executable, os.path.join(CHURP_DIR, 'churp.py'), 'bulk_rnaseq',
+        '--fq-folder', os.path.join(TEST_DATA, 'Test_Project_010'),
+        '--hisat2-index',
+        os.path.join(TEST_DATA, 'Genome', 'genome_snp_tran'),
+        '--gtf', os.path.join(TEST_DATA, 'Genome', 'annotations.gtf'),
+        '--adapters', os.path.join(TEST_DATA, 'test_adapters.fasta'),
+        '--output-dir', outdir,
+        '--working-dir', os.path.join(run_dir, 'Work'),
+        '--scheduler', scheduler,
+        '--queue', 'amdsmall',
+        '--no-submit'] + SCHEDULER_ARGS[scheduler] + extra_args
+    proc = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+    return proc, outdir
+
+
+def write_pipeline(run_dir, scheduler, summary_only, extra_args=None):
+    """Run churp.py bulk_rnaseq and return the text of the pipeline script
+    that it wrote."""
+    extra_args = list(extra_args or [])
+    if summary_only:
+        extra_args.append('--summary-only')
+    # churp.py exits with the code of its final message, which is not 0 when
+    # it succeeds, so look for the script instead
+    proc, outdir = run_churp(run_dir, scheduler, extra_args)
+    scripts = [
+        f for f in os.listdir(outdir) if f.endswith('.pipeline.sh')]
+    assert len(scripts) == 1, proc.stdout
+    with open(os.path.join(outdir, scripts[0]), 'r') as f:
+        return f.read()
+
+
+def normalize(script, run_dir):
+    """Replace the parts of a script that change from run to run."""
+    script = re.sub(
+        r'^# Generated at .*$', '# Generated at <NOW>', script, flags=re.M)
+    script = re.sub(
+        r'^CHURP_PYTHON=".*"$', 'CHURP_PYTHON="<PYTHON>"', script,
+        flags=re.M)
+    script = re.sub(
+        r'\d{4}-\d{2}-\d{2}\.[^./"]+\.bulk_rnaseq\.',
+        '<DATE>.<USER>.bulk_rnaseq.', script)
+    script = script.replace(run_dir, '<RUN_DIR>')
+    return script.replace(CHURP_DIR, '<CHURP_DIR>')
+
+
+@pytest.mark.parametrize('summary_only', [False, True])
+@pytest.mark.parametrize('scheduler', ['slurm', 'local'])
+def test_pipeline_script(tmp_path, scheduler, summary_only):
+    run_dir = str(tmp_path)
+    script = normalize(
+        write_pipeline(run_dir, scheduler, summary_only), run_dir)
+    name = scheduler
+    if summary_only:
+        name += '_summary_only'
+    expected_path = os.path.join(EXPECTED_DIR, name + '.pipeline.sh')
+    if os.environ.get('CHURP_UPDATE_EXPECTED'):
+        with open(expected_path, 'w') as f:
+            f.write(script)
+    with open(expected_path, 'r') as f:
+        assert script == f.read()
+
+
+def test_counts_only(tmp_path):
+    script = write_pipeline(
+        str(tmp_path), 'local', True,
+        ['--counts-only', '--norm-engine', 'numpy'])
+    assert 'COUNTS_ONLY="true"' in script
+    assert 'NORM_ENGINE="numpy"' in script
+
+
+def test_counts_only_needs_numpy(tmp_path):
+    proc, outdir = run_churp(str(tmp_path), 'local', ['--counts-only'])
+    assert proc.returncode == DieGracefully.BRNASEQ_COUNTS_ONLY, proc.stdout
+    assert '--norm-engine numpy' in proc.stdout
+
+
+def test_render_leaves_other_at_signs():
+    template = '\n'.join([
+        '# CHURP @version',
+        'for f in "${files[@]}"',
+        'echo "help@msi.umn.edu" "@versions"',
+        '@jobs'])
+    script = pipeline_script.render(
+        template,
+        Slurm.SlurmScheduler({
+            'verbosity': 'warn', 'msi_queue': 'msi', 'pbs_group': '',
+            'ppn': 1, 'mem': 1000, 'tmp_space': 1000, 'walltime': 1}),
+        [],
+        [],
+        {'version': '1.0'})
+    assert script == '\n'.join([
+        '# CHURP 1.0',
+        'for f in "${files[@]}"',
+        'echo "help@msi.umn.edu" "@versions"'])
@@ -0,0 +1,48 @@
+"""Check the resubmission scripts that 'churp resubmit' writes from the
+pipeline scripts in tests/expected."""
+
+import logging
+import os
+import shutil
+
+import pytest
+
+from CHURPipelines.RunTools import Resubmit
+
+EXPECTED_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'expected')
+
+
+def resubmit_script(tmp_path, name, mem_factor, time_factor):
+    """Write the resubmission script for tasks 2 and 4 of an expected
+    pipeline script, and return its lines. The run state is not read, so
+    the object is set up by hand."""
+    pipeline = str(tmp_path / 'bulk_rnaseq.pipeline.sh')
+    shutil.copyfile(os.path.join(EXPECTED_DIR, name), pipeline)
+    r = Resubmit.Resubmit.__new__(Resubmit.Resubmit)
+    r.resub_logger = logging.getLogger(__name__)
+    r.pipeline = pipeline
+    r.mem_factor = mem_factor
+    r.time_factor = time_factor
+    r.purge = False
+    with open(r.write_script([2, 4], [], []), 'r') as f:
+        return f.read().split('\n')
+
+
+@pytest.mark.parametrize('name, mem', [
+    ('local.pipeline.sh', '--mem=18000 '),
+    ('slurm.pipeline.sh', '--mem=18000mb ')])
+def test_scale_single_sample_array(tmp_path, name, mem):
+    lines = resubmit_script(tmp_path, name, 1.5, 2)
+    assert 'QSUB_ARRAY="2,4"' in lines
+    single = [l for l in lines if l.lstrip().startswith('single_id=$(')]
+    assert len(single) == 1
+    assert mem in single[0]
+    assert '--time=1440 ' in single[0]
+    # The summary job keeps its resources
+    summary = [l for l in lines if l.lstrip().startswith('summary_id=$(')]
+    assert summary
+    for line in summary:
+        assert '--mem=12000' in line
+        assert '--mem=18000' not in line
+        assert '--time=720 ' in line
@@ -0,0 +1,81 @@
+"""Check the keys of the shared per-sample result cache."""
+
+import glob
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+from CHURPipelines.FileOps import result_cache
+from CHURPipelines.FileOps import sheet_format
+
+LOG = logging.getLogger(__name__)
+CHURP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DATA = os.path.join(CHURP_DIR, 'Test_Data')
+FASTQ = ''.join(
+    '@read' + str(i) + '\nACGTACGTAC\n+\nIIIIIIIIII\n' for i in range(100))
+
+
+def write_fastq(path, text=FASTQ):
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def cache_keys(run_dir, bam_metrics):
+    """Write the samplesheet of a run on the reads in Test_Data with a result
+    cache, and return the cache key of each sample."""
+    outdir = os.path.join(run_dir, 'Output')
+    # churp.py exits with the code of its final message, which is not 0 when
+    # it succeeds, so look for the sheet instead
+    subprocess.run(
+        [sys.executable, os.path.join(CHURP_DIR, 'churp.py'), 'bulk_rnaseq',
+         '--fq-folder', os.path.join(TEST_DATA, 'Test_Project_010'),
+         '--hisat2-index',
+         os.path.join(TEST_DATA, 'Genome', 'genome_snp_tran'),
+         '--gtf', os.path.join(TEST_DATA, 'Genome', 'annotations.gtf'),
+         '--adapters', os.path.join(TEST_DATA, 'test_adapters.fasta'),
+         '--output-dir', outdir,
+         '--working-dir', os.path.join(run_dir, 'Work'),
+         '--cache-dir', os.path.join(run_dir, 'Cache'),
+         '--bam-metrics', bam_metrics,
+         '--scheduler', 'local', '--queue', 'amdsmall',
+         '--max-cores', '4', '--ppn', '2', '--no-submit'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    sheets = glob.glob(os.path.join(outdir, '*.samplesheet.txt'))
+    assert len(sheets) == 1
+    return {
+        r['SampleName']: r['CacheKey']
+        for r in sheet_format.read_sheet(sheets[0])}
+
+
+def test_key_changes_with_bam_metrics(tmp_path):
+    tools = cache_keys(str(tmp_path / 'tools'), 'tools')
+    pysam = cache_keys(str(tmp_path / 'pysam'), 'pysam')
+    assert sorted(tools) == sorted(pysam)
+    for sample in tools:
+        assert tools[sample]
+        assert tools[sample] != pysam[sample]
+    # The output and working directories are not in the key
+    assert tools == cache_keys(str(tmp_path / 'again'), 'tools')
+
+
+def test_fingerprint_ignores_path_and_time(tmp_path):
+    fq = write_fastq(str(tmp_path / 'S1_R1_001.fastq'))
+    copy_dir = tmp_path / 'copy'
+    copy_dir.mkdir()
+    copy = str(copy_dir / 'S1_R1_001.fastq')
+    shutil.copyfile(fq, copy)
+    os.utime(copy, (0, 0))
+    assert (result_cache.fastq_fingerprint(fq, LOG) ==
+            result_cache.fastq_fingerprint(copy, LOG))
+
+
+def test_fingerprint_changes_with_contents(tmp_path):
+    fq = write_fastq(str(tmp_path / 'S1_R1_001.fastq'))
+    other = write_fastq(
+        str(tmp_path / 'S2_R1_001.fastq'), FASTQ.replace('ACGT', 'TGCA'))
+    assert (result_cache.fastq_fingerprint(fq, LOG) !=
+            result_cache.fastq_fingerprint(other, LOG))
+    assert result_cache.fastq_fingerprint('', LOG) == ''
@@ -0,0 +1,67 @@
+"""Check the per-section resource profiles: what profile_functions.sh records
+for a short section, and how 'churp profile' aggregates the records."""
+
+import csv
+import os
+import subprocess
+
+from CHURPipelines.RunTools import RunProfile
+
+CHURP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEADER = [
+    'Sample', 'JobID', 'Section', 'Start', 'End', 'CPUUser', 'CPUSys',
+    'MaxRSSKB', 'MemScope', 'ReadBytes', 'WriteBytes', 'ExitCode']
+
+
+def test_short_section_has_no_job_peak(tmp_path):
+    # The job peak in the fake cgroup file must not be recorded as the peak
+    # of a section that the sampler did not see
+    cgroup_peak = tmp_path / 'memory.peak'
+    cgroup_peak.write_text(str(64 * 1024 ** 3) + '\n')
+    profile = tmp_path / 'Sample01_Profile.tsv'
+    subprocess.run(
+        ['bash', '-c',
+         'source "${1}"; PROF_MEM_FILE="${2}"; PROFILE_FNAME="${3}"; '
+         'PROFILE_SAMPLE=Sample01; PROFILE_JOB=1; LOG_SECTION=Short; '
+         'profile_open; true; profile_close 0',
+         'test', os.path.join(CHURP_DIR, 'PBS', 'profile_functions.sh'),
+         str(cgroup_peak), str(profile)],
+        check=True)
+    with open(str(profile), 'r') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+    assert len(rows) == 1
+    assert rows[0]['Section'] == 'Short'
+    assert rows[0]['MemScope'] == 'section'
+    assert rows[0]['MaxRSSKB'] != str(64 * 1024 ** 2)
+
+
+def test_job_peaks_are_left_out_of_the_percentiles(tmp_path):
+    logs = tmp_path / 'Logs'
+    logs.mkdir()
+    gb_kb = 1024 ** 2
+    rows = [
+        ['Sample01', '1', 'Align', '0', '100', '90', '1', str(8 * gb_kb),
+         'section', '0', '0', '0'],
+        ['Sample01', '1', 'Index', '100', '101', '1', '0', str(8 * gb_kb),
+         'job', '0', '0', '0'],
+        ['Sample02', '2', 'Align', '0', '100', '90', '1', str(6 * gb_kb),
+         'section', '0', '0', '0'],
+        ['Sample02', '2', 'Index', '100', '101', '1', '0', str(1 * gb_kb),
+         'section', '0', '0', '0'],
+        ['Sample03', '3', 'Index', '100', '101', '1', '0', 'NA',
+         'section', '0', '0', '0']]
+    for sample in ['Sample01', 'Sample02', 'Sample03']:
+        with open(str(logs / (sample + '_Profile.tsv')), 'w') as f:
+            f.write('\t'.join(HEADER) + '\n')
+            for r in rows:
+                if r[0] == sample:
+                    f.write('\t'.join(r) + '\n')
+    prof = RunProfile.RunProfile(
+        {'verbosity': 'warn', 'outdir': str(tmp_path), 'output': None})
+    table = {
+        row[0]: dict(zip(RunProfile.TABLE_COLUMNS, row))
+        for row in prof.summarize()}
+    assert table['Index']['Records'] == 3
+    assert table['Index']['MaxRSS.GB.Max'] == 1.0
+    assert table['Index']['MemScope'] == 'job,section'
+    assert table['Align']['MaxRSS.GB.p50'] == 7.0